@@ -33,6 +33,7 @@ def reset():
     event_map = {}
     from emod_api import schema_to_class as s2c
     s2c.schema_cache = None
+    s2c.clear_schema_index()
     del (implicits[:])
 
 
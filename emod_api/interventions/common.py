@@ -9,10 +9,6 @@ from typing import List
 schema_path = None
 old_adhoc_trigger_style = True
 
-cached_be = None
-cached_mid = None
-cached_sec = None
-cached_ce = None
 _MAX_AGE = 365 * 125
 
 ###
@@ -44,12 +40,9 @@ def BroadcastEvent(
     if Event_Trigger is None or Event_Trigger == "":
         raise ValueError("BroadcastEvent called with an empty Event_Trigger. Please specify a string.")
 
-    global cached_be
-    if cached_be is None:
-        global schema_path
-        schema_path = (camp.schema_path if camp is not None else schema_path)
-        cached_be = s2c.get_class_with_defaults("BroadcastEvent", schema_path)
-    intervention = copy.deepcopy(cached_be)
+    global schema_path
+    schema_path = (camp.schema_path if camp is not None else schema_path)
+    intervention = s2c.get_class_with_defaults("BroadcastEvent", schema_path)
     try:
         intervention.Broadcast_Event = camp.get_send_trigger(Event_Trigger, old=old_adhoc_trigger_style)
     except ValueError as ex:
@@ -199,10 +192,7 @@ def MultiInterventionDistributor(
     schema_path = camp.schema_path if camp is not None else schema_path
     if Intervention_List is None or type(Intervention_List) is not list or len(Intervention_List) == 0:
         raise ValueError("Intervention_List is empty or None or not a list.")
-    global cached_mid
-    if cached_mid is None:
-        cached_mid = s2c.get_class_with_defaults("MultiInterventionDistributor", schema_path)
-    intervention = copy.deepcopy(cached_mid)
+    intervention = s2c.get_class_with_defaults("MultiInterventionDistributor", schema_path)
     intervention.Intervention_List = copy.deepcopy(Intervention_List)
     if "Intervention_Name" in Intervention_List[0]:
         intervention.Intervention_Name = Intervention_List[0].Intervention_Name
@@ -458,11 +448,7 @@ def ScheduledCampaignEvent(
     # Not checking Intervention_list because MultiInterventionDistributor checks
 
     event = s2c.get_class_with_defaults("CampaignEvent", schema_path)
-    global cached_sec
-    if cached_sec is None:
-        cached_sec = s2c.get_class_with_defaults("StandardEventCoordinator", schema_path)
-
-    coordinator = copy.deepcopy(cached_sec)
+    coordinator = s2c.get_class_with_defaults("StandardEventCoordinator", schema_path)
     coordinator.Demographic_Coverage = Demographic_Coverage
     coordinator.Number_Repetitions = Number_Repetitions
     coordinator.Timesteps_Between_Repetitions = Timesteps_Between_Repetitions
@@ -580,10 +566,7 @@ def TriggeredCampaignEvent(
     if Property_Restrictions is None:
         Property_Restrictions = []
 
-    global cached_ce
-    if cached_ce is None:
-        cached_ce = s2c.get_class_with_defaults("CampaignEvent", schema_path)
-    event = copy.deepcopy(cached_ce)
+    event = s2c.get_class_with_defaults("CampaignEvent", schema_path)
     event.Start_Day = float(Start_Day)
 
     if Nodeset_Config is not None and Node_Ids is not None:
@@ -598,10 +581,7 @@ def TriggeredCampaignEvent(
         node_ids = Node_Ids
         event.Nodeset_Config = utils.do_nodes(camp.schema_path, node_ids)
 
-    global cached_sec
-    if cached_sec is None:
-        cached_sec = s2c.get_class_with_defaults("StandardEventCoordinator", schema_path)
-    coordinator = copy.deepcopy(cached_sec)
+    coordinator = s2c.get_class_with_defaults("StandardEventCoordinator", schema_path)
     coordinator.Number_Repetitions = Number_Repetitions
     coordinator.Timesteps_Between_Repetitions = Timesteps_Between_Repetitions
 
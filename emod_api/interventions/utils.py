@@ -1,9 +1,5 @@
 from emod_api import schema_to_class as s2c
 import json
-import copy
-
-cached_NSA = None
-cached_NSNL = None
 
 
 def do_nodes(schema_path, node_ids: list = None):
@@ -18,16 +14,10 @@ def do_nodes(schema_path, node_ids: list = None):
         Well-configured NodeSetConfig
     """
     if node_ids and len(node_ids) > 0:
-        global cached_NSNL
-        if cached_NSNL is None:
-            cached_NSNL = s2c.get_class_with_defaults("NodeSetNodeList", schema_path)
-        nodelist = copy.deepcopy(cached_NSNL)
+        nodelist = s2c.get_class_with_defaults("NodeSetNodeList", schema_path)
         nodelist.Node_List = node_ids
     else:
-        global cached_NSA
-        if cached_NSA is None:
-            cached_NSA = s2c.get_class_with_defaults("NodeSetAll", schema_path)
-        nodelist = copy.deepcopy(cached_NSA)
+        nodelist = s2c.get_class_with_defaults("NodeSetAll", schema_path)
     return nodelist
 
 
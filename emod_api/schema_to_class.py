@@ -1,3 +1,4 @@
+import copy
 import json
 import os
 import pdb
@@ -6,6 +7,14 @@ from collections import OrderedDict
 
 schema_cache = None
 show_warnings = True
+# id(schema) -> SchemaIndex, least recently used first, see get_schema_index()
+schema_indices = OrderedDict()
+max_schema_indices = 8
+# Default object templates kept per schema, see SchemaIndex.template()
+max_templates = 1024
+# id(schema blob) -> [schema blob, {key: validator}, depends-on graph], least recently used first, see _get_compiled()
+compiled_schemas = OrderedDict()
+max_compiled_schemas = 256
 
 
 def disable_warnings():
@@ -15,15 +24,56 @@ def disable_warnings():
     show_warnings = False
 
 class ReadOnlyDict(OrderedDict):
+    # The schema blob of the class, set with set_schema(). It is shared by all objects of the class
+    # rather than stored as an entry, so copying or serializing an object does not copy the schema.
+    __slots__ = ("_schema",)
+
     def __missing__(self, key):
         raise KeyError(f"'{key}' not found in this object. List of keys = {self.keys()}.")
 
     def __getattr__(self, item): 
+        if item == "_schema":
+            return None  # set_schema() was not called
         try:
             return self[item]
         except KeyError:
             raise AttributeError(item) # to allow deepcopy (from s/o)
 
+    def __deepcopy__(self, memo):
+        # The schema blob is shared, it is not modified and copying it dominates the cost of a copy.
+        copied = type(self)()
+        _set_schema(copied, self._schema)
+        memo[id(self)] = copied
+        for key, value in self.items():
+            copied[key] = value if key == "schema" else copy.deepcopy(value, memo)
+        return copied
+
+    def __copy__(self):
+        copied = type(self)(self)
+        _set_schema(copied, self._schema)
+        return copied
+
+    def __reduce__(self):
+        # The schema is needed to validate and finalize the object, e.g. in a worker process, so it is
+        # pickled as the state. Objects sharing a blob share it in the pickle as well.
+        return type(self), (), self._schema, None, iter(self.items())
+
+    def __setstate__(self, state):
+        _set_schema(self, state)
+
+    @property
+    def schema(self):
+        """
+            The schema blob of this object, see set_schema(). Configs loaded from JSON with a
+            "schema" node keep it as an entry, which is returned here as well. Copies share the
+            blob, pickles carry it once for all objects sharing it.
+        """
+        # The entry is looked up first, reading the slot of an object without a schema is slow.
+        schema = self.get("schema")
+        if schema is None:
+            schema = self._schema
+        return schema
+
     def __setattr__(self, key, value):
         # if key not in self and "Config" not in key and "List" not in key: # these are lame;
         # find way in schema to initialize complex types {}, [], or null
@@ -33,59 +83,16 @@ class ReadOnlyDict(OrderedDict):
         if value is None:
             return
 
-        if "schema" not in self:
+        schema = self.schema
+        if schema is None:
             print( f"DEBUG: No schema in node for param {key}." )
         else:
-            if "type" in self["schema"][key]:
-                if self["schema"][key]["type"] in [ "integer", "float" ]:
-                    if type(value) is str:
-                        raise ValueError(f"{value} is string when needs to be {self['schema'][key]['type']} "
-                                         f"for parameter {key}.")
-                    elif value < self["schema"][key]["min"]:
-                        raise ValueError(f"{value} is below minimum {self['schema'][key]['min']} for parameter {key}.")
-                    elif value > self["schema"][key]["max"]:
-                        raise ValueError(f"{value} is above maximum {self['schema'][key]['max']} "
-                                         f"for parameter {key}.")
-
-                elif self["schema"][key]["type"] == "enum":
-                    if value not in self["schema"][key]["enum"]:
-                        raise ValueError(f"{value} is not list of possible values {self['schema'][key]['enum']} "
-                                         f"for parameter {key}.")
-                elif self["schema"][key]["type"] == "bool":
-                    if not any([value is False, value is True, value == 1, value == 0]):
-                        raise ValueError(f"value needs to be a bool for parameter {key}.")
-                    if value is False:
-                        value = 0
-                    elif value is True:
-                        value = 1
-                elif "Vector" in self["schema"][key]["type"] and "idmType" not in self['schema'][key]['type']:
-                    if type(value) is not list:
-                        raise ValueError(f"Value needs to be a list for parameter {key}.")
-
-            # if param is dependent on a param, set that param to the value. but needs to be recursive.
-            if "depends-on" in self["schema"][key]:
-                # set this value BUT NOT IF key == Simulation_Type!
-                for k,v in dict(self["schema"][key]["depends-on"]).items():
-                    if k == "Simulation_Type":
-                        if k not in self.keys():
-                            # not supported yet for campaigns; need to provide campaign blobs access to config...
-                            continue
-                        elif self["Simulation_Type"] in [x.strip() for x in v.split(',')]:
-                            pass
-                        else:
-                            raise ValueError(f"ERROR: Simulation_Type needs to be one of {v} for you to be able to "
-                                             f"set {key} to {value} but it seems to be {self.Simulation_Type}.")
-                    else:
-                        if type(v) is str and len(v.split(',')) > 1:
-                            v = v.split(',')[0]  # pretty arbitrary but least arbitrary of options it seems
-                        if self["schema"][k]['default'] == self[k]:
-                            # only set implicit value if default (i.e. user didn't set it)
-                            self.__setattr__(k, v)
-                        if "implicits" not in self:  # This should NOT be needed
-                            self["implicits"] = []
-                        self["implicits"].append(key)
-
-            if "default" in self["schema"][key] and self["schema"][key]["default"] == value and value == self[key]:
+            validators = _get_compiled(schema)[1]
+            validator = validators.get(key)
+            if validator is None:
+                validator = validators[key] = _compile_validator(schema, key)
+            value = validator(self, value)
+            if value is _unchanged:
                 return
 
         self[key] = value
@@ -98,9 +105,9 @@ class ReadOnlyDict(OrderedDict):
 
     def set_schema(self, schema):
         """
-            Add schema node.
+            Set the schema blob of this object, it is referenced rather than copied.
         """
-        self["schema"] = schema
+        _set_schema(self, schema)
 
     def to_file(self, config_name="config.json"):
         """
@@ -115,37 +122,44 @@ class ReadOnlyDict(OrderedDict):
         """
             Remove all params that are disabled by depends-on param being off and schema node.
         """
+        schema = self.schema
+        depends_on = _get_depends_on(schema) if schema is not None else {}
+        # Keys to remove in the order they are found, each key is decided once.
         nuke_list = []
+        nuked = set()
+        finalized = set()
+
+        def purge_key(key):
+            # Depth first, so the keys a key depends on are decided before it (topological order).
+            finalized.add(key)
+            for dep_k, dep_v, values in depends_on[key]:
+                if dep_k not in finalized and dep_k in depends_on and dep_k in self:
+                    purge_key( dep_k )
+                if values is not None:
+                    disabled = dep_k in self and self[dep_k] not in values
+                else:
+                    disabled = self[dep_k] != dep_v or dep_k in nuked
+                if disabled and key not in nuked:
+                    nuked.add(key)
+                    nuke_list.append(key)
+
         for key, v in self.items():
-            finalized_keys = []
-            if type(v) is ReadOnlyDict and "schema" in v.keys():
+            if type(v) is ReadOnlyDict and v.schema is not None:
                 v.finalize() # experimental recursive code
-            elif type(v) is list and len(v)>0 and type(v[0]) is ReadOnlyDict and "schema" in v[0].keys():
+            elif type(v) is list and len(v)>0 and type(v[0]) is ReadOnlyDict and v[0].schema is not None:
                 for elem in v:
                     elem.finalize() # experimental recursive code
 
             if key in [ "schema", "explicits", "implicits" ]:
                 continue
-            elif key not in self["schema"]:
+            elif schema is None:
+                self.__missing__("schema")
+            elif key not in schema:
                 if show_warnings:
                     print(f"WARNING: During schema-based param purge, {key} not in schema.")
-            elif "depends-on" in self["schema"][key]:
-                def purge_key(key):
-                    if key not in self.keys() or "depends-on" not in self["schema"][key]:
-                        return
-                    for dep_k,dep_v in dict(self["schema"][key]["depends-on"]).items():
-                        if dep_k not in nuke_list and dep_k not in finalized_keys:
-                            purge_key( dep_k ) # careful
-                        if type(dep_v) is str:
-                            vals = [x.strip() for x in str(dep_v).split(',')] 
-                            if dep_k in self and self[dep_k] not in vals:
-                                nuke_list.append(key)
-                        else:
-                            if self[dep_k] != dep_v or dep_k in nuke_list:
-                                nuke_list.append(key)
-
-                    finalized_keys.append( key )
-                purge_key( key )
+            elif key in depends_on:
+                if key not in finalized:
+                    purge_key( key )
             elif v == "UNINITIALIZED STRING": # work around current schema string defaults
                 self[key] = ""
 
@@ -153,7 +167,8 @@ class ReadOnlyDict(OrderedDict):
         if "logLevel_default" in self.keys():
             ll_default = self["logLevel_default"]
             for key, val in self.items():
-                if key.startswith("logLevel_") and val == ll_default and key != "logLevel_default":
+                if key.startswith("logLevel_") and val == ll_default and key != "logLevel_default" and key not in nuked:
+                    nuked.add(key)
                     nuke_list.append(key)
 
         if "Actual_IndividualIntervention_Config" in self.keys() and "Actual_NodeIntervention_Config" in self.keys():
@@ -168,23 +183,167 @@ class ReadOnlyDict(OrderedDict):
                 raise ValueError("We have both Actual_IndividualIntervention_Config "
                                  "and Actual_NodeIntervention_Config set.")
 
-        # Note that nuke_list is not a set and is typically full of duplicates. There are many ways to de-dupe.
+        explicits = set(self["explicits"]) if "explicits" in self else ()
         for nuke_key in nuke_list:
-            if nuke_key in self.keys():
-                if "explicits" in self and nuke_key in self['explicits']:
+            if nuke_key in self:
+                if nuke_key in explicits:
                     raise ValueError(f"You set param {nuke_key} but it was disabled and is not being used.")
                 self.pop(nuke_key)
         if "implicits" in self:
             self.pop("implicits")
         if "explicits" in self:
             self.pop( "explicits" )
-        try:
-            self.pop("schema")
-        except Exception as ex:
-            raise ValueError(f"ERROR: Something bad happened during finalize: {ex}.")
+        if self._schema is not None:
+            _set_schema(self, None)
+        else:
+            try:
+                self.pop("schema")
+            except Exception as ex:
+                raise ValueError(f"ERROR: Something bad happened during finalize: {ex}.")
         return self
 
 
+_set_schema = ReadOnlyDict._schema.__set__
+
+# Returned by a validator if the value is the default and already set, i.e. nothing needs to be set.
+_unchanged = object()
+_missing = object()
+
+
+def _get_compiled(schema):
+    """
+        Returns [schema blob, validators, depends-on graph] of a schema blob. Validators are
+        compiled per key when first needed, see _compile_validator(), the graph by _get_depends_on().
+    """
+    entry = compiled_schemas.get(id(schema))
+    if entry is None or entry[0] is not schema:
+        entry = [schema, {}, None]
+        compiled_schemas[id(schema)] = entry
+        while len(compiled_schemas) > max_compiled_schemas:
+            compiled_schemas.popitem(last=False)
+    else:
+        compiled_schemas.move_to_end(id(schema))
+    return entry
+
+
+def _get_depends_on(schema):
+    """
+        Returns the depends-on graph of a schema blob, compiled on first use: parameter ->
+        ((parameter it depends on, value, stripped comma separated values or None), ...).
+    """
+    entry = _get_compiled(schema)
+    if entry[2] is None:
+        graph = {}
+        for key, param in schema.items():
+            if isinstance(param, dict) and "depends-on" in param:
+                deps = []
+                for dep_k, dep_v in dict(param["depends-on"]).items():
+                    values = tuple(x.strip() for x in dep_v.split(',')) if type(dep_v) is str else None
+                    deps.append((dep_k, dep_v, values))
+                graph[key] = tuple(deps)
+        entry[2] = graph
+    return entry[2]
+
+
+def _compile_validator(schema, key):
+    """
+        Compile the checks ReadOnlyDict.__setattr__ applies to a parameter of a schema blob into a
+        function of (object, value) which raises ValueError for an invalid value and otherwise
+        returns the value to set or _unchanged.
+    """
+    param = schema[key]
+    param_type = param["type"] if "type" in param else None
+    check = None
+
+    if param_type in [ "integer", "float" ]:
+        minimum = param["min"] if "min" in param else _missing
+        maximum = param["max"] if "max" in param else _missing
+
+        def check(value):
+            if type(value) is str:
+                raise ValueError(f"{value} is string when needs to be {param_type} for parameter {key}.")
+            elif value < (param["min"] if minimum is _missing else minimum):
+                raise ValueError(f"{value} is below minimum {minimum} for parameter {key}.")
+            elif value > (param["max"] if maximum is _missing else maximum):
+                raise ValueError(f"{value} is above maximum {maximum} for parameter {key}.")
+            return value
+
+    elif param_type == "enum":
+        enum = param["enum"]
+        try:
+            enum_set = frozenset(enum)
+        except TypeError:
+            enum_set = None
+
+        def check(value):
+            try:
+                valid = value in enum_set
+            except TypeError:
+                valid = value in enum  # unhashable value or enum of unhashable values
+            if not valid:
+                raise ValueError(f"{value} is not list of possible values {enum} for parameter {key}.")
+            return value
+
+    elif param_type == "bool":
+        def check(value):
+            if not any([value is False, value is True, value == 1, value == 0]):
+                raise ValueError(f"value needs to be a bool for parameter {key}.")
+            if value is False:
+                value = 0
+            elif value is True:
+                value = 1
+            return value
+
+    elif param_type is not None and "Vector" in param_type and "idmType" not in param_type:
+        def check(value):
+            if type(value) is not list:
+                raise ValueError(f"Value needs to be a list for parameter {key}.")
+            return value
+
+    # if param is dependent on a param, set that param to the value. but needs to be recursive.
+    # Simulation_Type is only checked, other parameters are set to the first of their values.
+    depends_on = []
+    if "depends-on" in param:
+        for k, v in dict(param["depends-on"]).items():
+            if k == "Simulation_Type":
+                allowed = tuple(x.strip() for x in v.split(',')) if type(v) is str else None
+                depends_on.append((k, v, allowed))
+            else:
+                if type(v) is str and len(v.split(',')) > 1:
+                    v = v.split(',')[0]  # pretty arbitrary but least arbitrary of options it seems
+                depends_on.append((k, v, None))
+    depends_on = tuple(depends_on)
+
+    has_default = "default" in param
+    default = param["default"] if has_default else None
+
+    def validator(obj, value):
+        if check is not None:
+            value = check(value)
+        for k, v, allowed in depends_on:
+            if k == "Simulation_Type":
+                if k not in obj.keys():
+                    # not supported yet for campaigns; need to provide campaign blobs access to config...
+                    continue
+                elif obj["Simulation_Type"] in (allowed if allowed is not None else [x.strip() for x in v.split(',')]):
+                    pass
+                else:
+                    raise ValueError(f"ERROR: Simulation_Type needs to be one of {v} for you to be able to "
+                                     f"set {key} to {value} but it seems to be {obj.Simulation_Type}.")
+            else:
+                if schema[k]['default'] == obj[k]:
+                    # only set implicit value if default (i.e. user didn't set it)
+                    obj.__setattr__(k, v)
+                if "implicits" not in obj:  # This should NOT be needed
+                    obj["implicits"] = []
+                obj["implicits"].append(key)
+        if has_default and default == value and value == obj[key]:
+            return _unchanged
+        return value
+
+    return validator
+
+
 def uses_old_waning(schema_path=None):
     global schema_cache
     if schema_path is not None:
@@ -212,11 +371,106 @@ def get_schema( schema_path=None ):
         schema = schema_cache
     return schema
 
+class SchemaIndex:
+    """
+        Lookups compiled from one schema. The default object of each class is built once and
+        kept as a template; get_class_with_defaults() returns copies of it. The intervention
+        classes of all intervention families are indexed by name when first needed.
+    """
+    def __init__(self, schema):
+        self.schema = schema
+        self.templates = OrderedDict()
+        self._interventions = None
+
+    def template(self, classname, schema_path=None):
+        """
+            Returns the default object template of a class, building it on first use. The
+            max_templates most recently used templates are kept. Do not modify the template,
+            use get_class_with_defaults() for a copy.
+        """
+        template = self.templates.get(classname)
+        if template is None:
+            template = _build_class_with_defaults( classname, self.schema, schema_path, self )
+            self.templates[classname] = template
+            while len(self.templates) > max_templates:
+                self.templates.popitem(last=False)
+        else:
+            self.templates.move_to_end(classname)
+        return template
+
+    @property
+    def interventions(self):
+        """
+            Intervention class name -> schema blob, from the first family listing the class.
+        """
+        if self._interventions is None:
+            interventions = {}
+            for iv_type in self.schema["idmTypes"]["idmAbstractType:Intervention"].values():
+                for iv_name, iv_blob in iv_type.items():
+                    interventions.setdefault(iv_name, iv_blob)
+            self._interventions = interventions
+        return self._interventions
+
+
+def get_schema_index( schema ):
+    """
+        Returns the SchemaIndex of a schema (dict), creating it on first use. Indices are kept by
+        schema identity for the few most recently used schemas.
+    """
+    index = schema_indices.get(id(schema))
+    if index is None or index.schema is not schema:
+        index = SchemaIndex(schema)
+        schema_indices[id(schema)] = index
+        while len(schema_indices) > max_schema_indices:
+            schema_indices.popitem(last=False)
+    else:
+        schema_indices.move_to_end(id(schema))
+    return index
+
+
+def clear_schema_index():
+    """
+        Forget all compiled schema indices, templates, and validators, e.g. after modifying a
+        loaded schema.
+    """
+    schema_indices.clear()
+    compiled_schemas.clear()
+
+
+_containers = frozenset([dict, list, ReadOnlyDict])
+
+
+def copy_template( template ):
+    """
+        Copy a default object template. Containers are copied, the schema blobs set with
+        ReadOnlyDict.set_schema() are shared with the template.
+    """
+    if type(template) is list:
+        return [copy_template(value) if type(value) in _containers else value for value in template]
+    elif type(template) not in _containers:
+        return template
+    # Copy the entries at once and then replace the few containers.
+    copied = type(template)(template)
+    if type(template) is ReadOnlyDict:
+        _set_schema(copied, template._schema)
+    for key, value in template.items():
+        if type(value) in _containers:
+            copied[key] = copy_template(value)
+    return copied
+
+
 def get_class_with_defaults( classname, schema_path=None ):
     """
         Returns the default config for a datatype in the schema.
+
+        The default object of each class is built once per schema and copied on later calls,
+        see SchemaIndex.template() and copy_template().
     """
-    schema = get_schema(schema_path)
+    index = get_schema_index(get_schema(schema_path))
+    return copy_template(index.template(classname, schema_path))
+
+
+def _build_class_with_defaults( classname, schema, schema_path, index ):
     ret_json = {}  # there are some types that are actually arrays!?
     schema_blob = None
 
@@ -364,42 +618,40 @@ def get_class_with_defaults( classname, schema_path=None ):
             except Exception as ex:
                 raise ValueError(f"ERROR: {ex}")
     else:
-        for iv_type in schema["idmTypes"]["idmAbstractType:Intervention"].keys():
-            if classname in schema["idmTypes"]["idmAbstractType:Intervention"][iv_type].keys():
-                schema_blob = schema["idmTypes"]["idmAbstractType:Intervention"][iv_type][classname]
-                ret_json["class"] = schema_blob["class"]
-                for iv_key in schema_blob.keys():
-                    if any( [ iv_key == "class", iv_key == "iv_type" ] ):
+        if classname in index.interventions:
+            schema_blob = index.interventions[classname]
+            ret_json["class"] = schema_blob["class"]
+            for iv_key in schema_blob.keys():
+                if any( [ iv_key == "class", iv_key == "iv_type" ] ):
+                    continue
+                try:
+                    if "default" in schema_blob[iv_key]:
+                        ret_json[iv_key] = schema_blob[iv_key]["default"]
+
+                    elif "_Config" in iv_key and iv_key.count("_") > 1:
+                        # this sucks, looking for things like Actual_IndividualIntervention_Config
+                        # and Positive_Diagnosis_Config
+                        ret_json[iv_key] = {}
+
+                    elif "type" in schema_blob[iv_key]:
+                        idmtype = schema_blob[iv_key]["type"]
+                        if "Vector" in idmtype:
+                            ret_json[iv_key] = []
+                        elif "String" in idmtype:
+                            ret_json[iv_key] = ""
+                        elif "idmType:" in schema_blob[iv_key]["type"]:
+                            ret_json[iv_key] = get_class_with_defaults( idmtype, schema["idmTypes"] )
+                        elif "List" in iv_key:  # a bit lame: to handle Intervention_List which has bad schema bug
+                            ret_json[iv_key] = []
+                        else:
+                            raise ValueError(f"Don't know how to make default for type {idmtype}.")
+                    elif iv_key not in ["Sim_Types"]:
+                        # very small whitelist of keys that are allowed to be ignored by this process.
                         continue
-                    try:
-                        if "default" in schema_blob[iv_key]:
-                            ret_json[iv_key] = schema_blob[iv_key]["default"]
-
-                        elif "_Config" in iv_key and iv_key.count("_") > 1:
-                            # this sucks, looking for things like Actual_IndividualIntervention_Config
-                            # and Positive_Diagnosis_Config
-                            ret_json[iv_key] = {}
-
-                        elif "type" in schema_blob[iv_key]:
-                            idmtype = schema_blob[iv_key]["type"]
-                            if "Vector" in idmtype:
-                                ret_json[iv_key] = []
-                            elif "String" in idmtype:
-                                ret_json[iv_key] = ""
-                            elif "idmType:" in schema_blob[iv_key]["type"]:
-                                ret_json[iv_key] = get_class_with_defaults( idmtype, schema["idmTypes"] )
-                            elif "List" in iv_key:  # a bit lame: to handle Intervention_List which has bad schema bug
-                                ret_json[iv_key] = []
-                            else:
-                                raise ValueError(f"Don't know how to make default for type {idmtype}.")
-                        elif iv_key not in ["Sim_Types"]:
-                            # very small whitelist of keys that are allowed to be ignored by this process.
-                            continue
 
-                    except Exception as ex:
-                        raise ValueError(f"ERROR: Exception caught while processing {iv_key} in Intervention family."
-                                         f"Exception: {ex}")
-                break
+                except Exception as ex:
+                    raise ValueError(f"ERROR: Exception caught while processing {iv_key} in Intervention family."
+                                     f"Exception: {ex}")
         if bool(ret_json) is False:
             raise ValueError(f"Failed to find {classname} in schema.")
 
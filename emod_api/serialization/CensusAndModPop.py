@@ -14,7 +14,9 @@ def change_ser_pop(input_serpop_path, mod_fn=None, save_file_path=None):
 
     The new file is saved to a name provided by user. Interactive if none provided to function.
 
-    Assuming a single node file for now.
+    All nodes of the file are processed. For changes which can be expressed as "set this field where
+    that condition holds" use SerializedPopulation.set_field() instead, it applies the change to all
+    selected individuals without calling back into Python for each of them.
     """
     # print( f"change_ser_pop called with 'path'={input_serpop_path}, 'save_file_path'={save_file_path}." )
 
@@ -29,21 +31,17 @@ def change_ser_pop(input_serpop_path, mod_fn=None, save_file_path=None):
 
     ser_pop = sp.SerializedPopulation(input_serpop_path) 
 
-    if len(ser_pop.nodes) > 1:
-        print( "This code currently operates properly on single-node population files. This file has {len(ser_pop)} nodes." )
-        return
+    pop_size = sum( len( node["individualHumans"] ) for node in ser_pop.nodes )
+    print( f"Found {pop_size} people -- or agents -- in {len(ser_pop.nodes)} node(s) of serialized population file." )
 
-    node_0 = ser_pop.nodes[0]
-    pop_size = len( node_0["individualHumans"] )
-    print( f"Found {pop_size} people -- or agents -- in serialized population file." )
-  
-    for person in range(len(node_0["individualHumans"])):
-        # 1) Figure out what age bucket this person is in.
-        if "individualHumans" not in node_0:
-            print( "ERROR: Failed to find 'individualHumans' in node_0 serialized population input." )
+    for node in ser_pop.nodes:
+        if "individualHumans" not in node:
+            print( "ERROR: Failed to find 'individualHumans' in node of serialized population input." )
+            continue
 
         if mod_fn:
-            node_0["individualHumans"][person] = mod_fn( node_0["individualHumans"][person] )
+            for person in range(len(node["individualHumans"])):
+                node["individualHumans"][person] = mod_fn( node["individualHumans"][person] )
 
     if mod_fn:
         if save_file_path==None:
@@ -51,4 +49,30 @@ def change_ser_pop(input_serpop_path, mod_fn=None, save_file_path=None):
     ser_pop.write( save_file_path )
 
 
-
+def change_ser_pop_fields(input_serpop_path, updates, save_file_path, fields=sp.DEFAULT_FIELDS):
+    """
+    Load a serialization population file, apply column-wise updates to the individuals of all nodes, and
+    save the result.
+
+    Args:
+        input_serpop_path: serialized population file to change
+        updates: list of (field, values, condition) tuples applied in order. condition is called with the
+            table of the unchanged population from SerializedPopulation.to_table() and returns a boolean
+            mask, or is None for everybody. See SerializedPopulation.set_field() for field and values.
+        save_file_path: name of the new serialized population file
+        fields: fields of the table passed to the conditions
+
+    Examples:
+        Make children under 5 immune::
+
+            change_ser_pop_fields("state-00100.dtk",
+                                  [("susceptibility.mod_acquire", 0, lambda table: table.m_age < 5 * 365)],
+                                  "state-00100-protected.dtk")
+    """
+    ser_pop = sp.SerializedPopulation(input_serpop_path)
+    table = ser_pop.to_table(fields)
+    for field, values, condition in updates:
+        where = condition(table) if condition is not None else None
+        changed = ser_pop.set_field(field, values, where)
+        print( f"Set {field} for {changed} individuals." )
+    ser_pop.write( save_file_path )
@@ -1,32 +1,230 @@
 """Class to load and manipulate a saved population."""
 import json
 import collections
+import collections.abc
 import difflib
 import copy
+import functools
+import numpy as np
+import pandas as pd
 import emod_api.serialization.dtkFileTools as dft
 
 
 COUNTER = 0
 
+# Per-individual fields exported by to_table() and read_table() by default.
+DEFAULT_FIELDS = ("suid.id", "m_age", "m_gender", "m_is_infected", "m_mc_weight", "infections",
+                  "susceptibility.age", "susceptibility.mod_acquire", "susceptibility.mod_transmit",
+                  "susceptibility.mod_mortality")
+
+
+class _TrackedNodes(list):
+    """List of nodes which remembers the indices of the nodes handed out, these may have been modified."""
+
+    def __init__(self, nodes):
+        super().__init__(nodes)
+        self.dirty = set()
+
+    def __getitem__(self, index):
+        # Only record the index once the access succeeded, an invalid index must not reach flush().
+        item = super().__getitem__(index)
+        self._mark(index)
+        return item
+
+    def __setitem__(self, index, value):
+        super().__setitem__(index, value)
+        self._mark(index)
+
+    def _mark(self, index):
+        if isinstance(index, slice):
+            self.dirty.update(range(*index.indices(len(self))))
+        else:
+            self.dirty.add(index + len(self) if index < 0 else index)
+
+    def __iter__(self):
+        self.dirty.update(range(len(self)))
+        return super().__iter__()
+
+
+KeyPathInfo = collections.namedtuple("KeyPathInfo", ["path", "types", "count", "cardinality"])
+
+
+class KeyPathIndex:
+    """Index of the unique key paths in a set of nodes, e.g. "individualHumans[].susceptibility.age".
+
+    The index is built once from a sample of the elements of every list, lookups by path or by
+    (fuzzy) field name are then dictionary lookups rather than walks of the whole population.
+
+    Args:
+        nodes: node objects, e.g. :attr:`SerializedPopulation.nodes`
+        sample: maximum number of (evenly spaced) elements of each list which are indexed, None for all
+        max_values: maximum number of distinct values counted per path for the cardinality
+
+    Examples:
+        Where is the age of an individual stored?::
+
+            index = ser_pop.key_paths()
+            print(index.find("age"))
+            ['individualHumans[].m_age', 'individualHumans[].susceptibility.age']
+            print(index["individualHumans[].m_gender"])
+            KeyPathInfo(path='individualHumans[].m_gender', types=('int',), count=100, cardinality=2)
+    """
+
+    def __init__(self, nodes=(), sample: int = 100, max_values: int = 1000):
+        self._sample = sample
+        self._max_values = max_values
+        self._types = collections.defaultdict(set)
+        self._counts = collections.Counter()
+        self._values = collections.defaultdict(set)
+        self._names = None
+        for node in nodes:
+            self._add(node, "")
+
+    @classmethod
+    def from_file(cls, file: str, sample: int = 100, max_values: int = 1000, workers: int = None):
+        """Build the index from a serialized population file.
+
+        The file is read lazily and each node is decoded, indexed, and released before the next one,
+        so only one decoded node (per worker) is held in memory at a time.
+
+        Args:
+            file: serialized population file
+            sample: maximum number of elements of each list which are indexed
+            max_values: maximum number of distinct values counted per path
+            workers: number of worker processes, each node is decoded and indexed in a worker
+        """
+        dtk = dft.read(file, lazy=True)
+        index = cls(sample=sample, max_values=max_values)
+        for node_index in dft.map_nodes(dtk, functools.partial(_index_node, sample=sample, max_values=max_values),
+                                        workers):
+            index.update(node_index)
+        return index
+
+    def update(self, other: "KeyPathIndex"):
+        """Add the paths of another index, e.g. one built from another node."""
+        for path, types in other._types.items():
+            self._types[path].update(types)
+        for path, other_values in other._values.items():
+            values = self._values[path]
+            for value in other_values:
+                if len(values) >= self._max_values:
+                    break
+                values.add(value)
+        self._counts.update(other._counts)
+        self._names = None
+
+    def _add(self, item, path):
+        if path:
+            # SerialObject and CompactObject are reported as dict
+            self._types[path].add("dict" if isinstance(item, collections.abc.Mapping) else type(item).__name__)
+            self._counts[path] += 1
+        if isinstance(item, collections.abc.Mapping):
+            for key, value in item.items():
+                self._add(value, path + "." + key if path else key)
+        elif isinstance(item, list):
+            step = max(1, len(item) // self._sample) if self._sample else 1
+            for element in item[::step][:self._sample]:
+                self._add(element, path + "[]")
+        elif path:
+            values = self._values[path]
+            if len(values) < self._max_values:
+                values.add(item)
+
+    def _name_lookup(self):
+        # lower case field name (last part of the path) -> paths, built on first use
+        if self._names is None:
+            self._names = collections.defaultdict(list)
+            for path in sorted(self._types):
+                self._names[path.rstrip("[]").rsplit(".", 1)[-1].lower()].append(path)
+        return self._names
+
+    def __len__(self):
+        return len(self._types)
+
+    def __iter__(self):
+        return iter(sorted(self._types))
+
+    def __contains__(self, path):
+        return path in self._types
+
+    def __getitem__(self, path) -> KeyPathInfo:
+        """Types, number of occurrences in the sample, and number of distinct scalar values of a path."""
+        if path not in self._types:
+            raise KeyError(path)
+        values = self._values.get(path)
+        return KeyPathInfo(path, tuple(sorted(self._types[path])), self._counts[path],
+                           len(values) if values is not None else None)
+
+    @property
+    def paths(self) -> list:
+        """All indexed paths, sorted."""
+        return sorted(self._types)
+
+    def find(self, name: str, cutoff: float = 0.6) -> list:
+        """Paths of the fields with the given name, ignoring case, or a similar name.
+
+        Args:
+            name: field name, e.g. "age", or a full path, e.g. "individualHumans[].m_age"
+            cutoff: similarity threshold for approximate matches, see difflib.get_close_matches()
+
+        Returns:
+            sorted list of paths, only the path itself if name is an indexed path
+        """
+        if name in self._types:
+            return [name]
+        names = self._name_lookup()
+        matches = list(names.get(name.lower(), []))
+        # The field names are far fewer than the paths, let alone the values in the population.
+        for field in difflib.get_close_matches(name.lower(), list(names), n=10, cutoff=cutoff):
+            matches.extend(names[field])
+        matches.extend(difflib.get_close_matches(name, list(self._types), n=10, cutoff=cutoff))
+        return sorted(set(matches))
+
+    def __str__(self):
+        lines = []
+        for path in self.paths:
+            info = self[path]
+            cardinality = "" if info.cardinality is None else info.cardinality
+            lines.append(f"{path:<64} {'|'.join(info.types):<16} {info.count:>8} {cardinality:>8}")
+        return "\n".join(lines)
+
+
 class SerializedPopulation:
     """Opens the passed file and reads in all the nodes.
 
     Args:
         file: serialized population file
+        workers: number of threads used to decompress the nodes while they are parsed,
+            by default the nodes are read one after another
+        compact: decode the nodes as :class:`dtkFileSupport.CompactObject` which share the keys of
+            objects with the same fields, e.g. all individuals, and need much less memory, but take
+            longer to decode. The objects behave like dicts with attribute access and are written
+            back as the same JSON.
 
     Examples:
         Create an instance of SerializedPopulation::
 
             import emod_api.serialization.SerializedPopulation as SerPop
             ser_pop = SerPop.SerializedPopulation('state-00001.dtk')
+
+        Decompress the nodes of a file with many nodes in 4 threads::
+
+            ser_pop = SerPop.SerializedPopulation('state-00001.dtk', workers=4)
+
+        Analyze a checkpoint with millions of individuals in less memory::
+
+            ser_pop = SerPop.SerializedPopulation('state-00001.dtk', compact=True)
         
      """
 
-    def __init__(self, file: str):
+    def __init__(self, file: str, workers: int = None, compact: bool = False):
         self.next_infection_suid = None
         self.next_infection_suid_initialized = False
-        self.dtk = dft.read(file)
-        self._nodes = [n for n in self.dtk.nodes]
+        # Simulation suid generator name -> [next id, numtasks], each is read from the simulation once.
+        self._suid_generators = {}
+        self.dtk = dft.read(file, compact=compact)
+        self._nodes = _TrackedNodes(dft.read_nodes(self.dtk, workers))
+        self._key_paths = None
 
     @property
     def nodes(self):
@@ -64,13 +262,38 @@ class SerializedPopulation:
                 node["individualHumans"][1]["infections"].append(infection)
                 node["individualHumans"][1].m_is_infected = True
 
+            Add many new individuals, allocating their ids in one call::
+
+                suids = ser_pop.allocate_individual_suids(0, len(new_individuals))
+                for individual, suid in zip(new_individuals, suids):
+                    individual["suid"] = suid
+                ser_pop.nodes[0].individualHumans.extend(new_individuals)
+
+        Nodes which are accessed through this property are considered modified and are
+        serialized again by :meth:`write`, also by later writes as references to them may be
+        kept and changed, all other nodes are written back unchanged.
         """
         return self._nodes
 
+    def mark_dirty(self, node_index: int):
+        """Mark a node as modified so that :meth:`write` serializes it again.
+
+        Nodes retrieved through :attr:`nodes` are marked automatically, use this e.g. after
+        modifying a node object obtained from somewhere else.
+
+        Args:
+            node_index: index of the node in :attr:`nodes`
+        """
+        if node_index < 0:
+            node_index += len(self._nodes)
+        if node_index < 0 or node_index >= len(self._nodes):
+            raise IndexError(f"Node index {node_index} out of range.")
+        self._nodes.dirty.add(node_index)
+
     def flush(self):
         """Save all made changes to the node(s)."""
-        for idx in range(len(self._nodes)):
-            self.dtk.nodes[idx] = self._nodes[idx]
+        for idx in sorted(self._nodes.dirty):
+            self.dtk.nodes[idx] = list.__getitem__(self._nodes, idx)
 
     def write(self, output_file: str = "my_sp_file.dtk"):
         """Write the population to a file.
@@ -79,36 +302,194 @@ class SerializedPopulation:
             output_file: output file
         """
         self.flush()
-        sim = self.dtk.simulation
-        sim["infectionSuidGenerator"]["next_suid"] = self.get_next_infection_suid()
-        self.dtk.simulation = sim
-
+        if self._suid_generators:
+            sim = self.dtk.simulation
+            for name, (next_id, _) in self._suid_generators.items():
+                sim[name]["next_suid"] = {"id": next_id}
+            self.dtk.simulation = sim
+        # Change the compression after assigning the modified objects, their chunks are then skipped and
+        # only compressed once when they are serialized.
         self.dtk.compression = dft.LZ4
+
         print(f"Saving file {output_file}.")
         dft.write(self.dtk, output_file)
 
-    def get_next_infection_suid(self):
-        """Each infection needs a unique identifier, this function returns one."""
-        sim = self.dtk.simulation
-        if not self.next_infection_suid_initialized:
-            self.next_infection_suid = sim["infectionSuidGenerator"]["next_suid"]
-            self.next_infection_suid_initialized = True
+    def to_table(self, fields=DEFAULT_FIELDS) -> pd.DataFrame:
+        """Flatten per-individual fields of all nodes into a table with one row per individual.
+
+        Args:
+            fields: dotted paths of the fields to export, relative to an individual. See
+                :func:`read_table` for how lists and properties are handled.
+
+        Returns:
+            DataFrame with a "node" column holding the index of the node of each individual and a
+            column for each field
+
+        Examples:
+            Count individuals under 5 years by node::
+
+                table = ser_pop.to_table(["m_age", "Properties.Risk"])
+                print(table[table.m_age < 5 * 365].groupby("node").size())
+        """
+        # Reading the nodes for the export does not mark them as modified.
+        columns = [_node_columns(node, tuple(fields)) for node in list.__iter__(self._nodes)]
+        return _concatenate_columns(columns, fields)
+
+    def to_parquet(self, path: str, fields=DEFAULT_FIELDS):
+        """Write the table from :meth:`to_table` to a Parquet file, requires pyarrow or fastparquet.
+
+        Args:
+            path: output file
+            fields: dotted paths of the fields to export
+        """
+        self.to_table(fields).to_parquet(path)
+
+    def set_field(self, field: str, values, where=None) -> int:
+        """Set a per-individual field for many individuals across all nodes at once.
+
+        The rows are those of :meth:`to_table`, i.e. the individuals of all nodes in order, so
+        masks and values computed from the table can be passed directly.
+
+        Args:
+            field: dotted path of the field relative to an individual, e.g. "susceptibility.mod_acquire"
+                or "Properties.Risk"
+            values: a single value, one value per selected individual, or one value per row
+            where: boolean mask with one entry per row selecting the individuals to change, all
+                individuals if None
+
+        Returns:
+            The number of individuals changed.
+
+        Examples:
+            Remove the susceptibility of all children under 5::
+
+                table = ser_pop.to_table(["m_age"])
+                ser_pop.set_field("susceptibility.mod_acquire", 0, where=table.m_age < 5 * 365)
+                ser_pop.write("children_protected.dtk")
+        """
+        counts = [len(node["individualHumans"]) for node in list.__iter__(self._nodes)]
+        rows = sum(counts)
+        if where is None:
+            selected = np.arange(rows)
         else:
-            self.next_infection_suid["id"] = (
-                self.next_infection_suid["id"]
-                + sim["infectionSuidGenerator"]["numtasks"]
-            )
+            where = np.asarray(where, dtype=bool)
+            if where.shape != (rows,):
+                raise ValueError(f"Mask has {where.size} entries but there are {rows} individuals.")
+            selected = np.flatnonzero(where)
+
+        values = np.asarray(values)
+        if values.ndim == 0:
+            values = np.broadcast_to(values, selected.shape)
+        elif values.shape == (rows,) and rows != len(selected):
+            values = values[selected]
+        elif values.shape != selected.shape:
+            raise ValueError(f"Got {values.size} values for {len(selected)} selected individuals.")
+        # Python scalars so the nodes can be serialized again
+        values = values.tolist()
+
+        parts = field.split(".")
+        offsets = np.cumsum([0] + counts)
+        bounds = np.searchsorted(selected, offsets)
+        for index in range(len(counts)):
+            first, last = bounds[index], bounds[index + 1]
+            if first == last:
+                continue
+            self.mark_dirty(index)
+            individuals = list.__getitem__(self._nodes, index)["individualHumans"]
+            for row, value in zip((selected[first:last] - offsets[index]).tolist(), values[first:last]):
+                _assign(individuals[row], parts, value)
+
+        return len(selected)
+
+    def key_paths(self, sample: int = 100, refresh: bool = False) -> KeyPathIndex:
+        """Index of the key paths in the nodes, see :class:`KeyPathIndex`.
+
+        The index is built on the first call and reused afterwards.
+
+        Args:
+            sample: maximum number of elements of each list which are indexed, e.g. individuals per node
+            refresh: rebuild the index, e.g. after adding new fields
+
+        Examples:
+            Find the parameters related to immunity::
+
+                index = ser_pop.key_paths()
+                for path in index.find("immunity"):
+                    print(index[path])
+        """
+        if self._key_paths is None or refresh:
+            self._key_paths = KeyPathIndex(list.__iter__(self._nodes), sample)
+        return self._key_paths
+
+    def allocate_infection_suids(self, n: int) -> list:
+        """Reserve unique identifiers for n infections.
+
+        The ids are taken from the simulation's infection suid generator, stepping by its
+        ``numtasks`` like EMOD does. The generator is read from the simulation once and the next
+        id is saved by :meth:`write`.
+
+        Args:
+            n: number of ids, a ValueError is raised if it is negative
+
+        Returns:
+            list of n suids, e.g. ``[{'id': 6803}, {'id': 6804}]``
+        """
+        suids = self._allocate_simulation_suids("infectionSuidGenerator", n)
+        if suids:
+            self.next_infection_suid = dict(suids[-1])
+            self.next_infection_suid_initialized = True
+        return suids
+
+    def allocate_individual_suids(self, node: int, n: int) -> list:
+        """Reserve unique identifiers for n individuals of a node.
 
-        return dict(self.next_infection_suid)
+        The ids are taken from the node's individual suid generator, stepping by its
+        ``numtasks`` like EMOD does, and the generator is advanced past them. Files in which the
+        nodes have no generator use the simulation's individual suid generator, which is read
+        once and saved by :meth:`write` like the infection suid generator.
+
+        Args:
+            node: index of the node in :attr:`nodes`
+            n: number of ids, a ValueError is raised if it is negative
+
+        Returns:
+            list of n suids, e.g. ``[{'id': 1032}, {'id': 1033}]``
+        """
+        _check_suid_count(n)
+        if "m_IndividualHumanSuidGenerator" not in list.__getitem__(self._nodes, node):
+            return self._allocate_simulation_suids("individualHumanSuidGenerator", n)
+        generator = self._nodes[node]["m_IndividualHumanSuidGenerator"]
+        first = generator["next_suid"]["id"]
+        stride = generator["numtasks"]
+        generator["next_suid"]["id"] = first + n * stride
+        return [{"id": suid} for suid in range(first, first + n * stride, stride)]
+
+    def _allocate_simulation_suids(self, name, n):
+        _check_suid_count(n)
+        if name not in self._suid_generators:
+            generator = self.dtk.simulation[name]
+            self._suid_generators[name] = [generator["next_suid"]["id"], generator["numtasks"]]
+        first, stride = self._suid_generators[name]
+        self._suid_generators[name][0] = first + n * stride
+        return [{"id": suid} for suid in range(first, first + n * stride, stride)]
+
+    def get_next_infection_suid(self):
+        """Each infection needs a unique identifier, this function returns one.
+
+        Use :meth:`allocate_infection_suids` to get many ids at once.
+        """
+        return self.allocate_infection_suids(1)[0]
 
     def get_next_individual_suid(self, node_id: int) -> dict:
         """Each individual needs a unique identifier, this function returns one.
 
+        Use :meth:`allocate_individual_suids` to get many ids at once.
+
         Args:
-            node_id: The first parameter.
+            node_id: index of the node in :attr:`nodes`
 
         Returns:
-            The return value. True for success, False otherwise.
+            The suid of the new individual.
 
         Examples:
             To get a unique id for an individual::
@@ -116,15 +497,100 @@ class SerializedPopulation:
                 print(sp.get_next_individual_suid(0))
                 {'id': 2}
         """
-        suid = self._nodes[node_id]["m_IndividualHumanSuidGenerator"]["next_suid"]
-        self._nodes[node_id]["m_IndividualHumanSuidGenerator"]["id"] = (
-            suid["id"]
-            + self._nodes[node_id]["m_IndividualHumanSuidGenerator"]["numtasks"]
-        )
-        return dict(suid)
+        return self.allocate_individual_suids(node_id, 1)[0]
 
 
 ### Some useful functions ###
+def read_table(file: str, fields=DEFAULT_FIELDS, workers: int = None, compact: bool = False) -> pd.DataFrame:
+    """Flatten per-individual fields of a serialized population file into a table.
+
+    The file is read lazily and the nodes are decoded and flattened one at a time, so only one decoded
+    node (per worker) is held in memory besides the columns of the table.
+
+    Fields are dotted paths relative to an individual, e.g. "m_age" or "susceptibility.mod_acquire".
+    A path ending in a list gives the length of the list, so "infections" is the number of infections.
+    A path through a list of "key:value" strings selects the value, so "Properties.Risk" is the value of
+    the individual property Risk. Missing fields are None.
+
+    Args:
+        file: serialized population file
+        fields: dotted paths of the fields to export
+        workers: number of worker processes, each node is decoded and flattened in a worker
+        compact: decode each node as compact objects, see :class:`SerializedPopulation`
+
+    Returns:
+        DataFrame with a "node" column holding the index of the node of each individual and a
+        column for each field
+    """
+    dtk = dft.read(file, lazy=True, compact=compact)
+    columns = dft.map_nodes(dtk, functools.partial(_node_columns, fields=tuple(fields)), workers)
+    return _concatenate_columns(columns, fields)
+
+
+def _check_suid_count(n):
+    # A negative count would move the generator back and later ids would repeat ones already handed out.
+    if n < 0:
+        raise ValueError(f"Cannot allocate a negative number of suids ({n}).")
+
+
+def _lookup(value, parts):
+    for part in parts:
+        if isinstance(value, collections.abc.Mapping):
+            value = value.get(part)
+        elif isinstance(value, list):
+            # Individual properties are serialized as a list of "key:value" strings.
+            prefix = part + ":"
+            value = next((entry[len(prefix):] for entry in value
+                          if isinstance(entry, str) and entry.startswith(prefix)), None)
+        else:
+            return None
+    return len(value) if isinstance(value, list) else value
+
+
+def _assign(individual, parts, value):
+    container = individual
+    for part in parts[:-1]:
+        container = container[part]
+    key = parts[-1]
+    if isinstance(container, list):
+        # Individual properties are serialized as a list of "key:value" strings.
+        prefix = key + ":"
+        entry = f"{key}:{value}"
+        for position, current in enumerate(container):
+            if isinstance(current, str) and current.startswith(prefix):
+                container[position] = entry
+                break
+        else:
+            container.append(entry)
+    else:
+        container[key] = value
+
+
+def _node_columns(node, fields):
+    individuals = node["individualHumans"]
+    paths = [field.split(".") for field in fields]
+    values = [[] for _ in fields]
+    # A single pass over the individuals fills all columns.
+    for individual in individuals:
+        for parts, column in zip(paths, values):
+            column.append(_lookup(individual, parts))
+    columns = {field: np.asarray(column) for field, column in zip(fields, values)}
+    return len(individuals), columns
+
+
+def _concatenate_columns(node_columns, fields):
+    table = {"node": np.repeat(np.arange(len(node_columns)), [count for count, _ in node_columns])}
+    for field in fields:
+        # Nodes without individuals give float arrays, leave them out so they do not change the dtype.
+        arrays = [columns[field] for count, columns in node_columns if count > 0]
+        table[field] = np.concatenate(arrays) if arrays else np.empty(0)
+    return pd.DataFrame(table)
+
+
+def _index_node(node, sample, max_values):
+    return KeyPathIndex([node], sample, max_values)
+
+
 def find(name: str, handle, currentlevel="dtk.nodes"):
     """Recursively searches for a paramters that matches or is close to name and prints out where to find it in the file.
 
@@ -145,7 +611,9 @@ def find(name: str, handle, currentlevel="dtk.nodes"):
             2000   Found in:  dtk.nodes.m_vectorpopulations[0].EggQueues[0].age
             2001   Found in:  dtk.nodes.m_vectorpopulations[0].EggQueues[1].age
             ...
- 
+
+        This walks every value of the population, :meth:`SerializedPopulation.key_paths` builds an
+        index of the paths once which answers the same question much faster.
     """
     global COUNTER
     if isinstance(
@@ -158,7 +626,7 @@ def find(name: str, handle, currentlevel="dtk.nodes"):
         COUNTER += 1
         return
 
-    if isinstance(handle, str) or not isinstance(handle, collections.Iterable):
+    if isinstance(handle, str) or not isinstance(handle, collections.abc.Iterable):
         return
 
     # key can be a string or on dict/list/..
@@ -170,7 +638,7 @@ def find(name: str, handle, currentlevel="dtk.nodes"):
         )
         try:
             tmp = handle[key]
-            if isinstance(tmp, collections.Iterable):
+            if isinstance(tmp, collections.abc.Iterable):
                 find(name, key, level + "[]")
             else:
                 find(name, key, level)
@@ -204,7 +672,7 @@ def get_parameters(handle, currentlevel="dtk.nodes"):
         param.add(currentlevel)
         return param
 
-    if not isinstance(handle, collections.Iterable):
+    if not isinstance(handle, collections.abc.Iterable):
         return param
 
     for _, d in enumerate(handle):
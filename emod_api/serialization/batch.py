@@ -0,0 +1,172 @@
+#!/usr/bin/python
+
+"""
+Apply a function to many serialized population files, e.g. all checkpoints of a sweep, in parallel.
+
+Each file is processed in a worker process of a process pool. By default every worker process handles
+a single file and is then replaced, so memory held on to by one file, e.g. a decoded population, is
+returned to the operating system before the next file. Python 3.11 and later replace the workers of the
+pool, on older versions each group of files is given to a new single process pool instead. Results are
+yielded as soon as each file is done together with the time it took and the peak resident memory of the
+worker, failures are reported rather than raised so one damaged file does not abort the batch.
+
+The function is called with the filename and must be picklable, e.g. a module level function or a
+functools.partial of one, and guard the calling script with ``if __name__ == "__main__":``.
+
+Example:
+    import emod_api.serialization.batch as batch
+    import emod_api.serialization.SerializedPopulation as SerPop
+
+    def count_infected(filename):
+        table = SerPop.read_table(filename, fields=["m_is_infected"])
+        return int(table.m_is_infected.sum())
+
+    if __name__ == "__main__":
+        for item in batch.map("output/state-*.dtk", count_infected, workers=16, memory_limit=4 * 2**30):
+            if item.error is None:
+                print(item.file, item.result, "{0:.1f}s".format(item.seconds))
+            else:
+                print(item.file, "FAILED", item.error)
+"""
+
+import collections
+import concurrent.futures
+import glob
+import sys
+import time
+import traceback
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+BatchResult = collections.namedtuple("BatchResult", ["file", "result", "error", "seconds", "peak_rss"])
+BatchResult.__doc__ = """
+Outcome of one file of a batch.
+
+Attributes:
+    file: the filename
+    result: return value of the function, None if it failed
+    error: None on success, otherwise the formatted exception (traceback) as a string
+    seconds: wall clock time of the function call
+    peak_rss: peak resident set size in bytes of the process over its lifetime so far, None if the resource
+        module is not available. This is the peak of this file only if the worker process handled no other
+        file before it (max_tasks_per_child=1), in this process (workers=None) it covers the whole batch.
+"""
+
+
+def map(files, fn, workers=None, max_tasks_per_child=1, memory_limit=None):
+    """
+    Call a function for each of several serialized population files in a pool of worker processes.
+
+    Args:
+        files: iterable of filenames or a glob pattern, e.g. "output/state-*.dtk"
+        fn: called with each filename, must be picklable
+        workers: number of worker processes, None or 1 processes the files one after another in this process
+        max_tasks_per_child: files processed by a worker process before it is replaced, None keeps the worker
+            processes for the whole batch (faster start up, but memory is not returned between files). Before
+            Python 3.11 each group of this many files runs in a new single process pool.
+        memory_limit: maximum address space of each worker process in bytes where the resource module is
+            available, a file which needs more fails with a MemoryError rather than exhausting the machine
+
+    Returns:
+        generator of BatchResult, in the order the files are finished when using worker processes
+    """
+    if isinstance(files, str):
+        files = sorted(glob.glob(files))
+    else:
+        files = list(files)
+
+    if workers is None or workers <= 1:
+        for filename in files:
+            yield __run__(fn, filename)
+        return
+
+    options = {}
+    if memory_limit is not None:
+        options.update(initializer=__limit_memory__, initargs=(memory_limit,))
+    if max_tasks_per_child is not None:
+        if sys.version_info < (3, 11):
+            yield from __map_recycled__(files, fn, workers, max_tasks_per_child, options)
+            return
+        options.update(max_tasks_per_child=max_tasks_per_child)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, **options) as executor:
+        futures = {executor.submit(__run__, fn, filename): filename for filename in files}
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                yield __result__(future, futures[future])
+        finally:
+            # Do not start the remaining files if the caller stops early.
+            for future in futures:
+                future.cancel()
+    return
+
+
+def __map_recycled__(files, fn, workers, max_tasks_per_child, options):
+    # ProcessPoolExecutor only accepts max_tasks_per_child from Python 3.11, run each group of files in a
+    # new single process pool instead, with up to workers pools at a time.
+    groups = collections.deque(files[start:start + max_tasks_per_child]
+                               for start in range(0, len(files), max_tasks_per_child))
+    executors = {}  # executor -> number of its files which are not done yet
+    futures = {}    # future -> (executor, filename)
+    try:
+        while groups or futures:
+            while groups and len(executors) < workers:
+                group = groups.popleft()
+                executor = concurrent.futures.ProcessPoolExecutor(max_workers=1, **options)
+                executors[executor] = len(group)
+                for filename in group:
+                    futures[executor.submit(__run__, fn, filename)] = (executor, filename)
+            done, _ = concurrent.futures.wait(futures, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                executor, filename = futures.pop(future)
+                executors[executor] -= 1
+                if executors[executor] == 0:
+                    del executors[executor]
+                    executor.shutdown()
+                yield __result__(future, filename)
+    finally:
+        # Do not start the remaining files if the caller stops early.
+        for future in futures:
+            future.cancel()
+        for executor in executors:
+            executor.shutdown()
+    return
+
+
+def __result__(future, filename):
+    try:
+        return future.result()
+    except Exception as exception:
+        # The worker process itself failed, e.g. it was killed by the operating system.
+        return BatchResult(filename, None, repr(exception), None, None)
+
+
+def __run__(fn, filename):
+    start = time.perf_counter()
+    try:
+        result = fn(filename)
+        error = None
+    except Exception:
+        # Exceptions are not necessarily picklable, send the traceback as text.
+        result = None
+        error = traceback.format_exc()
+    seconds = time.perf_counter() - start
+    return BatchResult(filename, result, error, seconds, __peak_rss__())
+
+
+def __peak_rss__():
+    if resource is None:
+        return None
+    # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+    scale = 1 if sys.platform == "darwin" else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def __limit_memory__(limit):
+    if resource is not None:
+        _, hard = resource.getrlimit(resource.RLIMIT_AS)
+        resource.setrlimit(resource.RLIMIT_AS, (limit if hard == resource.RLIM_INFINITY else min(limit, hard), hard))
+    return
@@ -0,0 +1,219 @@
+#!/usr/bin/python
+
+"""
+Structural comparison of two serialized population files.
+
+Headers are compared entry by entry. Node chunks are compared by their bytes first, only chunks which
+differ are decompressed, parsed, and compared key path by key path. Individuals are matched by their
+suid so reordered, added, or removed individuals are reported as such rather than as changed fields.
+
+Key paths use the same dotted notation as SerializedPopulation.to_table(), e.g. "susceptibility.age",
+with "[]" for the elements of a list, e.g. "infections[].duration".
+
+Example:
+    import emod_api.serialization.dtkFileDiff as dtkdiff
+    result = dtkdiff.diff("state-00100.dtk", "state-00100-modified.dtk", workers=8)
+    print(result)
+    print(result.individual_fields["m_age"], "individuals with a different age")
+"""
+
+import collections
+import collections.abc
+import concurrent.futures
+import itertools
+import emod_api.serialization.dtkFileTools as dft
+
+# Header entries which differ whenever any chunk differs or the file is rewritten, or which are optional like
+# the chunk checksums, the contents of the chunks are compared instead. The compression engine of all file
+# versions is compared as the 'engine' entry, 'compressed' and 'compression' follow from it.
+IGNORED_HEADER_KEYS = ('date', 'chunksizes', 'chunkchecksums', 'bytecount', 'compressed', 'compression')
+
+IDENTICAL = 'identical'
+DIFFERENT = 'different'
+ADDED = 'added'
+REMOVED = 'removed'
+
+
+class DtkDiff(object):
+    """
+    Differences between two serialized population files.
+
+    Attributes:
+        first, second: the compared filenames
+        header: header entry -> (first value, second value) for entries which differ
+        simulation: sorted key paths of the simulation object which differ
+        nodes: IDENTICAL, DIFFERENT, ADDED (only in second), or REMOVED (only in first) for each node
+        node_fields: Counter of key path -> number of nodes in which it differs (excluding individuals)
+        individual_fields: Counter of key path -> number of individuals in which it differs
+        individuals_changed, individuals_added, individuals_removed: individual counts, matched by suid
+    """
+
+    def __init__(self, first, second):
+        self.first = first
+        self.second = second
+        self.header = {}
+        self.simulation = []
+        self.nodes = []
+        self.node_fields = collections.Counter()
+        self.individual_fields = collections.Counter()
+        self.individuals_changed = 0
+        self.individuals_added = 0
+        self.individuals_removed = 0
+        return
+
+    @property
+    def identical(self):
+        return not self.header and not self.simulation and all(status == IDENTICAL for status in self.nodes)
+
+    def __str__(self):
+        lines = ["Comparing '{0}' and '{1}'".format(self.first, self.second)]
+        lines.append("Header: {0} entries differ".format(len(self.header)))
+        for key in sorted(self.header):
+            lines.append("    {0}: {1} != {2}".format(key, *self.header[key]))
+        lines.append("Simulation: {0} fields differ".format(len(self.simulation)))
+        for path in self.simulation:
+            lines.append("    {0}".format(path))
+        statuses = collections.Counter(self.nodes)
+        lines.append("Nodes: {0} identical, {1} different, {2} added, {3} removed".format(
+            statuses[IDENTICAL], statuses[DIFFERENT], statuses[ADDED], statuses[REMOVED]))
+        for path, count in sorted(self.node_fields.items()):
+            lines.append("    {0}: {1} nodes".format(path, count))
+        lines.append("Individuals: {0} changed, {1} added, {2} removed".format(
+            self.individuals_changed, self.individuals_added, self.individuals_removed))
+        for path, count in sorted(self.individual_fields.items()):
+            lines.append("    {0}: {1} individuals".format(path, count))
+        return "\n".join(lines)
+
+
+def diff(first, second, workers=None):
+    """
+    Compare two serialized population files.
+
+    Args:
+        first: filename of the first .dtk file
+        second: filename of the second .dtk file
+        workers: number of worker processes used to parse and compare the node chunks which differ,
+            None or 1 compares them one after another in this process
+
+    Returns:
+        DtkDiff with the differences
+    """
+    first_file = dft.read(first, lazy=True)
+    second_file = dft.read(second, lazy=True)
+    result = DtkDiff(first, second)
+
+    keys = (set(first_file.header.keys()) | set(second_file.header.keys())) - set(IGNORED_HEADER_KEYS)
+    for key in keys:
+        if first_file.header.get(key) != second_file.header.get(key):
+            result.header[key] = (first_file.header.get(key), second_file.header.get(key))
+
+    paths = set()
+    __compare__(__simulation__(first_file), __simulation__(second_file), '', paths)
+    result.simulation = sorted(paths)
+
+    first_count = len(first_file.nodes)
+    second_count = len(second_file.nodes)
+    common = min(first_count, second_count)
+    result.nodes = [IDENTICAL] * common + [REMOVED] * (first_count - common) + [ADDED] * (second_count - common)
+
+    # Identical chunks need not be parsed, this is cheap even for large files.
+    pending = [index for index in range(common) if not __same_chunk__(first_file, second_file, index + 1)]
+
+    if workers is not None and workers > 1 and len(pending) > 1 and 1 not in (first_file.version, second_file.version):
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            summaries = list(executor.map(
+                __compare_chunks__,
+                [dft.__chunk_source__(first_file.chunks, index + 1) for index in pending],
+                itertools.repeat(first_file.compression), itertools.repeat(first_file.version),
+                [dft.__chunk_source__(second_file.chunks, index + 1) for index in pending],
+                itertools.repeat(second_file.compression), itertools.repeat(second_file.version),
+                [index + 1 for index in pending]))
+    else:
+        summaries = (__compare_nodes__(first_file.nodes[index], second_file.nodes[index]) for index in pending)
+
+    for index, summary in zip(pending, summaries):
+        node_paths, individual_fields, changed, added, removed = summary
+        if node_paths or changed or added or removed:
+            result.nodes[index] = DIFFERENT
+        result.node_fields.update(node_paths)
+        result.individual_fields.update(individual_fields)
+        result.individuals_changed += changed
+        result.individuals_added += added
+        result.individuals_removed += removed
+
+    return result
+
+
+def __simulation__(dtk_file):
+    # Version 1 keeps the nodes in the simulation, they are compared separately.
+    simulation = dict(dtk_file.simulation)
+    simulation.pop('nodes', None)
+    return simulation
+
+
+def __same_chunk__(first_file, second_file, index):
+    if 1 in (first_file.version, second_file.version):
+        return False
+    # Version 2 wraps each node as {'suid':..., 'node':...}, the chunks of other versions cannot match.
+    if (first_file.version == 2) != (second_file.version == 2):
+        return False
+    first_chunk = first_file.chunks[index]
+    second_chunk = second_file.chunks[index]
+    if first_file.compression == second_file.compression and first_chunk == second_chunk:
+        return True
+    return dft.uncompress(first_chunk, first_file.compression) == dft.uncompress(second_chunk, second_file.compression)
+
+
+def __compare_chunks__(first_source, first_engine, first_version, second_source, second_engine, second_version,
+                       index):
+    first_node = dft.__decode_chunk__(first_source, first_engine, index)
+    second_node = dft.__decode_chunk__(second_source, second_engine, index)
+    return __compare_nodes__(first_node.node if first_version == 2 else first_node,
+                             second_node.node if second_version == 2 else second_node)
+
+
+def __compare_nodes__(first, second):
+    """Returns (node key paths, Counter of individual key paths, changed, added, removed individual counts)."""
+    node_paths = set()
+    for key in set(first.keys()) | set(second.keys()):
+        if key == 'individualHumans':
+            continue
+        if key not in first or key not in second:
+            node_paths.add(key)
+        else:
+            __compare__(first[key], second[key], key, node_paths)
+
+    individual_fields = collections.Counter()
+    first_individuals = {individual['suid']['id']: individual for individual in first.get('individualHumans', [])}
+    second_individuals = {individual['suid']['id']: individual for individual in second.get('individualHumans', [])}
+    changed = 0
+    for suid, individual in first_individuals.items():
+        other = second_individuals.get(suid)
+        if other is not None and individual != other:
+            paths = set()
+            __compare__(individual, other, '', paths)
+            individual_fields.update(paths)
+            changed += 1
+    added = len(second_individuals.keys() - first_individuals.keys())
+    removed = len(first_individuals.keys() - second_individuals.keys())
+
+    return node_paths, individual_fields, changed, added, removed
+
+
+def __compare__(first, second, path, paths):
+    # Equality of built in containers is checked in C, identical sub-trees are skipped quickly.
+    if first == second:
+        return
+    if isinstance(first, collections.abc.Mapping) and isinstance(second, collections.abc.Mapping):
+        for key in set(first.keys()) | set(second.keys()):
+            child = '.'.join([path, key]) if path else key
+            if key not in first or key not in second:
+                paths.add(child)
+            else:
+                __compare__(first[key], second[key], child, paths)
+    elif isinstance(first, list) and isinstance(second, list) and len(first) == len(second):
+        for first_item, second_item in zip(first, second):
+            __compare__(first_item, second_item, path + '[]', paths)
+    else:
+        paths.add(path)
+    return
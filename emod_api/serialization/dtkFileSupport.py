@@ -1,6 +1,11 @@
 #!/usr/bin/python
 
+import codecs
+import collections.abc
+import json
 import lz4.block
+import re
+import sys
 
 try:
     import snappy
@@ -8,12 +13,18 @@ try:
 except:
     SNAPPY_SUPPORT = False
 
+try:
+    import zstandard
+    ZSTD_SUPPORT = True
+except:
+    ZSTD_SUPPORT = False
+
 
 # noinspection PyCamelCase
 class Uncompressed(object):
 
     @classmethod
-    def compress(cls, data):
+    def compress(cls, data, level=None):
         return data
 
     @classmethod
@@ -24,8 +35,12 @@ class Uncompressed(object):
 class EllZeeFour(object):
 
     @classmethod
-    def compress(cls, data):
-        return lz4.block.compress(data if type(data) is bytes else data.encode())
+    def compress(cls, data, level=None):
+        # Levels select the high compression mode (1-16), the blocks are still readable by EMOD.
+        data = data.encode() if isinstance(data, str) else data
+        if level is None:
+            return lz4.block.compress(data)
+        return lz4.block.compress(data, mode='high_compression', compression=level)
 
     @classmethod
     def uncompress(cls, data):
@@ -35,7 +50,7 @@ class EllZeeFour(object):
 class Snappy(object):
 
     @classmethod
-    def compress(cls, data):
+    def compress(cls, data, level=None):
         if SNAPPY_SUPPORT:
             return snappy.compress(data)
         raise UserWarning("Snappy [de]compression not available.")
@@ -47,6 +62,22 @@ class Snappy(object):
         raise UserWarning("Snappy [de]compression not available.")
 
 
+class Zstandard(object):
+
+    # Compressor objects are not thread safe, a new one is created for each chunk.
+    @classmethod
+    def compress(cls, data, level=None):
+        if ZSTD_SUPPORT:
+            return zstandard.ZstdCompressor(level=3 if level is None else level).compress(data)
+        raise UserWarning("Zstandard [de]compression not available.")
+
+    @classmethod
+    def uncompress(cls, data):
+        if ZSTD_SUPPORT:
+            return zstandard.ZstdDecompressor().decompress(data)
+        raise UserWarning("Zstandard [de]compression not available.")
+
+
 class SerialObject(dict):
     # noinspection PyDefaultArgument
     def __init__(self, dictionary={}):
@@ -54,9 +85,257 @@ class SerialObject(dict):
         self.__dict__ = self
         return
 
+    def __reduce__(self):
+        # __dict__ is the dictionary itself, so copy and pickle the contents rather than the attributes.
+        return self.__class__, (dict(self),)
+
 
 class NullPtr(SerialObject):
     def __init__(self):
         nullptr = {'__class__': 'nullptr'}
         super(NullPtr, self).__init__(nullptr)
 
+    def __reduce__(self):
+        return self.__class__, ()
+
+
+class _Shape(object):
+    """Ordered keys of CompactObjects and the position of each key, shared by all objects with the same keys."""
+
+    __slots__ = ('keys', 'index')
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.index = {key: position for position, key in enumerate(keys)}
+        return
+
+
+# Maximum number of shapes registered at a time. When the registry is full it is cleared, existing objects
+# keep their shapes and new objects register them again, so arbitrary keys cannot grow it without limit.
+MAX_SHAPES = 65536
+
+__shapes__ = {}
+
+
+def __shape__(keys):
+    shape = __shapes__.get(keys)
+    if shape is None:
+        if len(__shapes__) >= MAX_SHAPES:
+            __shapes__.clear()
+        shape = __shapes__[keys] = _Shape(tuple(sys.intern(key) for key in keys))
+    return shape
+
+
+class CompactObject(collections.abc.MutableMapping):
+    """
+    Memory efficient alternative to SerialObject for decoding large populations. The keys are held once
+    per distinct set of keys (e.g. once for all individuals) and each object only holds a tuple of its
+    values. Entries can be accessed as items or attributes and keep their order, so encoding with
+    json_default() gives the same JSON as the SerialObject.
+    """
+
+    __slots__ = ('_shape', '_values')
+
+    def __init__(self, pairs=()):
+        # Accepts a mapping or a list of (key, value) pairs, i.e. works as object_hook and object_pairs_hook.
+        if isinstance(pairs, collections.abc.Mapping):
+            pairs = pairs.items()
+        keys, values = tuple(zip(*pairs)) or ((), ())
+        shape = __shapes__.get(keys) or __shape__(keys)
+        if len(shape.index) != len(keys):
+            # The last value of a duplicated key wins, as in a dict.
+            unique = dict(zip(keys, values))
+            shape, values = __shape__(tuple(unique.keys())), tuple(unique.values())
+        _set_shape(self, shape)
+        _set_values(self, values)
+        return
+
+    def __getitem__(self, key):
+        return self._values[self._shape.index[key]]
+
+    def __setitem__(self, key, value):
+        position = self._shape.index.get(key)
+        if position is None:
+            _set_shape(self, __shape__(self._shape.keys + (key,)))
+            _set_values(self, self._values + (value,))
+        else:
+            values = self._values
+            _set_values(self, values[:position] + (value,) + values[position + 1:])
+        return
+
+    def __delitem__(self, key):
+        position = self._shape.index[key]
+        keys = self._shape.keys
+        values = self._values
+        _set_shape(self, __shape__(keys[:position] + keys[position + 1:]))
+        _set_values(self, values[:position] + values[position + 1:])
+        return
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+        return
+
+    def __delattr__(self, name):
+        try:
+            del self[name]
+        except KeyError:
+            raise AttributeError(name)
+        return
+
+    def __iter__(self):
+        return iter(self._shape.keys)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __contains__(self, key):
+        return key in self._shape.index
+
+    def get(self, key, default=None):
+        position = self._shape.index.get(key)
+        return default if position is None else self._values[position]
+
+    def to_dict(self):
+        return dict(zip(self._shape.keys, self._values))
+
+    def __reduce__(self):
+        return self.__class__, (list(zip(self._shape.keys, self._values)),)
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+# The values are immutable tuples which are replaced when an entry changes, __setattr__ is taken by the entries.
+_set_shape = CompactObject._shape.__set__
+_set_values = CompactObject._values.__set__
+
+
+def json_default(item):
+    """default hook for json.dumps() which encodes CompactObjects as JSON objects."""
+    if isinstance(item, CompactObject):
+        return item.to_dict()
+    raise TypeError("Object of type {0} is not JSON serializable".format(type(item).__name__))
+
+
+class JsonStream(object):
+    """
+    Incremental reader for UTF-8 JSON text in a bytes-like object. Only a window of the text is decoded
+    to a string at a time and values are parsed one at a time, so the whole document never exists as a
+    single string or object tree.
+    """
+
+    __whitespace__ = re.compile(r'[ \t\n\r]*')
+
+    def __init__(self, data, object_hook=SerialObject, block_size=1 << 20):
+        self._data = memoryview(data).cast('B')
+        self._decoder = codecs.getincrementaldecoder('utf-8')()
+        self._json = json.JSONDecoder(object_hook=object_hook)
+        self._block_size = block_size
+        self._consumed = 0
+        self._text = ''
+        self._index = 0
+        return
+
+    def _more(self, size):
+        """Decode at least size more bytes into the window, dropping the text already parsed."""
+        if self._consumed >= len(self._data):
+            return False
+        block = self._data[self._consumed:self._consumed + size]
+        self._consumed += len(block)
+        self._text = self._text[self._index:] + self._decoder.decode(block, self._consumed >= len(self._data))
+        self._index = 0
+        return True
+
+    def peek(self):
+        """Return the next non-whitespace character without consuming it, '' at the end of the data."""
+        while True:
+            self._index = self.__whitespace__.match(self._text, self._index).end()
+            if self._index < len(self._text):
+                return self._text[self._index]
+            if not self._more(self._block_size):
+                return ''
+
+    def expect(self, characters):
+        """Consume the next non-whitespace character, which must be one of characters, and return it."""
+        character = self.peek()
+        if not character or character not in characters:
+            raise ValueError("Expected one of '{0}' but found '{1}'".format(characters, character))
+        self._index += 1
+        return character
+
+    def value(self):
+        """Parse and return the next JSON value."""
+        self.peek()
+        size = self._block_size
+        while True:
+            try:
+                item, end = self._json.raw_decode(self._text, self._index)
+                # A number (or a value ending exactly at the end of the window) may continue in the next block.
+                if end < len(self._text) or not self._more(size):
+                    self._index = end
+                    return item
+            except json.JSONDecodeError:
+                if not self._more(size):
+                    raise
+            # Grow the window geometrically so large values are not re-parsed too often.
+            size *= 2
+
+    def members(self):
+        """Iterate over the keys of the next JSON object, the value of each key must be consumed by the caller."""
+        self.expect('{')
+        if self.peek() == '}':
+            self._index += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            if self.expect(',}') == '}':
+                return
+
+    def elements(self):
+        """Iterate over the elements of the next JSON array."""
+        self.expect('[')
+        if self.peek() == ']':
+            self._index += 1
+            return
+        while True:
+            yield self.value()
+            if self.expect(',]') == ']':
+                return
+
+
+def iter_json_array(data, path, object_hook=SerialObject, block_size=1 << 20):
+    """
+    Yield the elements of an array in UTF-8 JSON text one at a time.
+
+    Args:
+        data: bytes-like object with the JSON text, e.g. a decompressed node chunk
+        path: keys leading from the root object to the array, e.g. ['individualHumans']
+        object_hook: called with each decoded JSON object, as in json.loads()
+        block_size: number of bytes decoded to text at a time
+
+    Returns:
+        generator of the array elements, empty if the path does not exist
+    """
+    stream = JsonStream(data, object_hook, block_size)
+    return __iter_path__(stream, list(path))
+
+
+def __iter_path__(stream, path):
+    for key in stream.members():
+        if key != path[0]:
+            stream.value()
+        elif len(path) == 1:
+            yield from stream.elements()
+            return
+        else:
+            yield from __iter_path__(stream, path[1:])
+            return
+    return
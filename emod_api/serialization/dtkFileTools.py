@@ -8,19 +8,44 @@ Support for three formats of serialized population files:
 4. "Metadata update": compressed: true|false + engine: NONE|LZ4|SNAPPY replaced with compression: NONE|LZ4|SNAPPY
 """
 
+import collections
+import concurrent.futures
 import copy
 import emod_api.serialization.dtkFileSupport as support
+import itertools
 import json
+import mmap
 import os
+import shutil
 import time
+import zlib
 
 IDTK = 'IDTK'
 NONE = 'NONE'
 LZ4 = 'LZ4'
 SNAPPY = 'SNAPPY'
+ZSTD = 'ZSTD'
 MAX_VERSION = 5
 
-__engines__ = {LZ4: support.EllZeeFour, SNAPPY: support.Snappy, NONE: support.Uncompressed}
+__engines__ = {LZ4: support.EllZeeFour, SNAPPY: support.Snappy, NONE: support.Uncompressed,
+               ZSTD: support.Zstandard}
+
+
+def register_engine(name, engine):
+    """
+    Add (or replace) a compression engine.
+
+    Args:
+        name: engine name as written to the file header, stored upper case
+        engine: object with compress(data, level=None) and uncompress(data) returning bytes
+
+    Note that EMOD itself only reads NONE, LZ4, and SNAPPY files, other engines are for files
+    which are only read by Python tools, e.g. archival copies.
+    """
+    if not (callable(getattr(engine, 'compress', None)) and callable(getattr(engine, 'uncompress', None))):
+        raise UserWarning("Compression engine '{0}' must have compress() and uncompress() methods".format(name))
+    __engines__[name.upper()] = engine
+    return
 
 
 def uncompress(data, engine):
@@ -30,13 +55,156 @@ def uncompress(data, engine):
         raise RuntimeError("Unknown/unsupported compression scheme '{0}'".format(engine))
 
 
-def compress(data, engine):
+def compress(data, engine, level=None):
     if engine in __engines__:
-        return __engines__[engine].compress(data)
+        if level is None:
+            return __engines__[engine].compress(data)
+        return __engines__[engine].compress(data, level=level)
     else:
         raise RuntimeError("Unknown/unsupported compression scheme '{0}'".format(engine))
 
 
+def checksum(data):
+    """CRC-32 of a (compressed) chunk as stored in the chunkchecksums header entry."""
+    return zlib.crc32(data)
+
+
+def recompress(data, source, target, level=None):
+    """Convert a chunk compressed with the source engine to the target engine without decoding its contents."""
+    if isinstance(data, str):
+        data = data.encode()
+    if source != target or level is not None:
+        data = compress(uncompress(data, source), target, level)
+    # Chunks from a memory mapped file are views into the mapping, always return a copy.
+    return bytes(data)
+
+
+class LazyChunks(object):
+    """
+    List-like collection of chunks for a file opened in lazy mode. The byte offset of each chunk
+    is recorded when the file is opened and the chunk is only read from disk when it is accessed.
+    Chunks which are assigned or appended are held in memory. If checksums are given each chunk
+    is verified when it is read from disk.
+    """
+
+    def __init__(self, filename, offsets, sizes, checksums=None):
+        self._filename = filename
+        self._offsets = list(offsets)
+        self._sizes = list(sizes)
+        self._checksums = list(checksums) if checksums is not None else None
+        self._loaded = {}
+        return
+
+    def __iter__(self):
+        index = 0
+        while index < len(self):
+            yield self.__getitem__(index)
+            index += 1
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.__getitem__(i) for i in range(*index.indices(len(self)))]
+        index = self.__check_index__(index)
+        if index in self._loaded:
+            return self._loaded[index]
+        chunk = self._read(index)
+        if self._checksums is not None:
+            __verify_checksum__(chunk, self._checksums[index], index, self._filename)
+        return chunk
+
+    def __setitem__(self, index, value):
+        index = self.__check_index__(index)
+        self._loaded[index] = value
+        self._sizes[index] = len(value)
+        return
+
+    def append(self, item):
+        self._loaded[len(self)] = item
+        self._offsets.append(None)
+        self._sizes.append(len(item))
+        if self._checksums is not None:
+            self._checksums.append(None)
+        return
+
+    def __len__(self):
+        length = len(self._offsets)
+        return length
+
+    @property
+    def filename(self):
+        return self._filename
+
+    @property
+    def sizes(self):
+        return list(self._sizes)
+
+    def offset(self, index):
+        """Byte offset of the chunk in the file or None if the chunk only exists in memory."""
+        index = self.__check_index__(index)
+        return None if index in self._loaded else self._offsets[index]
+
+    def checksum(self, index):
+        """Checksum of the chunk from the file header or None if not known or the chunk only exists in memory."""
+        index = self.__check_index__(index)
+        return None if index in self._loaded or self._checksums is None else self._checksums[index]
+
+    def close(self):
+        """Release any resources held for the file. The file is only opened while a chunk is read."""
+        return
+
+    def _read(self, index):
+        with open(self._filename, 'rb') as handle:
+            handle.seek(self._offsets[index])
+            chunk = handle.read(self._sizes[index])
+        if len(chunk) != self._sizes[index]:
+            raise UserWarning("Only read {0} bytes of {1} for chunk {2} of file '{3}'".format(
+                len(chunk), self._sizes[index], index, self._filename))
+        return chunk
+
+    def __check_index__(self, index):
+        length = len(self)
+        if index < 0:
+            index += length
+        if index < 0 or index >= length:
+            raise IndexError("chunk index out of range")
+        return index
+
+
+class MappedChunks(LazyChunks):
+    """
+    Lazy collection of chunks backed by a read-only memory map of the file. Accessing a chunk returns
+    a memoryview slice into the mapping rather than a copy which is passed as is to the decompression
+    engine. Once the map is closed, chunks are read from the file again.
+    """
+
+    def __init__(self, filename, offsets, sizes, mapping, checksums=None):
+        super(MappedChunks, self).__init__(filename, offsets, sizes, checksums)
+        self._mapping = mapping
+        self._view = memoryview(mapping)
+        return
+
+    def close(self):
+        """Close the memory map, e.g. so the file can be replaced or deleted on Windows."""
+        if self._mapping is not None:
+            self._view.release()
+            try:
+                self._mapping.close()
+            except BufferError:
+                self._view = memoryview(self._mapping)
+                raise UserWarning("Cannot close the memory map of '{0}' while chunks of it are still in use".format(
+                    self._filename))
+            self._mapping = None
+            self._view = None
+        return
+
+    def _read(self, index):
+        if self._mapping is None:
+            return super(MappedChunks, self)._read(index)
+        offset = self._offsets[index]
+        chunk = self._view[offset:offset + self._sizes[index]]
+        return chunk
+
+
 class DtkHeader(support.SerialObject):
     # noinspection PyDefaultArgument
     def __init__(self, dictionary=None):
@@ -81,58 +249,160 @@ class DtkFile(object):
             return data
 
         def __setitem__(self, index, value):
-            data = compress(value.encode(), self.__parent__.compression)
-            self.__parent__.chunks[index] = data
+            data = compress(value.encode(), self.__parent__.compression, self.__parent__.compression_level)
+            # New contents replace any decoded (and possibly modified) object for this chunk.
+            self.__parent__.objects.invalidate(index, flush=False)
+            self.__parent__._chunks[index] = data
             return
 
         def append(self, item):
-            data = compress(item, self.__parent__.compression)
+            data = compress(item, self.__parent__.compression, self.__parent__.compression_level)
             self.__parent__.chunks.append(data)
 
         def __len__(self):
-            length = len(self.__parent__.chunks)
+            length = len(self.__parent__._chunks)
             return length
 
     class Objects(object):
+        """
+        Decoded objects of the chunks. By default each access decompresses and parses the chunk and
+        returns a new object, changes made to it only take effect when it is assigned back. Assigning an
+        object marks the chunk as dirty, the object is kept and only serialized and compressed when the
+        chunks are next needed, e.g. by write(), so unchanged chunks are never encoded again. Until then
+        accesses return the assigned object.
+
+        Set cache_size to keep up to that many recently accessed objects for repeated random access.
+        Cached objects are shared by later accesses, changes made to them in place are seen by later
+        accesses but are only written if the object is assigned back. Iterating does not fill the cache.
+        """
         def __init__(self, parent):
             self.__parent__ = parent
+            self.cache_size = 0
+            self._cache = collections.OrderedDict()     # least recently used first
+            self._dirty = {}
             return
 
         def __iter__(self):
             index = 0
             while index < len(self):
-                yield self.__getitem__(index)
+                yield self.__load__(index)
                 index += 1
 
         def __getitem__(self, index):
-            try:
-                contents = self.__parent__.contents[index]
-                item = json.loads(contents, object_hook=support.SerialObject)
-            except:
-                raise UserWarning("Could not parse JSON in chunk {0}".format(index))
+            index = self.__check_index__(index)
+            if index in self._cache:
+                self._cache.move_to_end(index)
+                return self._cache[index]
+            item = self.__load__(index)
+            if self.cache_size > 0 and index not in self._dirty:
+                self._cache[index] = item
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
             return item
 
         def __setitem__(self, index, value):
-            contents = json.dumps(value, separators=(',', ':'))
-            self.__parent__.contents[index] = contents
+            index = self.__check_index__(index)
+            self._cache.pop(index, None)
+            self._dirty[index] = value
             return
 
         def append(self, item):
-            contents = json.dumps(item, separators=(',', ':'))
+            contents = __encode__(item)
             self.__parent__.contents.append(contents)
             return
 
         def __len__(self):
-            length = len(self.__parent__.chunks)
+            length = len(self.__parent__._chunks)
             return length
 
+        @property
+        def dirty(self):
+            """Indices of the chunks with assigned objects which have not been serialized yet."""
+            return sorted(self._dirty)
+
+        def flush(self):
+            """Serialize and compress the objects of all dirty chunks."""
+            compression = self.__parent__.compression
+            level = self.__parent__.compression_level
+            for index in sorted(self._dirty):
+                contents = __encode__(self._dirty[index])
+                self.__parent__._chunks[index] = compress(contents.encode(), compression, level)
+            self._dirty.clear()
+            return
+
+        def invalidate(self, index=None, flush=True):
+            """
+            Drop cached and assigned objects, e.g. to release memory or after replacing raw chunks.
+
+            Args:
+                index: chunk index, None for all chunks
+                flush: if True assigned objects are serialized before they are dropped, otherwise their
+                    changes are discarded
+            """
+            if flush:
+                self.flush()
+            if index is None:
+                self._cache.clear()
+                self._dirty.clear()
+            else:
+                index = self.__check_index__(index)
+                self._cache.pop(index, None)
+                self._dirty.pop(index, None)
+            return
+
+        def __detached__(self, index):
+            """Like objects[index], using the cache if enabled, but the result is never shared, i.e. a copy."""
+            item = self.__getitem__(index)
+            index = self.__check_index__(index)
+            if index in self._cache or index in self._dirty:
+                item = copy.deepcopy(item)
+            return item
+
+        def __load__(self, index):
+            """The assigned or cached object of a chunk, otherwise decode the chunk without caching it."""
+            index = self.__check_index__(index)
+            item = self._dirty.get(index, self._cache.get(index))
+            if item is not None:
+                return item
+            try:
+                # The chunk is not dirty, so the raw chunk is current without serializing assigned objects.
+                chunk = self.__parent__._chunks[index]
+                contents = str(uncompress(chunk, self.__parent__.compression), 'utf-8')
+                item = __decode__(contents, self.__parent__.compact)
+            except:
+                raise UserWarning("Could not parse JSON in chunk {0}".format(index))
+            return item
+
+        def __check_index__(self, index):
+            if index < 0:
+                index += len(self)
+            return index
+
     def __init__(self, header):
         self.__header__ = header
         self._chunks = [None for index in range(header.chunkcount)]
+        self._level = None
+        self._compact = False
         self.contents = self.Contents(self)
         self.objects = self.Objects(self)
         return
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def close(self):
+        """
+        Close the memory map of a file read with memory_map=True, later accesses read the chunks from disk.
+        Files read in lazy mode do not keep the file open and files read completely hold no resources.
+        """
+        if isinstance(self._chunks, LazyChunks):
+            self._chunks.close()
+        return
+
     @property
     def header(self):
         return self.__header__
@@ -155,7 +425,26 @@ class DtkFile(object):
 
     @compression.setter
     def compression(self, engine):
-        self.__set_compression__(engine.upper())
+        self.__set_compression__(engine.upper(), level=self.compression_level)
+
+    @property
+    def compression_level(self):
+        """Level used when compressing chunks, None for the engine's default. Not stored in the file."""
+        return self._level
+
+    def set_compression(self, engine, workers=None, level=None):
+        """
+        Convert all chunks to the given compression engine and level. Chunks are converted concurrently
+        in a thread pool, the compression libraries release the GIL while they work.
+
+        Args:
+            engine: NONE, LZ4, SNAPPY, ZSTD, or a registered engine
+            workers: maximum number of threads, None for the ThreadPoolExecutor default
+            level: engine specific level, e.g. 1-16 selects LZ4 high compression mode and 1-22 for ZSTD,
+                None for the engine's default (fast) mode
+        """
+        self.__set_compression__(engine.upper(), workers, level)
+        return
 
     @property
     def byte_count(self):
@@ -164,14 +453,47 @@ class DtkFile(object):
 
     @property
     def chunk_count(self):
-        length = len(self.chunks)
+        # The number of chunks does not depend on assigned objects, no need to serialize them.
+        length = len(self._chunks)
         return length
 
     @property
     def chunk_sizes(self):
+        if isinstance(self.chunks, LazyChunks):
+            return self.chunks.sizes
         sizes = [len(chunk) for chunk in self.chunks]
         return sizes
 
+    def chunk_checksums(self, workers=None):
+        """
+        Checksums of all chunks, see checksum(). Chunks of a lazily read file which are unchanged reuse
+        the checksums from the file header, the others are computed in a thread pool.
+
+        Args:
+            workers: maximum number of threads, None for the ThreadPoolExecutor default
+        """
+        chunks = self.chunks
+        known = [chunks.checksum(index) if isinstance(chunks, LazyChunks) else None for index in range(len(chunks))]
+        missing = [index for index, value in enumerate(known) if value is None]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            for index, value in zip(missing, executor.map(lambda index: checksum(chunks[index]), missing)):
+                known[index] = value
+        return known
+
+    @property
+    def compact(self):
+        """If True objects are decoded as support.CompactObject rather than support.SerialObject."""
+        return self._compact
+
+    @compact.setter
+    def compact(self, value):
+        self._compact = bool(value)
+
+    @property
+    def lazy(self):
+        is_lazy = isinstance(self.chunks, LazyChunks)
+        return is_lazy
+
     # Optional header entries
     @property
     def author(self):
@@ -205,28 +527,112 @@ class DtkFile(object):
 
     @property
     def chunks(self):
+        # Serialize any assigned objects first so the raw chunks are current.
+        self.objects.flush()
         return self._chunks
 
     @property
     def nodes(self):
         return self._nodes
 
-    def _sync_header(self):
+    def iter_individuals(self, node_index):
+        """
+        Yield the individuals (individualHumans) of a node one at a time without decoding the whole node.
+
+        The node chunk is decompressed, but only a window of its text is decoded and parsed at a time, so
+        scanning or filtering the individuals of a very large node needs memory for the compressed and
+        decompressed chunk but not for the text or objects of all individuals.
+
+        Args:
+            node_index: index of the node, as for dtk.nodes[node_index]
+
+        Returns:
+            generator of individual objects
+        """
+        if self.version == 1:
+            yield from self.nodes[node_index].individualHumans
+            return
+        index = node_index + 1 if node_index >= 0 else node_index + self.chunk_count
+        if index < 1 or index >= self.chunk_count:
+            raise IndexError("node index out of range")
+        # noinspection PyProtectedMember
+        if index in self.objects._dirty or index in self.objects._cache:
+            # Already decoded (and possibly modified), use the object.
+            yield from self.nodes[node_index].individualHumans
+            return
+        # Version 2 looks like this {'suid':{'id':id},'node':{...}}
+        path = ['node', 'individualHumans'] if self.version == 2 else ['individualHumans']
+        data = uncompress(self._chunks[index], self.compression)
+        object_hook = support.CompactObject if self.compact else support.SerialObject
+        yield from support.iter_json_array(data, path, object_hook)
+        return
+
+    def _sync_header(self, checksums=None):
 
         self.__header__.date = time.strftime('%a %b %d %H:%M:%S %Y')
         self.__header__.chunkcount = len(self.chunks)
-        self.__header__.chunksizes = [len(chunk) for chunk in self.chunks]
+        self.__header__.chunksizes = self.chunk_sizes
         self.__header__.bytecount = sum(self.__header__.chunksizes)
+        if checksums is None:
+            checksums = 'chunkchecksums' in self.__header__
+        if checksums:
+            self.__header__.chunkchecksums = self.chunk_checksums()
+        else:
+            self.__header__.pop('chunkchecksums', None)
 
         return
 
-    def __set_compression__(self, engine):
-        if engine != self.compression:
-            for index in range(self.chunk_count):
-                chunk = compress(self.contents[index], engine)
-                self._chunks[index] = chunk
+    def _read_chunks(self, handle, filename, lazy=False, memory_map=False, verify=True):
+        sizes = self.__header__.chunksizes
+        checksums = self.__header__.get('chunkchecksums') if verify else None
+        if checksums is not None and len(checksums) != len(sizes):
+            raise UserWarning("Header of '{0}' has {1} chunk checksums for {2} chunks".format(
+                filename, len(checksums), len(sizes)))
+        if lazy or memory_map:
+            # Record where each chunk starts, but only check that the file is long enough to hold them.
+            offsets = []
+            offset = handle.tell()
+            for size in sizes:
+                offsets.append(offset)
+                offset += size
+            file_size = os.fstat(handle.fileno()).st_size
+            for index, size in enumerate(sizes):
+                if offsets[index] + size > file_size:
+                    raise UserWarning("Only read {0} bytes of {1} for chunk {2} of file '{3}'".format(
+                        max(file_size - offsets[index], 0), size, index, filename))
+            if memory_map:
+                mapping = mmap.mmap(handle.fileno(), 0, access=mmap.ACCESS_READ)
+                self._chunks = MappedChunks(filename, offsets, sizes, mapping, checksums)
+            else:
+                self._chunks = LazyChunks(filename, offsets, sizes, checksums)
+        else:
+            for index, size in enumerate(sizes):
+                self.chunks[index] = handle.read(size)
+                if len(self.chunks[index]) != size:
+                    raise UserWarning("Only read {0} bytes of {1} for chunk {2} of file '{3}'".format(
+                        len(self.chunks[index]), size, index, filename))
+            if checksums is not None:
+                # zlib releases the GIL, so the chunks are checked in parallel.
+                with concurrent.futures.ThreadPoolExecutor() as executor:
+                    list(executor.map(__verify_checksum__, self._chunks, checksums, range(len(sizes)),
+                                      itertools.repeat(filename)))
+        return
+
+    def __set_compression__(self, engine, workers=None, level=None):
+        if engine != self.compression or level != self.compression_level:
+            if engine not in __engines__:
+                raise RuntimeError("Unknown/unsupported compression scheme '{0}'".format(engine))
+            # Dirty chunks are skipped, they are compressed with the new engine when they are flushed.
+            dirty = set(self.objects.dirty)
+            indices = [index for index in range(len(self._chunks)) if index not in dirty]
+            source = self.compression
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                chunks = executor.map(lambda index: recompress(self._chunks[index], source, engine, level), indices)
+                for index, chunk in zip(indices, chunks):
+                    self._chunks[index] = chunk
             self.__header__.engine = engine
             self.__header__['compressed'] = (engine != NONE)
+            self._level = level
         return
 
 
@@ -263,14 +669,18 @@ class DtkFileV2(DtkFile):
             index = 0
             while index < len(self):
                 # Version 2 looks like this {'suid':{'id':id},'node':{...}}, dereference the node here for simplicity.
-                yield self.__getitem__(index)
+                yield self.__parent__.objects.__load__(index+1).node
                 index += 1
 
         def __getitem__(self, index):
+            if index < 0:
+                index += len(self)
             item = self.__parent__.objects[index+1]
             return item.node
 
         def __setitem__(self, index, value):
+            if index < 0:
+                index += len(self)
             # Version 2 actually saves the entry from simulation.nodes (C++) which is a map of suid to node.
             self.__parent__.objects[index+1] = {'suid': {'id': value.suid.id}, 'node': value}
             return
@@ -279,24 +689,21 @@ class DtkFileV2(DtkFile):
             length = self.__parent__.chunk_count - 1
             return length
 
-    def __init__(self, header=None, filename='', handle=None):
+    def __init__(self, header=None, filename='', handle=None, lazy=False, memory_map=False, verify=True):
         if header is None:
             header = DtkHeader()
         header.version = 2
         super(DtkFileV2, self).__init__(header)
-        for index, size in enumerate(header.chunksizes):
-            self.chunks[index] = handle.read(size)
-            if len(self.chunks[index]) != size:
-                raise UserWarning(
-                    "Only read {0} bytes of {1} for chunk {2} of file '{3}'".format(len(self.chunks[index]),
-                                                                                    size, index, filename))
+        if handle is not None:
+            self._read_chunks(handle, filename, lazy, memory_map, verify)
         # Version 2 looks like this: {'simulation':{...}} so we dereference the simulation here for simplicity.
         self._nodes = self.NodesV2(self)
         return
 
     @property
     def simulation(self):
-        sim = self.objects[0]['simulation']
+        # A new object on each access, changes only take effect when it is assigned back.
+        sim = self.objects.__detached__(0)['simulation']
         del sim['nodes']
         return sim
 
@@ -318,14 +725,18 @@ class DtkFileV3(DtkFile):
         def __iter__(self):
             index = 0
             while index < len(self):
-                yield self.__getitem__(index)
+                yield self.__parent__.objects.__load__(index+1)
                 index += 1
 
         def __getitem__(self, index):
+            if index < 0:
+                index += len(self)
             item = self.__parent__.objects[index+1]
             return item
 
         def __setitem__(self, index, value):
+            if index < 0:
+                index += len(self)
             self.__parent__.objects[index+1] = value
             return
 
@@ -333,15 +744,13 @@ class DtkFileV3(DtkFile):
             length = self.__parent__.chunk_count - 1
             return length
 
-    def __init__(self, header=None, filename='', handle=None):
+    def __init__(self, header=None, filename='', handle=None, lazy=False, memory_map=False, verify=True):
         if header is None:
             header = DtkHeader()
         header.version = 3
         super(DtkFileV3, self).__init__(header)
-        for index, size in enumerate(header.chunksizes):
-            self.chunks[index] = handle.read(size)
-            if len(self.chunks[index]) != size:
-                raise UserWarning("Only read {0} bytes of {1} for chunk {2} of file '{3}'".format(len(self.chunks[index]), size, index, filename))
+        if handle is not None:
+            self._read_chunks(handle, filename, lazy, memory_map, verify)
         self._nodes = self.NodesV3(self)
         return
 
@@ -354,7 +763,8 @@ class DtkFileV3(DtkFile):
         # else:
         #     sim = {}
 
-        sim = self.objects[0]
+        # A new object on each access, changes only take effect when it is assigned back.
+        sim = self.objects.__detached__(0)
         del sim['nodes']
         return sim
 
@@ -371,16 +781,16 @@ class DtkFileV3(DtkFile):
 
 class DtkFileV4(DtkFileV3):
 
-    def __init__(self, header=None, filename='', handle=None):
+    def __init__(self, header=None, filename='', handle=None, lazy=False, memory_map=False, verify=True):
         if header is None:
             header = DtkHeader()
-        super(DtkFileV4, self).__init__(header, filename, handle)
+        super(DtkFileV4, self).__init__(header, filename, handle, lazy, memory_map, verify)
         header.version = 4
         return
 
 
 class DtkFileV5(DtkFileV4):
-    def __init__(self, header=None, filename='', handle=None):
+    def __init__(self, header=None, filename='', handle=None, lazy=False, memory_map=False, verify=True):
         if header is None:
             header = DtkHeader()
             version5_params = {
@@ -398,12 +808,33 @@ class DtkFileV5(DtkFileV4):
                 }
             }
             header.update(version5_params)
-        super(DtkFileV5, self).__init__(header, filename, handle)
+        super(DtkFileV5, self).__init__(header, filename, handle, lazy, memory_map, verify)
         header.version = 5
         return
 
 
-def read(filename):
+def read(filename, lazy=False, memory_map=False, compact=False, verify=True):
+    """
+    Read a serialized population file.
+
+    Args:
+        filename: path to the .dtk file
+        lazy: if True only the header is read and the offset of each chunk is recorded; chunks are
+            read, decompressed, and parsed when they are accessed, e.g. dtk.nodes[i] or dtk.simulation.
+            Version 1 files keep everything in a single chunk and are always read completely.
+        memory_map: if True the file is memory mapped and dtk.chunks[i] is a memoryview slice of the
+            mapping which is decompressed without first copying it. Implies lazy. Use dtk.close() or
+            "with read(...) as dtk:" to release the map, e.g. before replacing the file on Windows.
+        compact: if True objects are decoded as support.CompactObject which needs much less memory
+            for large populations than the default support.SerialObject, but takes longer to decode.
+            Version 1 files are always decoded as SerialObject.
+        verify: if True and the header has chunk checksums (see write()), all chunks are checked when
+            the file is read, or in lazy mode each chunk is checked when it is read. A UserWarning is
+            raised for a chunk which does not match. Set to False e.g. to salvage a damaged file.
+
+    Returns:
+        DtkFile object for the version of the file
+    """
 
     new_file = None
     with open(filename, 'rb') as handle:
@@ -412,19 +843,152 @@ def read(filename):
         if header.version == 1:
             new_file = DtkFileV1(header, filename=filename, handle=handle)
         elif header.version == 2:
-            new_file = DtkFileV2(header, filename=filename, handle=handle)
+            new_file = DtkFileV2(header, filename=filename, handle=handle, lazy=lazy, memory_map=memory_map,
+                                  verify=verify)
         elif header.version == 3:
-            new_file = DtkFileV3(header, filename=filename, handle=handle)
+            new_file = DtkFileV3(header, filename=filename, handle=handle, lazy=lazy, memory_map=memory_map,
+                                  verify=verify)
         elif header.version == 4:
-            new_file = DtkFileV4(header, filename=filename, handle=handle)
+            new_file = DtkFileV4(header, filename=filename, handle=handle, lazy=lazy, memory_map=memory_map,
+                                  verify=verify)
         elif header.version == 5:
-            new_file = DtkFileV5(header, filename=filename, handle=handle)
+            new_file = DtkFileV5(header, filename=filename, handle=handle, lazy=lazy, memory_map=memory_map,
+                                  verify=verify)
         else:
             raise UserWarning('Unknown serialized population file version: {0}'.format(header.version))
 
+    new_file.compact = compact and header.version > 1
     return new_file
 
 
+def read_nodes(dtk_file, workers=None):
+    """
+    Decompress and parse all node chunks of a serialized population file.
+
+    With workers the chunks are read and decompressed in a pool of threads, the compression engines
+    release the GIL, while this thread parses each chunk as soon as it is ready. Parsing takes most of
+    the time, so the gain is mostly the time otherwise spent reading and decompressing. Only a few
+    chunks more than workers are decompressed ahead of the parser. Use map_nodes() to reduce the
+    nodes in worker processes instead.
+
+    Args:
+        dtk_file: DtkFile object, e.g. from read()
+        workers: number of threads used to read and decompress the node chunks, None or 1 decodes
+            the chunks one after another in this thread
+
+    Returns:
+        list of node objects, the same objects iterating dtk_file.nodes would produce
+    """
+    if dtk_file.version == 1 or workers is None or workers <= 1 or len(dtk_file.nodes) < 2:
+        return [node for node in dtk_file.nodes]
+
+    chunks = dtk_file.chunks
+    engine = dtk_file.compression
+    items = []
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for index in range(1, len(chunks)):
+            pending.append((index, executor.submit(__uncompress_chunk__, chunks, index, engine)))
+            if len(pending) > 2 * workers:
+                items.append(__parse_chunk__(*pending.popleft(), compact=dtk_file.compact))
+        while pending:
+            items.append(__parse_chunk__(*pending.popleft(), compact=dtk_file.compact))
+
+    # Version 2 looks like this {'suid':{'id':id},'node':{...}}, dereference the node here for simplicity.
+    nodes = [item.node for item in items] if dtk_file.version == 2 else items
+    return nodes
+
+
+def __uncompress_chunk__(chunks, index, engine):
+    try:
+        data = uncompress(chunks[index], engine)
+    except UserWarning:
+        raise
+    except:
+        raise UserWarning("Could not parse JSON in chunk {0}".format(index))
+    return data
+
+
+def __parse_chunk__(index, future, compact=False):
+    data = future.result()
+    try:
+        item = __decode__(str(data, 'utf-8'), compact)
+    except:
+        raise UserWarning("Could not parse JSON in chunk {0}".format(index))
+    return item
+
+
+def map_nodes(dtk_file, function, workers=None):
+    """
+    Apply a function to every node of a serialized population file.
+
+    With workers each node chunk is read, decompressed, parsed, and passed to the function in a worker
+    process, only the results are sent back. The function must then be picklable, e.g. a module level
+    function or a functools.partial of one.
+
+    Args:
+        dtk_file: DtkFile object, e.g. from read(filename, lazy=True)
+        function: called with each node object
+        workers: number of worker processes, None or 1 calls the function in this process
+
+    Returns:
+        list with the result of the function for each node
+    """
+    if dtk_file.version == 1 or workers is None or workers <= 1 or len(dtk_file.nodes) < 2:
+        return [function(node) for node in dtk_file.nodes]
+
+    results = __map_chunks__(dtk_file, function, workers)
+    return results
+
+
+def __map_chunks__(dtk_file, function, workers):
+    chunks = dtk_file.chunks
+    sources = [__chunk_source__(chunks, index) for index in range(1, len(chunks))]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(__map_chunk__, sources, itertools.repeat(dtk_file.compression),
+                                    itertools.repeat(dtk_file.version), range(1, len(chunks)),
+                                    itertools.repeat(function), itertools.repeat(dtk_file.compact)))
+    return results
+
+
+def __chunk_source__(chunks, index):
+    offset = chunks.offset(index) if isinstance(chunks, LazyChunks) else None
+    if offset is not None:
+        # Let the worker read the chunk from disk rather than sending it through a pipe.
+        return chunks.filename, offset, chunks.sizes[index]
+    return bytes(chunks[index])
+
+
+def __map_chunk__(source, engine, version, index, function, compact=False):
+    item = __decode_chunk__(source, engine, index, compact)
+    return function(item.node if version == 2 else item)
+
+
+def __decode_chunk__(source, engine, index, compact=False):
+    if isinstance(source, tuple):
+        filename, offset, size = source
+        with open(filename, 'rb') as handle:
+            handle.seek(offset)
+            source = handle.read(size)
+    try:
+        contents = str(uncompress(source, engine), 'utf-8')
+        item = __decode__(contents, compact)
+    except:
+        raise UserWarning("Could not parse JSON in chunk {0}".format(index))
+    return item
+
+
+def __decode__(contents, compact=False):
+    if compact:
+        return json.loads(contents, object_pairs_hook=support.CompactObject)
+    return json.loads(contents, object_hook=support.SerialObject)
+
+
+def __encode__(item):
+    return json.dumps(item, separators=(',', ':'), default=support.json_default)
+
+
 def __check_magic_number__(handle):
     magic = handle.read(4).decode()
     if magic != IDTK:
@@ -480,6 +1044,13 @@ def __check_version__(version):
     return
 
 
+def __verify_checksum__(chunk, expected, index, filename):
+    if checksum(chunk) != expected:
+        raise UserWarning("Checksum of chunk {0} of file '{1}' does not match, the file is damaged".format(
+            index, filename))
+    return
+
+
 def __check_chunk_sizes__(chunk_sizes):
     for size in chunk_sizes:
         if size <= 0:
@@ -487,17 +1058,26 @@ def __check_chunk_sizes__(chunk_sizes):
     return
 
 
-def write(dtk_file, filename):
+def write(dtk_file, filename, checksums=None):
+    """
+    Write a serialized population file.
+
+    Args:
+        dtk_file: DtkFile object
+        filename: path of the new .dtk file
+        checksums: if True a CRC-32 of each chunk is written to the header (chunkchecksums) which read()
+            and verify() check, False removes them, None keeps them if the header already has them
+    """
+
+    if dtk_file.lazy and os.path.exists(filename) and os.path.samefile(dtk_file.chunks.filename, filename):
+        raise UserWarning("Cannot overwrite '{0}' while it is open in lazy mode.".format(filename))
 
     # noinspection PyProtectedMember
-    dtk_file._sync_header()
+    dtk_file._sync_header(checksums)
 
     with open(filename, 'wb') as handle:
         __write_magic_number__(handle)
-        if dtk_file.version <= 3:
-            header = json.dumps({'metadata': dtk_file.header}, separators=(',', ':'))
-        else:
-            header = json.dumps(dtk_file.header, separators=(',', ':')).replace('"engine"', '"compression"')
+        header = __format_header__(dtk_file.header)
 
         __write_header_size__(len(header), handle)
         __write_header__(header, handle)
@@ -506,6 +1086,14 @@ def write(dtk_file, filename):
     return
 
 
+def __format_header__(header):
+    if header.version <= 3:
+        text = json.dumps({'metadata': header}, separators=(',', ':'))
+    else:
+        text = json.dumps(header, separators=(',', ':')).replace('"engine"', '"compression"')
+    return text
+
+
 def __write_magic_number__(handle):
     handle.write('IDTK'.encode())
     return
@@ -524,5 +1112,321 @@ def __write_header__(string, handle):
 
 def __write_chunks__(chunks, handle):
     for chunk in chunks:
-        handle.write(chunk if type(chunk) is bytes else chunk.encode())
+        handle.write(chunk.encode() if isinstance(chunk, str) else chunk)
     return
+
+
+class DtkWriter(object):
+    """
+    Write a serialized population file one chunk at a time without holding all chunks in memory.
+
+    Each chunk is compressed and written as soon as it is added. The header is written into a reserved,
+    space padded region at the start of the file when the writer is closed. If the final header does not
+    fit in the reserved region the chunk data is moved to make room for it. The file is written under a
+    temporary name (filename + '.partial') and only renamed to filename when the writer is closed, if an
+    exception leaves the with block the partial file is removed and an existing file is left untouched.
+
+    Args:
+        filename: output .dtk file
+        version: serialized population file version, 2 through MAX_VERSION
+        compression: compression engine for the chunks, NONE, LZ4, SNAPPY, ZSTD, or a registered engine
+        header: optional DtkHeader with additional entries, e.g. author, tool, or emod_info
+        node_count: expected number of nodes, used to size the reserved header region
+        compression_level: engine specific level, e.g. 1-16 for LZ4 high compression, None for the default
+        checksums: if True a CRC-32 of each chunk is written to the header, see write()
+
+    Examples:
+        Write a simulation and its nodes::
+
+            with dft.DtkWriter("state-00010.dtk", compression=dft.LZ4) as writer:
+                writer.write_simulation(simulation)
+                for node in make_nodes():
+                    writer.write_node(node)
+    """
+
+    __file_classes__ = {2: DtkFileV2, 3: DtkFileV3, 4: DtkFileV4, 5: DtkFileV5}
+
+    def __init__(self, filename, version=MAX_VERSION, compression=LZ4, header=None, node_count=1000,
+                 compression_level=None, checksums=False):
+        if version not in self.__file_classes__:
+            raise UserWarning("Cannot stream serialized population file version {0}".format(version))
+        if compression.upper() not in __engines__:
+            raise RuntimeError("Unknown/unsupported compression scheme '{0}'".format(compression))
+        self._filename = filename
+        self._level = compression_level
+        self._header = self.__file_classes__[version](header=header).header
+        self._header.engine = compression.upper()
+        self._header['compressed'] = (self._header.engine != NONE)
+        self._sizes = []
+        self._checksums = [] if checksums else None
+        # Leave room for a chunk size and, if requested, a chunk checksum per node.
+        self._reserve = len(__format_header__(self._header)) + (28 if checksums else 16) * (node_count + 1) + 256
+        self._temporary = filename + '.partial'
+        self._handle = open(self._temporary, 'w+b')
+        __write_magic_number__(self._handle)
+        __write_header_size__(self._reserve, self._handle)
+        self._handle.write(b' ' * self._reserve)
+        return
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.__discard__()
+        return False
+
+    @property
+    def header(self):
+        return self._header
+
+    @property
+    def version(self):
+        return self._header.version
+
+    @property
+    def compression(self):
+        return self._header.engine
+
+    @property
+    def compression_level(self):
+        return self._level
+
+    @property
+    def chunk_count(self):
+        return len(self._sizes)
+
+    def write_simulation(self, simulation):
+        """Serialize, compress, and write the simulation object, this must be the first chunk."""
+        if self._sizes:
+            raise UserWarning("The simulation must be the first chunk of '{0}'".format(self._filename))
+        sim = dict(simulation)
+        sim['nodes'] = []
+        self.write_object({'simulation': sim} if self.version == 2 else sim)
+        return
+
+    def write_node(self, node):
+        """Serialize, compress, and write a node object."""
+        if not self._sizes:
+            raise UserWarning("The simulation must be written before any nodes to '{0}'".format(self._filename))
+        # Version 2 actually saves the entry from simulation.nodes (C++) which is a map of suid to node.
+        self.write_object({'suid': {'id': node['suid']['id']}, 'node': node} if self.version == 2 else node)
+        return
+
+    def write_object(self, item):
+        """Serialize, compress, and write an object as the next chunk."""
+        self.write_contents(__encode__(item))
+        return
+
+    def write_contents(self, contents):
+        """Compress and write JSON text (str or bytes) as the next chunk."""
+        data = contents.encode() if isinstance(contents, str) else contents
+        self.write_chunk(compress(data, self.compression, self._level))
+        return
+
+    def write_chunk(self, chunk):
+        """Write an already compressed chunk as is."""
+        self._handle.write(chunk)
+        self._sizes.append(len(chunk))
+        if self._checksums is not None:
+            self._checksums.append(checksum(chunk))
+        return
+
+    def close(self):
+        """Write the header and close the file."""
+        if self._handle.closed:
+            return
+        self._header.date = time.strftime('%a %b %d %H:%M:%S %Y')
+        self._header.chunkcount = len(self._sizes)
+        self._header.chunksizes = list(self._sizes)
+        self._header.bytecount = sum(self._sizes)
+        if self._checksums is not None:
+            self._header.chunkchecksums = list(self._checksums)
+        text = __format_header__(self._header)
+        try:
+            if len(text) <= self._reserve:
+                self._handle.seek(len(IDTK))
+                __write_header_size__(self._reserve, self._handle)
+                __write_header__(text.ljust(self._reserve), self._handle)
+                self._handle.close()
+                os.replace(self._temporary, self._filename)
+            else:
+                self.__relocate__(text)
+        except:
+            self.__discard__()
+            raise
+        return
+
+    def __relocate__(self, text):
+        temporary = self._filename + '.tmp'
+        try:
+            with open(temporary, 'wb') as handle:
+                __write_magic_number__(handle)
+                __write_header_size__(len(text), handle)
+                __write_header__(text, handle)
+                self._handle.seek(len(IDTK) + 12 + self._reserve)
+                shutil.copyfileobj(self._handle, handle)
+            os.replace(temporary, self._filename)
+        except:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+            raise
+        self.__discard__()
+        return
+
+    def __discard__(self):
+        self._handle.close()
+        if os.path.exists(self._temporary):
+            os.remove(self._temporary)
+        return
+
+
+def verify(filename, workers=None):
+    """
+    Check the integrity of a serialized population file without parsing the JSON of the chunks.
+
+    The header must be readable and the file must hold all of the chunks listed in the header. Each
+    chunk must match its checksum, if the header has checksums (see write()), and must decompress to
+    something which looks like a JSON object.
+
+    Args:
+        filename: serialized population file
+        workers: maximum number of threads used to check the chunks, None for the ThreadPoolExecutor default
+
+    Returns:
+        list of problems found, empty if the file is intact
+    """
+    try:
+        dtk_file = read(filename, lazy=True, verify=False)
+    except UserWarning as problem:
+        return [str(problem)]
+
+    checksums = dtk_file.header.get('chunkchecksums')
+    problems = []
+    if checksums is not None and len(checksums) != len(dtk_file.chunks):
+        problems.append("Header has {0} chunk checksums for {1} chunks".format(len(checksums), len(dtk_file.chunks)))
+        checksums = None
+
+    def check(index):
+        chunk = dtk_file.chunks[index]
+        if checksums is not None and checksum(chunk) != checksums[index]:
+            return "Checksum of chunk {0} does not match".format(index)
+        try:
+            data = uncompress(chunk, dtk_file.compression).rstrip(b'\x00').strip()
+        except Exception as exception:
+            return "Chunk {0} does not decompress ({1})".format(index, exception)
+        if not (data.startswith(b'{') and data.endswith(b'}')):
+            return "Chunk {0} does not contain a JSON object".format(index)
+        return None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        problems.extend(problem for problem in executor.map(check, range(len(dtk_file.chunks))) if problem)
+
+    return problems
+
+
+def merge(sources, filename, compression=None, level=None):
+    """
+    Combine the nodes of several serialized population files into one file without decoding the nodes.
+
+    The compressed node chunks are copied as they are (or only recompressed if the compression differs),
+    one at a time. Only the simulation is decoded and written again. It is taken from the first source
+    with its infection and individual suid generators advanced to the largest next suid of all sources.
+    The header entries, e.g. author and emod_info, are also taken from the first source.
+
+    Node suids/externalIds are not checked, the caller must make sure the selected nodes are distinct.
+
+    Args:
+        sources: list of serialized population filenames and/or (filename, node indices) tuples to only
+            take the given nodes (in the given order) of a file
+        filename: output .dtk file, must not be one of the sources
+        compression: compression engine of the output, default is the compression of the first source
+        level: compression level for recompressed chunks, see DtkFile.set_compression()
+
+    Returns:
+        number of nodes written
+
+    Examples:
+        Assemble a regional checkpoint from two runs::
+
+            dft.merge([("north.dtk", [0, 1, 2]), "south.dtk"], "region.dtk")
+    """
+    inputs = []
+    for source in sources:
+        name, indices = (source, None) if isinstance(source, str) else source
+        dtk_file = read(name, lazy=True)
+        if dtk_file.version == 1:
+            raise UserWarning("Cannot merge version 1 file '{0}', it has no separate node chunks".format(name))
+        node_count = len(dtk_file.nodes)
+        indices = list(range(node_count)) if indices is None else list(indices)
+        for index in indices:
+            if index < 0 or index >= node_count:
+                raise IndexError("Node index {0} out of range for '{1}' with {2} nodes".format(index, name, node_count))
+        if os.path.exists(filename) and os.path.samefile(name, filename):
+            raise UserWarning("Cannot write '{0}' while it is being merged.".format(filename))
+        inputs.append((dtk_file, indices))
+
+    if not inputs:
+        raise UserWarning("No serialized population files to merge.")
+    first = inputs[0][0]
+    if any((dtk_file.version == 2) != (first.version == 2) for dtk_file, _ in inputs):
+        # Version 2 node chunks are {'suid':..., 'node':...} rather than just the node.
+        raise UserWarning("Cannot merge version 2 files with files of other versions.")
+
+    simulation = first.simulation
+    for generator in ['infectionSuidGenerator', 'individualHumanSuidGenerator']:
+        next_ids = [dtk_file.simulation[generator]['next_suid']['id'] for dtk_file, _ in inputs
+                    if generator in dtk_file.simulation]
+        if generator in simulation:
+            simulation[generator] = copy.deepcopy(simulation[generator])
+            simulation[generator]['next_suid']['id'] = max(next_ids)
+
+    header = DtkHeader(copy.deepcopy(dict(first.header)))
+    header.pop('compression', None)
+    # Checksums are recomputed by the writer if the first source has them.
+    checksums = header.pop('chunkchecksums', None) is not None
+    compression = first.compression if compression is None else compression.upper()
+    node_count = sum(len(indices) for _, indices in inputs)
+    with DtkWriter(filename, version=first.version, compression=compression, header=header, node_count=node_count,
+                   compression_level=level, checksums=checksums) as writer:
+        writer.write_simulation(simulation)
+        for dtk_file, indices in inputs:
+            for index in indices:
+                chunk = dtk_file.chunks[index + 1]
+                if dtk_file.compression != compression or level is not None:
+                    chunk = recompress(chunk, dtk_file.compression, compression, level)
+                writer.write_chunk(chunk)
+
+    return node_count
+
+
+def split(filename, groups=None, output=None, compression=None, level=None):
+    """
+    Write the nodes of a serialized population file to several files without decoding the nodes.
+
+    Each output file has the simulation of the source and the compressed node chunks of its group
+    copied as they are, see merge().
+
+    Args:
+        filename: serialized population file
+        groups: list of lists of node indices, one output file is written for each list, by default
+            each node is written to its own file
+        output: output filename pattern, formatted with the index of the group, by default
+            "<filename without extension>-{0:05}.dtk"
+        compression: compression engine of the output, default is the compression of the source
+        level: compression level for recompressed chunks, see DtkFile.set_compression()
+
+    Returns:
+        list of the output filenames
+    """
+    if groups is None:
+        groups = [[index] for index in range(len(read(filename, lazy=True).nodes))]
+    if output is None:
+        output = os.path.splitext(filename)[0] + '-{0:05}.dtk'
+    filenames = []
+    for index, group in enumerate(groups):
+        filenames.append(output.format(index))
+        merge([(filename, group)], filenames[-1], compression, level)
+    return filenames
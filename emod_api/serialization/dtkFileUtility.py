@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 import argparse
+import emod_api.serialization.dtkFileDiff as dtkdiff
 import emod_api.serialization.dtkFileTools as dft
 import json
 import os
@@ -20,7 +21,8 @@ def __do_read__(args):
     else:
         extension = 'json'
 
-    dtk_file = dft.read(args.filename)
+    # Lazy read only reads the header, chunks are read from their offset in the file when accessed.
+    dtk_file = dft.read(args.filename, lazy=True)
 
     if args.header:
         with open(args.header, 'w') as handle:
@@ -28,7 +30,17 @@ def __do_read__(args):
 
     print('File header: {0}'.format(dtk_file.header))
 
-    for index in range(len(dtk_file.chunks)):
+    if args.header_only:
+        return
+
+    chunk_count = len(dtk_file.chunks)
+    indices = range(chunk_count) if args.chunk is None else args.chunk
+    for index in indices:
+        if index < 0 or index >= chunk_count:
+            raise UserWarning("Chunk index {0} is out of range, '{1}' has {2} chunks".format(
+                index, args.filename, chunk_count))
+
+    for index in indices:
         if args.raw:
             # Write raw chunks to disk
             output = dtk_file.chunks[index]
@@ -39,7 +51,7 @@ def __do_read__(args):
             else:
                 # Expand compressed contents, serialize, write out formatted
                 obj = dtk_file.objects[index]
-                print('Formatting chunk {0} of {1}... '.format(index+1, len(dtk_file.chunks)), end='')
+                print('Formatting chunk {0} of {1}... '.format(index+1, chunk_count), end='')
                 output = json.dumps(obj, indent=2, separators=(',', ':'))
 
         if index == 0:
@@ -58,6 +70,54 @@ def __do_read__(args):
     return
 
 
+def __do_list__(args):
+
+    dtk_file = dft.read(args.filename, lazy=True)
+
+    print("File:        {0}".format(args.filename))
+    print("Version:     {0}".format(dtk_file.version))
+    print("Compression: {0}".format(dtk_file.compression))
+    print("Author:      {0}".format(dtk_file.author))
+    print("Tool:        {0}".format(dtk_file.tool))
+    print("Date:        {0}".format(dtk_file.date))
+    print("Chunks:      {0}".format(dtk_file.chunk_count))
+    print("Bytes:       {0}".format(dtk_file.byte_count))
+    print()
+    print("{0:>7} {1:>16} {2:>16}  {3}".format("chunk", "offset", "size", "contents"))
+    for index, size in enumerate(dtk_file.chunk_sizes):
+        # Version 1 files are read completely and only have a single chunk.
+        offset = dtk_file.chunks.offset(index) if dtk_file.lazy else None
+        contents = 'simulation' if index == 0 else 'node-{:0>5}'.format(index)
+        print("{0:>7} {1:>16} {2:>16}  {3}".format(index, offset if offset is not None else '-', size, contents))
+
+    return
+
+
+def __do_diff__(args):
+
+    result = dtkdiff.diff(args.first, args.second, workers=args.workers)
+    print(result)
+
+    # Like diff(1), exit with 1 if the files differ.
+    if not result.identical:
+        sys.exit(1)
+
+    return
+
+
+def __do_verify__(args):
+
+    problems = dft.verify(args.filename, workers=args.workers)
+    for problem in problems:
+        print(problem)
+
+    if problems:
+        sys.exit(1)
+    print("'{0}' OK".format(args.filename))
+
+    return
+
+
 def __do_write__(args):
 
     print("Writing file '{0}'".format(args.filename), file=sys.stderr)
@@ -68,38 +128,37 @@ def __do_write__(args):
     print("{0} contents".format("Compressing" if args.compress else "Not compressing"), file=sys.stderr)
     print("{0} contents".format("Verifying" if args.verify else "Not verifying"), file=sys.stderr)
     print("Using compression engine '{0}'".format(args.engine), file=sys.stderr)
+    print("Compression level {0}".format(args.level if args.level is not None else "default"), file=sys.stderr)
 
-    dtk_file = dft.DtkFileV3()
-    dtk_file.author = args.author
-    dtk_file.tool = args.tool
-    dtk_file.compression = args.engine
-
-    _prepare_simulation_data(args.simulation, dtk_file)
-    _prepare_node_data(args.nodes, dtk_file)
-
-    dft.write(dtk_file, args.filename)
+    # Each chunk is compressed and written as it is read so only one node is held in memory at a time.
+    with dft.DtkWriter(args.filename, version=3, compression=args.engine, node_count=len(args.nodes),
+                       compression_level=args.level, checksums=args.checksums) as writer:
+        writer.header.author = args.author
+        writer.header.tool = args.tool
+        _prepare_simulation_data(args.simulation, writer)
+        _prepare_node_data(args.nodes, writer)
 
     return
 
 
-def _prepare_simulation_data(filename, dtk_file):
+def _prepare_simulation_data(filename, writer):
 
     with open(filename, 'rb') as handle:
         data = handle.read()
-        # Do not use dtk_file.simulation property because this is text rather than a Python object
-        dtk_file.contents.append(data)
+        # Do not use writer.write_simulation() because this is text rather than a Python object
+        writer.write_contents(data)
 
     return
 
 
 # noinspection SpellCheckingInspection
-def _prepare_node_data(filenames, dtk_file):
+def _prepare_node_data(filenames, writer):
 
     for filename in filenames:
         with open(filename, 'rb') as handle:
             data = handle.read()
-            # Do not use dtk_file.nodes here because this is text rather than a Python object
-            dtk_file.contents.append(data)
+            # Do not use writer.write_node() here because this is text rather than a Python object
+            writer.write_contents(data)
 
     return
 
@@ -118,8 +177,28 @@ if __name__ == '__main__':
                              help='Write unformatted (compact) JSON to disk')
     read_parser.add_argument('-o', '--output', default=None,
                              help='Output filename prefix, defaults to input filename with .json extension')
+    read_parser.add_argument('-c', '--chunk', default=None, type=int, action='append', metavar='<index>',
+                             help='Only write this chunk (0 is the simulation, 1..N are nodes), may be repeated')
+    read_parser.add_argument('--header-only', default=False, action='store_true',
+                             help='Only read and print (see --header) the file header')
     read_parser.set_defaults(func=__do_read__)
 
+    list_parser = subparsers.add_parser('list', help='List header information and chunk offsets and sizes')
+    list_parser.add_argument('filename')
+    list_parser.set_defaults(func=__do_list__)
+
+    diff_parser = subparsers.add_parser('diff', help='Compare the header, simulation, and nodes of two .dtk files')
+    diff_parser.add_argument('first')
+    diff_parser.add_argument('second')
+    diff_parser.add_argument('-w', '--workers', default=None, type=int,
+                             help='Number of processes comparing node chunks which differ [1]')
+    diff_parser.set_defaults(func=__do_diff__)
+
+    verify_parser = subparsers.add_parser('verify', help='Check chunk sizes, checksums, and compression without parsing')
+    verify_parser.add_argument('filename')
+    verify_parser.add_argument('-w', '--workers', default=None, type=int, help='Number of threads checking chunks')
+    verify_parser.set_defaults(func=__do_verify__)
+
     username = os.environ['USERNAME'] if 'USERNAME' in os.environ else os.environ['USER']
     tool_name = os.path.basename(__file__)
 
@@ -133,7 +212,11 @@ if __name__ == '__main__':
                               help='Do not compress contents of new .dtk file')
     write_parser.add_argument('-v', '--verify', default=False, action='store_true',
                               help='Verify JSON in simulation and nodes (could be slow).')
-    write_parser.add_argument('-e', '--engine', default='LZ4', help='Compression engine {NONE|LZ4|SNAPPY} [LZ4]')
+    write_parser.add_argument('-e', '--engine', default='LZ4', help='Compression engine {NONE|LZ4|SNAPPY|ZSTD} [LZ4]')
+    write_parser.add_argument('-l', '--level', default=None, type=int,
+                              help='Compression level, e.g. 1-16 for LZ4 high compression or 1-22 for ZSTD [default]')
+    write_parser.add_argument('-k', '--checksums', default=False, action='store_true',
+                              help='Store a checksum of each chunk in the header')
     write_parser.set_defaults(func=__do_write__)
 
     commandline_args = parser.parse_args()
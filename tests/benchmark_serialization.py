@@ -0,0 +1,306 @@
+#!/usr/bin/python
+
+"""
+Benchmarks for the serialized population read/modify/write path.
+
+Synthetic serialized population files are generated for each combination of file version, node count,
+population size, and compression engine. The following operations are timed on each file:
+
+    open    dft.read() of the whole file
+    decode  decompress and parse the simulation and all nodes
+    edit    SerializedPopulation: change one individual of one node and write the file
+    write   dft.write() of the whole (decoded) file, i.e. serializing and compressing every chunk
+    recompress  DtkFile.set_compression() of all chunks to another engine, NONE for compressed files
+            and LZ4 for uncompressed ones unless --recompress-to is given
+    read    SerializedPopulation() with --workers threads decompressing the nodes while they are parsed
+    map     dft.map_nodes() of a lazily read file with --workers processes, each node is reduced to a
+            count and mean age in the worker
+
+The read and map operations are timed for each --workers count, 1 is the serial baseline. Parallel
+gains need as many free cores as workers.
+
+Each operation runs in a fresh process so the peak memory figures are not polluted by earlier runs.
+Results are reported as seconds, MB/s of (compressed) file size, individuals/s, and the peak Python heap
+(tracemalloc) and peak resident set size (where the resource module is available) of the process. Tracing
+allocations slows Python down several times, so the operation is timed (and its peak RSS taken) in one
+process and run again with tracemalloc in another process for the peak heap.
+
+Examples:
+    python benchmark_serialization.py --quick
+    python benchmark_serialization.py --nodes 1 10 100 --individuals 1000 100000 1000000 --csv results.csv
+    python benchmark_serialization.py --nodes 16 --individuals 1000000 --operations read map --workers 1 2 4
+"""
+
+import argparse
+import copy
+import csv
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import emod_api.serialization.dtkFileSupport as support
+import emod_api.serialization.dtkFileTools as dft
+import emod_api.serialization.SerializedPopulation as SerPop
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+OPERATIONS = ["open", "decode", "edit", "write", "recompress", "read", "map"]
+PARALLEL = ["read", "map"]
+
+SIMULATION = {
+    "__class__": "Simulation",
+    "serializationMask": 3,
+    "Run_Number": 1,
+    "sim_type": 0,
+    "nodes": [],
+    "infectionSuidGenerator": {"next_suid": {"id": 1}, "rank": 0, "numtasks": 1},
+    "individualHumanSuidGenerator": {"next_suid": {"id": 1}, "rank": 0, "numtasks": 1},
+}
+
+INDIVIDUAL = {
+    "__class__": "IndividualHuman",
+    "suid": {"id": 1},
+    "m_age": 9588.48,
+    "m_gender": 0,
+    "m_mc_weight": 1,
+    "m_daily_mortality_rate": 0,
+    "m_is_infected": False,
+    "m_new_infection_state": 0,
+    "StateChange": 0,
+    "cumulativeInfs": 0,
+    "infectiousness": 0,
+    "is_pregnant": False,
+    "pregnancy_timer": 0,
+    "above_poverty": 0,
+    "home_node_id": {"id": 1},
+    "migration_destination": {"id": 0},
+    "waypoints": [],
+    "waypoints_trip_type": [],
+    "Properties": ["Risk:LOW"],
+    "infections": [],
+    "interventions": {
+        "__class__": "InterventionsContainer",
+        "drugVaccineReducedAcquire": 1,
+        "drugVaccineReducedTransmit": 1,
+        "drugVaccineReducedMortality": 1,
+        "interventions": [],
+    },
+    "susceptibility": {
+        "__class__": "Susceptibility",
+        "age": 9588.48,
+        "mod_acquire": 1,
+        "mod_transmit": 1,
+        "mod_mortality": 1,
+        "acqdecayoffset": 0,
+        "trandecayoffset": 0,
+        "mortdecayoffset": 0,
+    },
+}
+
+
+def make_node(node_id, first_suid, count):
+    individuals = []
+    for offset in range(count):
+        individual = copy.deepcopy(INDIVIDUAL)
+        individual["suid"]["id"] = first_suid + offset
+        individual["m_age"] = individual["susceptibility"]["age"] = float((first_suid + offset) * 37 % 36500)
+        individual["m_gender"] = offset % 2
+        individual["home_node_id"]["id"] = node_id
+        individuals.append(individual)
+    return {
+        "__class__": "Node",
+        "serializationMask": 3,
+        "suid": {"id": node_id},
+        "externalId": node_id,
+        "individualHumans": individuals,
+        "m_IndividualHumanSuidGenerator": {"next_suid": {"id": first_suid + count}, "rank": 0, "numtasks": 1},
+    }
+
+
+def make_file(filename, version, nodes, individuals, compression):
+    """Stream a synthetic serialized population file to disk, one node at a time."""
+    per_node = [individuals // nodes + (1 if index < individuals % nodes else 0) for index in range(nodes)]
+    with dft.DtkWriter(filename, version=version, compression=compression, node_count=nodes) as writer:
+        writer.header.tool = os.path.basename(__file__)
+        writer.write_simulation(SIMULATION)
+        first_suid = 1
+        for index, count in enumerate(per_node):
+            writer.write_node(make_node(index + 1, first_suid, count))
+            first_suid += count
+    return
+
+
+def summarize_node(node):
+    """Reduce a node to the number of individuals and their mean age, for the map operation."""
+    individuals = node["individualHumans"]
+    mean_age = sum(individual["m_age"] for individual in individuals) / max(len(individuals), 1)
+    return len(individuals), mean_age
+
+
+def run_operation(operation, filename, scratch, workers=1, target=None):
+    if operation == "open":
+        dft.read(filename)
+    elif operation == "decode":
+        dtk = dft.read(filename)
+        dtk.simulation
+        for _ in dtk.nodes:
+            pass
+    elif operation == "edit":
+        ser_pop = SerPop.SerializedPopulation(filename)
+        ser_pop.nodes[0].individualHumans[0].m_age += 1
+        ser_pop.write(scratch)
+    elif operation == "write":
+        dtk = dft.read(filename)
+        dtk.simulation = dtk.simulation
+        for index in range(len(dtk.nodes)):
+            dtk.nodes[index] = dtk.nodes[index]
+        dft.write(dtk, scratch)
+    elif operation == "recompress":
+        dtk = dft.read(filename)
+        dtk.set_compression(target or (dft.NONE if dtk.compressed else dft.LZ4))
+    elif operation == "read":
+        SerPop.SerializedPopulation(filename, workers=workers)
+    elif operation == "map":
+        dft.map_nodes(dft.read(filename, lazy=True), summarize_node, workers)
+    else:
+        raise ValueError("Unknown operation '{0}'".format(operation))
+    return
+
+
+def measure(operation, filename, scratch, workers, target, trace, queue):
+    """Run one operation in this (fresh) process and report its time and peak RSS, or its peak heap if traced."""
+    if trace:
+        tracemalloc.start()
+        run_operation(operation, filename, scratch, workers, target)
+        _, peak_heap = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        queue.put(peak_heap)
+        return
+    start = time.perf_counter()
+    run_operation(operation, filename, scratch, workers, target)
+    seconds = time.perf_counter() - start
+    peak_rss = None
+    if resource is not None:
+        # ru_maxrss is reported in kilobytes on Linux and in bytes on macOS
+        scale = 1 if sys.platform == "darwin" else 1024
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+    queue.put((seconds, peak_rss))
+    return
+
+
+def run_measurement(operation, filename, scratch, workers, target, trace, context):
+    queue = context.Queue()
+    process = context.Process(target=measure, args=(operation, filename, scratch, workers, target, trace, queue))
+    process.start()
+    result = queue.get()
+    process.join()
+    return result
+
+
+def benchmark(operation, filename, scratch, workers, target, context):
+    """Time an operation and measure its peak heap in a separate, traced, run."""
+    seconds, peak_rss = run_measurement(operation, filename, scratch, workers, target, False, context)
+    peak_heap = run_measurement(operation, filename, scratch, workers, target, True, context)
+    return seconds, peak_heap, peak_rss
+
+
+def main(arguments):
+    # Spawn a new interpreter for each measurement so no memory is inherited from the parent.
+    context = multiprocessing.get_context("spawn")
+    compressions = [engine.upper() for engine in arguments.compression]
+    if dft.SNAPPY in compressions and not support.SNAPPY_SUPPORT:
+        print("** NOTE ** [python-]snappy not installed, skipping SNAPPY.")
+        compressions.remove(dft.SNAPPY)
+    if dft.ZSTD in compressions and not support.ZSTD_SUPPORT:
+        print("** NOTE ** zstandard not installed, skipping ZSTD.")
+        compressions.remove(dft.ZSTD)
+
+    directory = tempfile.mkdtemp(prefix="dtk-benchmark-")
+    fields = ["version", "compression", "nodes", "individuals", "operation", "target", "workers", "file_mb",
+              "seconds", "mb_per_s", "individuals_per_s", "peak_heap_mb", "peak_rss_mb"]
+    rows = []
+    print(" ".join("{0:>17}".format(field) for field in fields))
+    try:
+        for version in arguments.versions:
+            for compression in compressions:
+                target = arguments.recompress_to.upper() if arguments.recompress_to else (
+                    dft.NONE if compression != dft.NONE else dft.LZ4)
+                for nodes in arguments.nodes:
+                    for individuals in arguments.individuals:
+                        filename = os.path.join(directory, "v{0}-{1}-{2}-{3}.dtk".format(
+                            version, compression, nodes, individuals))
+                        scratch = os.path.join(directory, "scratch.dtk")
+                        make_file(filename, version, nodes, individuals, compression)
+                        file_mb = os.path.getsize(filename) / 2**20
+                        runs = [(operation, workers) for operation in arguments.operations
+                                for workers in (arguments.workers if operation in PARALLEL else [None])]
+                        for operation, workers in runs:
+                            best = None
+                            for _ in range(arguments.repeat):
+                                result = benchmark(operation, filename, scratch, workers, target, context)
+                                best = result if best is None or result[0] < best[0] else best
+                            seconds, peak_heap, peak_rss = best
+                            row = {
+                                "version": version,
+                                "compression": compression,
+                                "nodes": nodes,
+                                "individuals": individuals,
+                                "operation": operation,
+                                "target": target if operation == "recompress" else "",
+                                "workers": workers if workers is not None else "",
+                                "file_mb": round(file_mb, 3),
+                                "seconds": round(seconds, 4),
+                                "mb_per_s": round(file_mb / seconds, 2),
+                                "individuals_per_s": round(individuals / seconds),
+                                "peak_heap_mb": round(peak_heap / 2**20, 2),
+                                "peak_rss_mb": round(peak_rss / 2**20, 2) if peak_rss is not None else "",
+                            }
+                            rows.append(row)
+                            print(" ".join("{0:>17}".format(row[field]) for field in fields))
+                        os.remove(filename)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if arguments.csv:
+        with open(arguments.csv, "w", newline="") as handle:
+            writer = csv.DictWriter(handle, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(rows)
+        print("Wrote results to '{0}'".format(arguments.csv))
+
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark serialized population file handling.")
+    parser.add_argument("--versions", type=int, nargs="+", default=[3, 4, 5], help="File versions [3 4 5]")
+    parser.add_argument("--nodes", type=int, nargs="+", default=[1, 10, 100], help="Node counts [1 10 100]")
+    parser.add_argument("--individuals", type=int, nargs="+", default=[1000, 10000, 100000, 1000000],
+                        help="Individuals per file [1000 10000 100000 1000000]")
+    parser.add_argument("--compression", nargs="+", default=[dft.NONE, dft.LZ4, dft.SNAPPY],
+                        help="Compression engines, e.g. NONE LZ4 SNAPPY ZSTD [NONE LZ4 SNAPPY]")
+    parser.add_argument("--operations", nargs="+", default=OPERATIONS, choices=OPERATIONS,
+                        help="Operations to time [{0}]".format(" ".join(OPERATIONS)))
+    parser.add_argument("--recompress-to", default=None,
+                        help="Target engine of the recompress operation [NONE, or LZ4 for uncompressed files]")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 4],
+                        help="Threads (read) or processes (map) for the parallel operations [1 4]")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per measurement, the fastest is reported [1]")
+    parser.add_argument("--quick", default=False, action="store_true",
+                        help="Small matrix (version 5, 1 and 10 nodes, 1000 and 10000 individuals)")
+    parser.add_argument("--csv", default=None, help="Also write the results to this CSV file")
+
+    args = parser.parse_args()
+    if args.quick:
+        args.versions = [5]
+        args.nodes = [1, 10]
+        args.individuals = [1000, 10000]
+
+    main(args)
@@ -26,10 +26,7 @@ class CommonInterventionTest(CampaignTest):
 
 
     def common_reset_globals(self):
-        common.cached_be = None
-        common.cached_ce = None
-        common.cached_mid = None
-        common.cached_sec = None
+        s2c.clear_schema_index()
 
     def save_campaignfile_and_load_event(self, intervention, camp_filename):
         camp.add(intervention)
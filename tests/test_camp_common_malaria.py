@@ -26,10 +26,7 @@ class CommonInterventionTestMalaria(CampaignTest):
         self.common_reset_globals()
 
     def common_reset_globals(self):
-        common.cached_be = None
-        common.cached_ce = None
-        common.cached_mid = None
-        common.cached_sec = None
+        s2c.clear_schema_index()
 
     def save_campaignfile_and_load_event(self, intervention, camp_filename):
         camp.add(intervention)
@@ -312,7 +309,7 @@ class CommonInterventionTestMalaria(CampaignTest):
             TriggeredCampaignEvent(camp,
                                    Start_Day=5,
                                    Event_Name='test_event_name',
-                                   Nodeset_Config=utils.do_nodes(schema_path, [3, 4]),
+                                   Nodeset_Config=utils.do_nodes(camp.schema_path, [3, 4]),
                                    Node_Ids=[3, 4],
                                    Triggers=copy.deepcopy(triggers),
                                    Intervention_List=[BroadcastEvent(camp)],
@@ -1355,11 +1352,8 @@ class CommonInterventionTestMalaria(CampaignTest):
         ind_property_restrictions = [{'key': 'value', 'Property3': 'value3'}, {"Tom": "Jerry"}]
         stop_trigger_condition_list = ['sdfjaslfdja']
         target_gender = TargetGender.Male
-        common.cached_mid = None
-        common.cached_be = None
+        s2c.clear_schema_index()
         common.schema_path = None
-        common.cached_ce = None
-        common.cached_sec = None
         # common.old_adhoc_trigger_style = True
         int1 = common.BroadcastEvent(camp, Event_Trigger=broadcast)
         int2 = common.BroadcastEvent(camp, Event_Trigger=broadcast2)
@@ -1,6 +1,7 @@
 import unittest
 import os
 import json
+import copy
 
 from emod_api.config import default_from_schema_no_validation as dfs
 from emod_api.config import from_schema
@@ -649,6 +650,189 @@ class ReadOnlyDictTest(unittest.TestCase):
             coordinator.Non_Existing_Parameter = None
         self.assertTrue("'Non_Existing_Parameter' not found in this object." in str(context.exception))
 
+    def test_schema_index(self):
+        s2c.schema_cache = None
+        schema_path = "data/config/input_malaria_schema.json"
+        first = s2c.get_class_with_defaults("CampaignEvent", schema_path)
+        index = s2c.get_schema_index(s2c.get_schema(schema_path))
+        self.assertIn("CampaignEvent", index.templates)
+        self.assertIn("NodeSetAll", index.templates)
+        self.assertIn("SimpleVaccine", index.interventions)
+
+        # Later calls return equal but independent objects which share the schema blobs.
+        first.Start_Day = 10
+        first.Nodeset_Config["class"] = "changed"
+        second = s2c.get_class_with_defaults("CampaignEvent", schema_path)
+        self.assertEqual(1, second.Start_Day)
+        self.assertEqual("NodeSetAll", second.Nodeset_Config["class"])
+        self.assertIs(first.schema, second.schema)
+        self.assertIsInstance(second.Nodeset_Config, s2c.ReadOnlyDict)
+
+        vaccine = s2c.get_class_with_defaults("SimpleVaccine", schema_path)
+        self.assertIsNot(vaccine.Waning_Config, s2c.get_class_with_defaults("SimpleVaccine", schema_path).Waning_Config)
+
+        from emod_api import campaign
+        campaign.reset()
+        self.assertEqual(0, len(s2c.schema_indices))
+
+    def test_template_cache(self):
+        import copy
+        s2c.schema_cache = None
+        schema_path = "data/config/input_malaria_schema.json"
+        index = s2c.get_schema_index(s2c.get_schema(schema_path))
+        max_templates = s2c.max_templates
+        try:
+            s2c.max_templates = 2
+            for classname in ["CampaignEvent", "StandardEventCoordinator", "SimpleVaccine", "StandardEventCoordinator"]:
+                s2c.get_class_with_defaults(classname, schema_path)
+            self.assertEqual(2, len(index.templates))
+            self.assertEqual("StandardEventCoordinator", list(index.templates)[-1])
+            self.assertNotIn("CampaignEvent", index.templates)
+        finally:
+            s2c.max_templates = max_templates
+
+        # Deep copies share the schema blobs but nothing else.
+        event = s2c.get_class_with_defaults("CampaignEvent", schema_path)
+        duplicate = copy.deepcopy(event)
+        self.assertEqual(event, duplicate)
+        self.assertIs(event.schema, duplicate.schema)
+        self.assertIs(event.Nodeset_Config.schema, duplicate.Nodeset_Config.schema)
+        self.assertIsNot(event.Nodeset_Config, duplicate.Nodeset_Config)
+        self.assertIsInstance(duplicate, s2c.ReadOnlyDict)
+        duplicate.Start_Day = 5
+        self.assertEqual(1, event.Start_Day)
+
+    def test_schema_is_not_an_entry(self):
+        import pickle
+        s2c.schema_cache = None
+        schema_path = "data/config/input_malaria_schema.json"
+        event = s2c.get_class_with_defaults("CampaignEvent", schema_path)
+        blob = s2c.get_schema(schema_path)["idmTypes"]["idmAbstractType:CampaignEvent"]["CampaignEvent"]
+        self.assertIs(blob, event.schema)
+        self.assertNotIn("schema", event)
+        self.assertNotIn('"schema"', json.dumps(event))
+
+        self.assertIs(blob, copy.copy(event).schema)
+        self.assertIs(blob, copy.deepcopy(event).schema)
+        # Pickles keep the schema, e.g. for objects built in worker processes, but only once per blob.
+        restored = pickle.loads(pickle.dumps(event))
+        self.assertEqual(event, restored)
+        self.assertEqual(blob, restored.schema)
+        self.assertIsNotNone(restored.Nodeset_Config.schema)
+        with self.assertRaises(ValueError):
+            restored.Start_Day = -1
+        restored.Start_Day = 3
+        self.assertEqual(3, restored.finalize()["Start_Day"])
+        other = s2c.get_class_with_defaults("CampaignEvent", schema_path)
+        first, second = pickle.loads(pickle.dumps([event, other]))
+        self.assertIs(first.schema, second.schema)
+        self.assertLess(len(pickle.dumps([event, other])), 2 * len(pickle.dumps(event)))
+
+        event.Start_Day = 5
+        event.finalize()
+        self.assertIsNone(event.schema)
+        self.assertIsNone(event.Nodeset_Config.schema)
+        self.assertEqual(5, event.Start_Day)
+
+        # A "schema" node of a config loaded from JSON is still used and removed by finalize().
+        config = json.loads(json.dumps({"Start_Day": 1, "schema": {"Start_Day": blob["Start_Day"]}}),
+                            object_hook=s2c.ReadOnlyDict)
+        self.assertEqual(blob["Start_Day"], config.schema["Start_Day"])
+        with self.assertRaises(ValueError):
+            config.Start_Day = -1
+        self.assertNotIn("schema", config.finalize())
+
+    def test_compiled_validators(self):
+        s2c.schema_cache = None
+        s2c.clear_schema_index()
+        schema_path = "data/config/input_malaria_schema.json"
+        coordinator = s2c.get_class_with_defaults("StandardEventCoordinator", schema_path)
+        vaccine = s2c.get_class_with_defaults("SimpleVaccine", schema_path)
+
+        coordinator.Number_Repetitions = 3
+        coordinator.Number_Repetitions = 4
+        validators = s2c.compiled_schemas[id(coordinator.schema)][1]
+        self.assertEqual(["Number_Repetitions"], list(validators))
+        self.assertEqual(4, coordinator.Number_Repetitions)
+        with self.assertRaises(ValueError) as context:
+            coordinator.Number_Repetitions = -2
+        self.assertIn("is below minimum", str(context.exception))
+        with self.assertRaises(ValueError) as context:
+            coordinator.Number_Repetitions = "3"
+        self.assertIn("is string when needs to be integer", str(context.exception))
+
+        vaccine.Vaccine_Type = "AcquisitionBlocking"
+        self.assertEqual("AcquisitionBlocking", vaccine.Vaccine_Type)
+        with self.assertRaises(ValueError) as context:
+            vaccine.Vaccine_Type = "Unknown"
+        self.assertIn("is not list of possible values", str(context.exception))
+        with self.assertRaises(ValueError):
+            vaccine.Vaccine_Type = []
+
+        vaccine.Dont_Allow_Duplicates = True
+        self.assertEqual(1, vaccine.Dont_Allow_Duplicates)
+        with self.assertRaises(ValueError):
+            vaccine.Dont_Allow_Duplicates = 2
+
+        # Objects of the same class share the validators of their schema blob.
+        other = s2c.get_class_with_defaults("StandardEventCoordinator", schema_path)
+        self.assertIs(coordinator.schema, other.schema)
+        other.Number_Repetitions = 5
+        self.assertEqual(1, len(validators))
+
+        s2c.clear_schema_index()
+        self.assertEqual(0, len(s2c.compiled_schemas))
+
+    def test_compiled_schemas_are_least_recently_used(self):
+        s2c.clear_schema_index()
+        limit = s2c.max_compiled_schemas
+        s2c.max_compiled_schemas = 2
+        try:
+            first, second, third = {"A": {}}, {"B": {}}, {"C": {}}
+            entry = s2c._get_compiled(first)
+            s2c._get_compiled(second)
+            # Using the first blob again keeps it, the second one is evicted instead.
+            self.assertIs(entry, s2c._get_compiled(first))
+            s2c._get_compiled(third)
+            self.assertEqual([id(first), id(third)], list(s2c.compiled_schemas))
+            self.assertIs(entry, s2c._get_compiled(first))
+        finally:
+            s2c.max_compiled_schemas = limit
+            s2c.clear_schema_index()
+
+    def test_finalize_depends_on(self):
+        schema = {
+            "Enable_A": {"type": "bool", "default": 0},
+            "A_Param": {"type": "float", "default": 1, "min": 0, "max": 10, "depends-on": {"Enable_A": 1}},
+            "A_Sub_Param": {"type": "float", "default": 1, "min": 0, "max": 10, "depends-on": {"A_Param": 1}},
+            "Mode": {"type": "enum", "default": "X", "enum": ["X", "Y", "Z"]},
+            "Mode_Param": {"type": "float", "default": 1, "min": 0, "max": 10, "depends-on": {"Mode": "X, Y"}}
+        }
+
+        def make_config(**params):
+            # Dependent parameters come first, they are decided after the parameters they depend on.
+            config = {"A_Sub_Param": 1, "A_Param": 1, "Enable_A": 0, "Mode_Param": 2, "Mode": "Y"}
+            config.update(params)
+            config["schema"] = schema
+            return json.loads(json.dumps(config), object_hook=s2c.ReadOnlyDict)
+
+        s2c.clear_schema_index()
+        config = make_config()
+        self.assertEqual({"Enable_A": 0, "Mode_Param": 2, "Mode": "Y"}, dict(make_config().finalize()))
+        self.assertEqual({"A_Sub_Param": 1, "A_Param": 1, "Enable_A": 1, "Mode": "Z"},
+                         dict(make_config(Enable_A=1, Mode="Z").finalize()))
+
+        # The graph is compiled once per schema blob.
+        graph = s2c._get_depends_on(config.schema)
+        self.assertEqual({"A_Param", "A_Sub_Param", "Mode_Param"}, set(graph))
+        self.assertEqual(("Mode", "X, Y", ("X", "Y")), graph["Mode_Param"][0])
+        self.assertIs(graph, s2c._get_depends_on(config.schema))
+
+        config["explicits"] = ["A_Sub_Param"]
+        with self.assertRaises(ValueError) as context:
+            config.finalize()
+        self.assertIn("You set param A_Sub_Param but it was disabled", str(context.exception))
+
 
 
 
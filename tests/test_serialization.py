@@ -3,10 +3,26 @@
 from __future__ import print_function
 import emod_api.serialization.dtkFileTools as dft
 import emod_api.serialization.dtkFileSupport as support
+import emod_api.serialization.SerializedPopulation as SerPop
+import emod_api.serialization.CensusAndModPop as CensusAndModPop
+import emod_api.serialization.dtkFileUtility as dtkFileUtility
+import emod_api.serialization.dtkFileDiff as dtkdiff
+import emod_api.serialization.batch as batch
+import argparse
+import contextlib
+import copy
+import importlib.util
+import io
+import json
 import os
+import pickle
+import shutil
 import tempfile
 import unittest
+import unittest.mock as mock
 import time
+import tracemalloc
+import zlib
 
 WORKING_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
 
@@ -1191,6 +1207,664 @@ class TestRegressions(unittest.TestCase):
         return
 
 
+class TestLazyRead(unittest.TestCase):
+
+    def test_lazy_read_matches_eager_read(self):
+        filename = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk")
+        eager = dft.read(filename)
+        lazy = dft.read(filename, lazy=True)
+        self.assertTrue(lazy.lazy)
+        self.assertFalse(eager.lazy)
+        self.assertEqual(eager.chunk_sizes, lazy.chunk_sizes)
+        self.assertEqual(eager.byte_count, lazy.byte_count)
+        self.assertEqual(eager.simulation, lazy.simulation)
+        self.assertEqual(len(eager.nodes), len(lazy.nodes))
+        self.assertEqual(eager.nodes[3], lazy.nodes[3])
+        self.assertEqual(eager.chunks[2], lazy.chunks[2])
+        self.assertEqual(eager.chunks[-1], lazy.chunks[-1])
+        return
+
+    def test_lazy_read_only_reads_header(self):
+        filename = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk")
+        dtk = dft.read(filename, lazy=True)
+        # Nothing is held in memory until a chunk is assigned.
+        self.assertEqual(0, len(dtk.chunks._loaded))
+        self.assertEqual(5, dtk.chunk_count)
+        self.assertEqual(1, dtk.nodes[0].externalId)
+        self.assertEqual(0, len(dtk.chunks._loaded))
+        return
+
+    def test_lazy_round_trip(self):
+        dtk = dft.read(os.path.join(WORKING_DIRECTORY, "data", "serialization", "baseline.dtk"), lazy=True)
+        node = dtk.nodes[1]
+        node.individualHumans[0].m_age = 1234.5
+        dtk.nodes[1] = node
+        self.assertIsNone(dtk.chunks.offset(2))
+        self.assertIsNotNone(dtk.chunks.offset(1))
+        handle, filename = tempfile.mkstemp()
+        os.close(handle)
+        dft.write(dtk, filename)
+        dest = dft.read(filename)
+        os.remove(filename)
+        self.assertEqual(1234.5, dest.nodes[1].individualHumans[0].m_age)
+        self.assertEqual(dtk.chunks[3], dest.chunks[3])
+        self.assertEqual(dtk.chunk_sizes, dest.chunk_sizes)
+        return
+
+    def test_lazy_read_cannot_overwrite_source(self):
+        handle, filename = tempfile.mkstemp()
+        os.close(handle)
+        dft.write(dft.read(os.path.join(WORKING_DIRECTORY, "data", "serialization", "version3.dtk")), filename)
+        dtk = dft.read(filename, lazy=True)
+        with self.assertRaises(UserWarning):
+            dft.write(dtk, filename)
+        os.remove(filename)
+        return
+
+    def test_lazy_read_truncated_file(self):
+        with self.assertRaises(UserWarning):
+            dft.read(os.path.join(WORKING_DIRECTORY, "data", "serialization", "truncated.dtk"), lazy=True)
+        return
+
+
+class TestObjectCache(unittest.TestCase):
+
+    def test_objects_are_not_cached_by_default(self):
+        filename = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk")
+        dtk = dft.read(filename, lazy=True)
+        node = dtk.nodes[1]
+        self.assertIsNot(node, dtk.nodes[1])
+        self.assertEqual(node, dtk.nodes[1])
+        # Changes made in place only take effect when the node is assigned back.
+        node.externalId = 42
+        self.assertNotEqual(42, dtk.nodes[1].externalId)
+        dtk.nodes[1] = node
+        self.assertIs(node, dtk.nodes[1])
+        self.assertEqual([2], dtk.objects.dirty)
+        # Iterating and mapping the nodes leave nothing behind.
+        self.assertEqual(4, len(list(dtk.nodes)))
+        self.assertEqual(4, len(dft.map_nodes(dtk, len)))
+        # noinspection PyProtectedMember
+        self.assertEqual(0, len(dtk.objects._cache))
+        self.assertEqual([2], dtk.objects.dirty)
+        return
+
+    def test_bounded_cache(self):
+        dtk = dft.read(os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk"))
+        dtk.objects.cache_size = 2
+        self.assertIs(dtk.nodes[1], dtk.nodes[1])
+        self.assertIs(dtk.objects[-1], dtk.objects[4])
+        first = dtk.nodes[0]
+        self.assertIs(dtk.nodes[1], dtk.nodes[1])
+        # noinspection PyProtectedMember
+        self.assertEqual([1, 2], list(dtk.objects._cache.keys()))
+        # Node 1 (chunk 2) was used most recently, so chunk 1 is evicted first.
+        dtk.nodes[2]
+        # noinspection PyProtectedMember
+        self.assertEqual([2, 3], list(dtk.objects._cache.keys()))
+        self.assertIsNot(first, dtk.nodes[0])
+        # Iterating does not fill the cache.
+        list(dtk.nodes)
+        # noinspection PyProtectedMember
+        self.assertEqual([3, 1], list(dtk.objects._cache.keys()))
+        return
+
+    def test_simulation_is_a_new_object(self):
+        for version in [2, 4]:
+            dtk = dft.read(os.path.join(WORKING_DIRECTORY, "data", "serialization", "version{0}.dtk".format(version)))
+            dtk.objects.cache_size = 4
+            sim = dtk.simulation
+            self.assertTrue("nodes" not in sim)
+            next_suid = sim.infectionSuidGenerator.next_suid.id
+            # Changes made in place are neither seen by later accesses nor written.
+            sim.infectionSuidGenerator.next_suid.id += 1000
+            self.assertEqual(next_suid, dtk.simulation.infectionSuidGenerator.next_suid.id)
+            self.assertEqual([], dtk.objects.dirty)
+            dtk.simulation = sim
+            self.assertEqual(next_suid + 1000, dtk.simulation.infectionSuidGenerator.next_suid.id)
+            # The assigned object is not shared either.
+            self.assertIsNot(dtk.simulation.infectionSuidGenerator, sim.infectionSuidGenerator)
+        return
+
+    def test_simulation_uses_cache(self):
+        for cache_size, decodes in [(0, 5), (10, 1)]:
+            dtk = dft.read(os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk"))
+            dtk.objects.cache_size = cache_size
+            with mock.patch.object(dft, "__decode__", wraps=dft.__decode__) as decode:
+                simulations = [dtk.simulation for _ in range(5)]
+            self.assertEqual(decodes, decode.call_count)
+            self.assertEqual(simulations[0], simulations[4])
+            self.assertIsNot(simulations[0], simulations[4])
+            self.assertTrue("nodes" in dtk.objects[0])
+        return
+
+    def test_only_dirty_chunks_are_encoded(self):
+        dtk = dft.read(os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk"))
+        chunks = list(dtk.chunks)
+        node = dtk.nodes[2]
+        node.externalId = 271828
+        dtk.nodes[2] = node
+        self.assertEqual([3], dtk.objects.dirty)
+        handle, filename = tempfile.mkstemp()
+        os.close(handle)
+        dft.write(dtk, filename)
+        self.assertEqual([], dtk.objects.dirty)
+        for index in [0, 1, 2, 4]:
+            self.assertIs(chunks[index], dtk.chunks[index])
+        self.assertIsNot(chunks[3], dtk.chunks[3])
+        dest = dft.read(filename)
+        os.remove(filename)
+        self.assertEqual(271828, dest.nodes[2].externalId)
+        self.assertEqual(dtk.nodes[1], dest.nodes[1])
+        return
+
+    def test_invalidate(self):
+        dtk = dft.read(os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk"))
+        node = dtk.nodes[0]
+        node.externalId = 3
+        dtk.nodes[0] = node
+        dtk.objects.invalidate(1)
+        self.assertEqual([], dtk.objects.dirty)
+        self.assertIsNot(node, dtk.nodes[0])
+        self.assertEqual(3, dtk.nodes[0].externalId)
+        # Replacing the contents of a chunk drops the cached object.
+        dtk.contents[1] = dtk.contents[2]
+        self.assertEqual(2, dtk.nodes[0].externalId)
+        return
+
+
+class TestDtkWriter(unittest.TestCase):
+
+    def stream(self, version, compression, node_count=1000):
+        source = dft.read(os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk"))
+        handle, filename = tempfile.mkstemp()
+        os.close(handle)
+        with dft.DtkWriter(filename, version=version, compression=compression, node_count=node_count) as writer:
+            writer.header.author = "streamer"
+            writer.write_simulation(source.simulation)
+            for node in source.nodes:
+                writer.write_node(node)
+        dest = dft.read(filename)
+        os.remove(filename)
+        self.assertEqual(version, dest.version)
+        self.assertEqual(compression, dest.compression)
+        self.assertEqual("streamer", dest.author)
+        self.assertEqual(source.chunk_count, dest.chunk_count)
+        self.assertEqual(source.simulation, dest.simulation)
+        for index in range(len(source.nodes)):
+            self.assertEqual(source.nodes[index], dest.nodes[index])
+        return dest
+
+    def test_stream_versions(self):
+        for version in [2, 3, 4, 5]:
+            self.stream(version, dft.LZ4)
+        self.stream(5, dft.NONE)
+        return
+
+    def test_stream_header_overflow(self):
+        dest = self.stream(5, dft.LZ4, node_count=0)
+        self.assertEqual(sum(dest.chunk_sizes), dest.byte_count)
+        return
+
+    def test_stream_raw_chunks(self):
+        source = dft.read(os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk"))
+        handle, filename = tempfile.mkstemp()
+        os.close(handle)
+        with dft.DtkWriter(filename, version=4, compression=source.compression) as writer:
+            for chunk in source.chunks:
+                writer.write_chunk(chunk)
+        dest = dft.read(filename)
+        os.remove(filename)
+        self.assertEqual(source.chunks, dest.chunks)
+        return
+
+    def test_stream_order(self):
+        handle, filename = tempfile.mkstemp()
+        os.close(handle)
+        writer = dft.DtkWriter(filename)
+        with self.assertRaises(UserWarning):
+            writer.write_node({"suid": {"id": 1}})
+        writer.write_simulation({"__class__": "Simulation", "nodes": []})
+        with self.assertRaises(UserWarning):
+            writer.write_simulation({"__class__": "Simulation", "nodes": []})
+        writer.close()
+        self.assertEqual(1, dft.read(filename).chunk_count)
+        os.remove(filename)
+        return
+
+    def test_stream_failure(self):
+        source = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk")
+        directory = tempfile.mkdtemp()
+        filename = os.path.join(directory, "state.dtk")
+        shutil.copyfile(source, filename)
+        with self.assertRaises(ValueError):
+            with dft.DtkWriter(filename) as writer:
+                writer.write_simulation(dft.read(source).simulation)
+                raise ValueError("failed to build the nodes")
+        # The existing file is untouched and no partial file is left behind.
+        self.assertEqual(["state.dtk"], os.listdir(directory))
+        self.assertEqual(dft.read(source).chunks, dft.read(filename).chunks)
+        # Relocating the header of a complete file leaves no temporary files either.
+        with dft.DtkWriter(filename, node_count=0) as writer:
+            writer.write_simulation(dft.read(source).simulation)
+            for node in dft.read(source).nodes:
+                writer.write_node(node)
+        self.assertEqual(["state.dtk"], os.listdir(directory))
+        self.assertEqual(5, dft.read(filename).chunk_count)
+        shutil.rmtree(directory)
+        return
+
+
+class TestStreamingIndividuals(unittest.TestCase):
+
+    def test_iter_individuals(self):
+        for name in ["version2.dtk", "version4.dtk", "uncompressed.dtk"]:
+            filename = os.path.join(WORKING_DIRECTORY, "data", "serialization", name)
+            dtk = dft.read(filename, memory_map=True)
+            streamed = list(dtk.iter_individuals(0))
+            self.assertEqual(0, len(dtk.objects._cache))
+            self.assertEqual(dft.read(filename).nodes[0].individualHumans, streamed)
+            self.assertIsInstance(streamed[0], support.SerialObject)
+            self.assertEqual(streamed[-1].m_age, streamed[-1]["m_age"])
+        return
+
+    def test_iter_individuals_modified_node(self):
+        dtk = dft.read(os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk"))
+        node = dtk.nodes[-1]
+        del node.individualHumans[10:]
+        dtk.nodes[-1] = node
+        self.assertEqual(10, len(list(dtk.iter_individuals(-1))))
+        with self.assertRaises(IndexError):
+            next(dtk.iter_individuals(4))
+        return
+
+    def test_small_blocks(self):
+        text = '{"a": [1, {"b": 12345}], "individualHumans" : [ {"x": "\u00e9t\u00e9", "y": [1.25, true, null]}, 1234567 , "s" ], "z": 0}'
+        data = text.encode()
+        expected = json.loads(text)["individualHumans"]
+        for block_size in [1, 2, 3, 7, 1 << 20]:
+            self.assertEqual(expected, list(support.iter_json_array(data, ["individualHumans"], block_size=block_size)))
+        self.assertEqual([], list(support.iter_json_array(data, ["missing"])))
+        self.assertEqual([], list(support.iter_json_array(b'{"individualHumans":[]}', ["individualHumans"])))
+        self.assertEqual([12345], list(support.iter_json_array(b'{"n":{"a":[12345]}}', ["n", "a"], block_size=2)))
+        with self.assertRaises(ValueError):
+            list(support.iter_json_array(b'{"individualHumans":[1,2', ["individualHumans"], block_size=2))
+        return
+
+
+class TestMemoryMappedRead(unittest.TestCase):
+
+    def test_mapped_chunks_are_memoryviews(self):
+        filename = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk")
+        eager = dft.read(filename)
+        mapped = dft.read(filename, memory_map=True)
+        self.assertTrue(mapped.lazy)
+        self.assertIsInstance(mapped.chunks[1], memoryview)
+        self.assertEqual(eager.chunks[1], mapped.chunks[1].tobytes())
+        self.assertEqual(eager.simulation, mapped.simulation)
+        self.assertEqual(eager.nodes[2], mapped.nodes[2])
+        return
+
+    def test_mapped_uncompressed_file(self):
+        filename = os.path.join(WORKING_DIRECTORY, "data", "serialization", "uncompressed.dtk")
+        eager = dft.read(filename)
+        mapped = dft.read(filename, memory_map=True)
+        self.assertEqual(dft.NONE, mapped.compression)
+        self.assertEqual(eager.contents[1], mapped.contents[1])
+        return
+
+    def test_mapped_round_trip(self):
+        source = dft.read(os.path.join(WORKING_DIRECTORY, "data", "serialization", "baseline.dtk"), memory_map=True)
+        node = source.nodes[0]
+        node.externalId = 42
+        source.nodes[0] = node
+        handle, filename = tempfile.mkstemp()
+        os.close(handle)
+        dft.write(source, filename)
+        with dft.read(filename, memory_map=True) as dest:
+            self.assertEqual(42, dest.nodes[0].externalId)
+            self.assertEqual(source.chunks[1], dest.chunks[1])
+        os.remove(filename)
+        return
+
+    def test_close(self):
+        filename = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk")
+        eager = dft.read(filename)
+        with dft.read(filename, memory_map=True) as mapped:
+            self.assertIsInstance(mapped.chunks[1], memoryview)
+        # noinspection PyProtectedMember
+        self.assertIsNone(mapped.chunks._mapping)
+        # After closing the map the chunks are read from the file.
+        self.assertIsInstance(mapped.chunks[1], bytes)
+        self.assertEqual(eager.nodes[1], mapped.nodes[1])
+        mapped.close()
+        # Closing while a chunk is still in use fails and keeps the map open.
+        mapped = dft.read(filename, memory_map=True)
+        chunk = mapped.chunks[2]
+        self.assertRaises(UserWarning, mapped.close)
+        self.assertEqual(eager.chunks[2], chunk.tobytes())
+        self.assertEqual(eager.nodes[2], mapped.nodes[2])
+        chunk.release()
+        mapped.close()
+        # Files read completely or lazily have nothing to close.
+        with dft.read(filename, lazy=True) as lazy:
+            self.assertEqual(eager.nodes[0], lazy.nodes[0])
+        eager.close()
+        return
+
+
+class TestRecompression(unittest.TestCase):
+
+    def test_recompress_matches_contents(self):
+        filename = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk")
+        expected = list(dft.read(filename).contents)
+        for workers in [1, 4]:
+            dtk = dft.read(filename)
+            dtk.set_compression(dft.NONE, workers=workers)
+            self.assertEqual(dft.NONE, dtk.compression)
+            self.assertFalse(dtk.compressed)
+            self.assertEqual(expected, list(dtk.contents))
+            dtk.set_compression(dft.LZ4, workers=workers)
+            self.assertEqual(expected, list(dtk.contents))
+        return
+
+    def test_recompress_lazy_and_mapped(self):
+        filename = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk")
+        eager = dft.read(filename)
+        for dtk in [dft.read(filename, lazy=True), dft.read(filename, memory_map=True)]:
+            dtk.compression = dft.NONE
+            self.assertTrue(all(isinstance(chunk, bytes) for chunk in dtk.chunks))
+            self.assertEqual(list(eager.contents), list(dtk.contents))
+        return
+
+    def test_recompress_str_chunk(self):
+        dtk = dft.DtkFileV4()
+        dtk.compression = dft.NONE
+        dtk.contents.append('{"a":1}')
+        dtk.compression = dft.LZ4
+        self.assertEqual({"a": 1}, dtk.objects[0])
+        return
+
+    def test_recompress_keeps_dirty_objects(self):
+        filename = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk")
+        dtk = dft.read(filename)
+        node = dtk.nodes[1]
+        node.externalId = 42
+        dtk.nodes[1] = node
+        dtk.compression = dft.NONE
+        self.assertEqual(42, json.loads(dtk.contents[2])["externalId"])
+        return
+
+    def test_recompress_unknown_engine(self):
+        dtk = dft.read(os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk"))
+        with self.assertRaises(RuntimeError):
+            dtk.compression = "BROTLI"
+        self.assertEqual(dft.LZ4, dtk.compression)
+        return
+
+
+class TestCompressionEngines(unittest.TestCase):
+
+    class ZlibEngine(object):
+
+        @classmethod
+        def compress(cls, data, level=None):
+            return zlib.compress(data, -1 if level is None else level)
+
+        @classmethod
+        def uncompress(cls, data):
+            return zlib.decompress(data)
+
+    def round_trip(self, source):
+        handle, filename = tempfile.mkstemp()
+        os.close(handle)
+        dft.write(source, filename)
+        dest = dft.read(filename)
+        os.remove(filename)
+        return dest
+
+    def test_lz4_high_compression(self):
+        source = dft.read(os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk"))
+        expected = list(source.contents)
+        default_size = source.byte_count
+        source.set_compression(dft.LZ4, level=9)
+        self.assertEqual(9, source.compression_level)
+        self.assertLessEqual(source.byte_count, default_size)
+        dest = self.round_trip(source)
+        self.assertEqual(dft.LZ4, dest.compression)
+        self.assertEqual(expected, list(dest.contents))
+        return
+
+    def test_level_used_for_modified_chunks(self):
+        source = dft.read(os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk"))
+        source.set_compression(dft.LZ4, level=12)
+        node = source.nodes[0]
+        node.externalId = 42
+        source.nodes[0] = node
+        self.assertEqual(support.EllZeeFour.compress(source.contents[1].encode(), level=12), source.chunks[1])
+        return
+
+    def test_register_engine(self):
+        dft.register_engine("zlib", self.ZlibEngine)
+        try:
+            source = dft.read(os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk"))
+            expected = list(source.contents)
+            source.set_compression("zlib", level=6)
+            self.assertEqual("ZLIB", source.compression)
+            dest = self.round_trip(source)
+            self.assertEqual("ZLIB", dest.compression)
+            self.assertEqual(expected, list(dest.contents))
+        finally:
+            del dft.__engines__["ZLIB"]
+        return
+
+    def test_register_invalid_engine(self):
+        with self.assertRaises(UserWarning):
+            dft.register_engine("bogus", object())
+        self.assertNotIn("BOGUS", dft.__engines__)
+        return
+
+    @unittest.skipUnless(support.ZSTD_SUPPORT, "zstandard not installed")
+    def test_zstd(self):
+        source = dft.read(os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk"))
+        expected = list(source.contents)
+        source.set_compression(dft.ZSTD, level=19)
+        dest = self.round_trip(source)
+        self.assertEqual(dft.ZSTD, dest.compression)
+        self.assertEqual(expected, list(dest.contents))
+        return
+
+    def test_writer_compression_level(self):
+        source = dft.read(os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk"))
+        handle, filename = tempfile.mkstemp()
+        os.close(handle)
+        with dft.DtkWriter(filename, version=4, compression=dft.LZ4, node_count=4, compression_level=9) as writer:
+            self.assertEqual(9, writer.compression_level)
+            writer.write_contents(source.contents[0])
+        dest = dft.read(filename)
+        self.assertEqual(support.EllZeeFour.compress(source.contents[0], level=9), dest.chunks[0])
+        os.remove(filename)
+        return
+
+
+class TestDtkFileUtility(unittest.TestCase):
+
+    def setUp(self):
+        self.filename = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk")
+        self.directory = tempfile.mkdtemp()
+        return
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        return
+
+    def read_args(self, **kwargs):
+        args = dict(filename=self.filename, header=None, raw=False, unformatted=True,
+                    output=os.path.join(self.directory, "out"), chunk=None, header_only=False)
+        args.update(kwargs)
+        return argparse.Namespace(**args)
+
+    def test_read_single_chunk(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            dtkFileUtility.__do_read__(self.read_args(chunk=[2]))
+        self.assertEqual(["out.node-00002.json"], os.listdir(self.directory))
+        with open(os.path.join(self.directory, "out.node-00002.json")) as handle:
+            self.assertEqual(dft.read(self.filename).contents[2], handle.read())
+        return
+
+    def test_read_bad_chunk(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(UserWarning):
+                dtkFileUtility.__do_read__(self.read_args(chunk=[5]))
+        self.assertEqual([], os.listdir(self.directory))
+        return
+
+    def test_read_header_only(self):
+        header = os.path.join(self.directory, "header.json")
+        with contextlib.redirect_stdout(io.StringIO()):
+            dtkFileUtility.__do_read__(self.read_args(header=header, header_only=True))
+        self.assertEqual(["header.json"], os.listdir(self.directory))
+        with open(header) as handle:
+            self.assertEqual(dft.read(self.filename).chunk_sizes, json.load(handle)["chunksizes"])
+        return
+
+    def test_list(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            dtkFileUtility.__do_list__(argparse.Namespace(filename=self.filename))
+        dtk = dft.read(self.filename, lazy=True)
+        lines = output.getvalue().splitlines()
+        for index in range(dtk.chunk_count):
+            self.assertIn([str(index), str(dtk.chunks.offset(index)), str(dtk.chunk_sizes[index])],
+                          [line.split()[:3] for line in lines])
+        return
+
+    def test_write(self):
+        with contextlib.redirect_stdout(io.StringIO()):
+            dtkFileUtility.__do_read__(self.read_args())
+        names = sorted(os.listdir(self.directory))
+        filename = os.path.join(self.directory, "out.dtk")
+        args = argparse.Namespace(filename=filename, simulation=os.path.join(self.directory, names[-1]),
+                                  nodes=[os.path.join(self.directory, name) for name in names[:-1]],
+                                  author="author", tool="tool", compress=True, verify=False, engine="LZ4", level=None,
+                                  checksums=False)
+        with contextlib.redirect_stderr(io.StringIO()):
+            dtkFileUtility.__do_write__(args)
+        source = dft.read(self.filename)
+        dest = dft.read(filename)
+        self.assertEqual(3, dest.version)
+        self.assertEqual("author", dest.author)
+        self.assertEqual(list(source.contents), list(dest.contents))
+        return
+
+
+class TestDtkFileDiff(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.source = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk")
+        cls.directory = tempfile.mkdtemp()
+        dtk = dft.read(cls.source)
+        node = dtk.nodes[1]
+        for individual in node.individualHumans[:3]:
+            individual.m_age += 1
+            individual.susceptibility.age += 1
+        node.individualHumans[10].m_is_infected = not node.individualHumans[10].m_is_infected
+        dtk.nodes[1] = node
+        node = dtk.nodes[2]
+        del node.individualHumans[0]
+        node.externalId = 42
+        dtk.nodes[2] = node
+        cls.modified = os.path.join(cls.directory, "modified.dtk")
+        dft.write(dtk, cls.modified)
+        dtk = dft.read(cls.source)
+        dtk.compression = dft.NONE
+        dtk.author = "someone else"
+        cls.uncompressed = os.path.join(cls.directory, "uncompressed.dtk")
+        dft.write(dtk, cls.uncompressed)
+        return
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.directory, ignore_errors=True)
+        return
+
+    def check_modified(self, result):
+        self.assertFalse(result.identical)
+        self.assertEqual({}, result.header)
+        self.assertEqual([], result.simulation)
+        self.assertEqual([dtkdiff.IDENTICAL, dtkdiff.DIFFERENT, dtkdiff.DIFFERENT, dtkdiff.IDENTICAL], result.nodes)
+        self.assertEqual({"externalId": 1}, dict(result.node_fields))
+        self.assertEqual({"m_age": 3, "susceptibility.age": 3, "m_is_infected": 1}, dict(result.individual_fields))
+        self.assertEqual(4, result.individuals_changed)
+        self.assertEqual(0, result.individuals_added)
+        self.assertEqual(1, result.individuals_removed)
+        return
+
+    def test_identical(self):
+        result = dtkdiff.diff(self.source, self.source)
+        self.assertTrue(result.identical)
+        self.assertEqual([dtkdiff.IDENTICAL] * 4, result.nodes)
+        return
+
+    def test_modified(self):
+        self.check_modified(dtkdiff.diff(self.source, self.modified))
+        return
+
+    def test_modified_workers(self):
+        self.check_modified(dtkdiff.diff(self.source, self.modified, workers=2))
+        return
+
+    def test_recompressed(self):
+        result = dtkdiff.diff(self.source, self.uncompressed)
+        self.assertEqual({"author": ("IDM", "someone else"), "engine": ("LZ4", "NONE")}, result.header)
+        self.assertEqual([dtkdiff.IDENTICAL] * 4, result.nodes)
+        self.assertEqual(0, result.individuals_changed)
+        return
+
+    def test_checksums(self):
+        filename = os.path.join(self.directory, "checksums.dtk")
+        dft.write(dft.read(self.source), filename, checksums=True)
+        result = dtkdiff.diff(self.source, filename)
+        self.assertEqual({}, result.header)
+        self.assertTrue(result.identical)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            dtkFileUtility.__do_diff__(argparse.Namespace(first=self.source, second=filename, workers=None))
+        return
+
+    def test_added_and_removed_nodes(self):
+        dtk = dft.read(self.source)
+        dtk.chunks.pop()
+        filename = os.path.join(self.directory, "three-nodes.dtk")
+        dft.write(dtk, filename)
+        self.assertEqual([dtkdiff.IDENTICAL] * 3 + [dtkdiff.REMOVED], dtkdiff.diff(self.source, filename).nodes)
+        self.assertEqual([dtkdiff.IDENTICAL] * 3 + [dtkdiff.ADDED], dtkdiff.diff(filename, self.source).nodes)
+        return
+
+    def test_different_versions(self):
+        source = dft.read(self.source)
+        filename = os.path.join(self.directory, "version5.dtk")
+        with dft.DtkWriter(filename, version=5, compression=source.compression) as writer:
+            for chunk in source.chunks:
+                writer.write_chunk(chunk)
+        result = dtkdiff.diff(self.source, filename)
+        self.assertEqual((4, 5), result.header["version"])
+        self.assertEqual([], result.simulation)
+        self.assertEqual([dtkdiff.IDENTICAL] * 4, result.nodes)
+        return
+
+    def test_report_and_utility(self):
+        self.assertIn("m_age: 3 individuals", str(dtkdiff.diff(self.source, self.modified)))
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            with self.assertRaises(SystemExit):
+                dtkFileUtility.__do_diff__(argparse.Namespace(first=self.source, second=self.modified, workers=None))
+            dtkFileUtility.__do_diff__(argparse.Namespace(first=self.source, second=self.source, workers=None))
+        self.assertIn("1 removed", output.getvalue())
+        return
+
+
 class TestReadVersion5(TestReadVersionFour, TestReadWrite):
 
     def test_dtkheader_5(self):
@@ -1309,5 +1983,623 @@ class TestReadVersion5(TestReadVersionFour, TestReadWrite):
         self.assertEqual(test_emod_sccs_date, time.strptime(header5_extension['emod_info']["emod_sccs_date"]))
 
 
+class TestSerializedPopulation(unittest.TestCase):
+
+    def test_parallel_read(self):
+        filename = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk")
+        serial = SerPop.SerializedPopulation(filename)
+        parallel = SerPop.SerializedPopulation(filename, workers=2)
+        self.assertEqual(4, len(parallel.nodes))
+        self.assertEqual(serial.nodes, parallel.nodes)
+        human = parallel.nodes[3].individualHumans[0]
+        self.assertIsInstance(human, support.SerialObject)
+        self.assertEqual(human["m_age"], human.m_age)
+        return
+
+    def test_parallel_read_version2(self):
+        dtk = dft.read(os.path.join(WORKING_DIRECTORY, "data", "serialization", "version2.dtk"))
+        self.assertEqual([node for node in dtk.nodes], dft.read_nodes(dtk, workers=2))
+        return
+
+    def test_write_only_modified_nodes(self):
+        filename = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk")
+        source = dft.read(filename)
+        ser_pop = SerPop.SerializedPopulation(filename)
+        ser_pop.nodes[1].individualHumans[0].m_age = 42.0
+        handle, output = tempfile.mkstemp()
+        os.close(handle)
+        ser_pop.write(output)
+        dest = dft.read(output)
+        os.remove(output)
+        self.assertEqual(42.0, dest.nodes[1].individualHumans[0].m_age)
+        self.assertNotEqual(source.chunks[2], dest.chunks[2])
+        for index in [1, 3, 4]:
+            self.assertEqual(source.chunks[index], dest.chunks[index])
+        return
+
+    def test_write_compresses_modified_nodes_once(self):
+        filename = os.path.join(WORKING_DIRECTORY, "data", "serialization", "uncompressed.dtk")
+        ser_pop = SerPop.SerializedPopulation(filename)
+        ser_pop.nodes[0].individualHumans[0].m_age = 42.0
+        handle, output = tempfile.mkstemp()
+        os.close(handle)
+        with mock.patch.object(dft, "recompress", wraps=dft.recompress) as recompress:
+            ser_pop.write(output)
+        # The chunk of the modified node is only compressed when it is serialized.
+        self.assertEqual(ser_pop.dtk.chunk_count - 1, recompress.call_count)
+        dest = dft.read(output)
+        self.assertEqual(dft.LZ4, dest.compression)
+        self.assertEqual(42.0, dest.nodes[0].individualHumans[0].m_age)
+        # A second write only serializes the node which was handed out again.
+        chunks = list(ser_pop.dtk.chunks)
+        ser_pop.write(output)
+        self.assertIsNot(chunks[1], ser_pop.dtk.chunks[1])
+        for index in range(2, len(chunks)):
+            self.assertIs(chunks[index], ser_pop.dtk.chunks[index])
+        os.remove(output)
+        return
+
+    def test_write_twice_with_a_kept_node(self):
+        filename = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk")
+        ser_pop = SerPop.SerializedPopulation(filename)
+        node = ser_pop.nodes[0]
+        handle, first = tempfile.mkstemp()
+        os.close(handle)
+        handle, second = tempfile.mkstemp()
+        os.close(handle)
+        ser_pop.write(first)
+        # Changes made to a node after a write are written by the next write.
+        node["individualHumans"][0]["m_age"] = 42.0
+        ser_pop.write(second)
+        self.assertNotEqual(42.0, dft.read(first).nodes[0].individualHumans[0].m_age)
+        self.assertEqual(42.0, dft.read(second).nodes[0].individualHumans[0].m_age)
+        os.remove(first)
+        os.remove(second)
+        return
+
+    def test_mark_dirty(self):
+        filename = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk")
+        ser_pop = SerPop.SerializedPopulation(filename)
+        ser_pop.mark_dirty(-1)
+        ser_pop.flush()
+        self.assertEqual([4], ser_pop.dtk.objects.dirty)
+        for node in ser_pop.nodes:
+            pass
+        ser_pop.flush()
+        self.assertEqual([1, 2, 3, 4], ser_pop.dtk.objects.dirty)
+        with self.assertRaises(IndexError):
+            ser_pop.mark_dirty(4)
+        return
+
+    def test_invalid_node_index_is_not_marked(self):
+        filename = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk")
+        ser_pop = SerPop.SerializedPopulation(filename)
+        with self.assertRaises(IndexError):
+            ser_pop.nodes[7]
+        with self.assertRaises(IndexError):
+            ser_pop.nodes[-5] = ser_pop.nodes[0]
+        self.assertEqual({0}, ser_pop._nodes.dirty)
+        self.assertEqual(2, len(ser_pop.nodes[2:9]))
+        self.assertEqual({0, 2, 3}, ser_pop._nodes.dirty)
+        ser_pop.nodes[-1] = ser_pop.nodes[-1]
+        self.assertEqual({0, 2, 3}, ser_pop._nodes.dirty)
+        handle, output = tempfile.mkstemp()
+        os.close(handle)
+        ser_pop.write(output)
+        self.assertEqual(dft.read(filename).nodes[3], dft.read(output).nodes[3])
+        os.remove(output)
+        return
+
+    def test_allocate_suids(self):
+        filename = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk")
+        ser_pop = SerPop.SerializedPopulation(filename)
+        self.assertEqual([{"id": 9996}, {"id": 9997}], ser_pop.allocate_infection_suids(2))
+        self.assertEqual({"id": 9998}, ser_pop.get_next_infection_suid())
+        self.assertEqual([], ser_pop.allocate_infection_suids(0))
+        with self.assertRaises(ValueError):
+            ser_pop.allocate_infection_suids(-2)
+        with self.assertRaises(ValueError):
+            ser_pop.allocate_individual_suids(1, -1)
+        # The generator is not moved back by a negative count.
+        self.assertEqual(9999, ser_pop._suid_generators["infectionSuidGenerator"][0])
+        # These nodes have no generator, the simulation's individual suid generator is used.
+        self.assertEqual({"id": 10001}, ser_pop.get_next_individual_suid(1))
+        self.assertEqual({"id": 10002}, ser_pop.get_next_individual_suid(2))
+        suids = ser_pop.allocate_individual_suids(1, 100000)
+        self.assertEqual(list(range(10003, 110003)), [suid["id"] for suid in suids])
+        handle, output = tempfile.mkstemp()
+        os.close(handle)
+        ser_pop.write(output)
+        dest = dft.read(output)
+        os.remove(output)
+        self.assertEqual({"id": 9999}, dest.simulation["infectionSuidGenerator"]["next_suid"])
+        self.assertEqual({"id": 110003}, dest.simulation["individualHumanSuidGenerator"]["next_suid"])
+        return
+
+    def test_allocate_suids_numtasks(self):
+        filename = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version3.dtk")
+        ser_pop = SerPop.SerializedPopulation(filename)
+        sim = ser_pop.dtk.simulation
+        sim["infectionSuidGenerator"]["numtasks"] = 4
+        ser_pop.dtk.simulation = sim
+        ser_pop.nodes[0]["m_IndividualHumanSuidGenerator"] = {"next_suid": {"id": 5000}, "rank": 1, "numtasks": 3}
+        self.assertEqual([6803, 6807, 6811], [suid["id"] for suid in ser_pop.allocate_infection_suids(3)])
+        self.assertEqual({"id": 6815}, ser_pop.get_next_infection_suid())
+        self.assertEqual([5000, 5003], [suid["id"] for suid in ser_pop.allocate_individual_suids(0, 2)])
+        self.assertEqual({"id": 5006}, ser_pop.get_next_individual_suid(0))
+        self.assertEqual(5009, ser_pop.nodes[0]["m_IndividualHumanSuidGenerator"]["next_suid"]["id"])
+        return
+
+    def test_to_table(self):
+        filename = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk")
+        ser_pop = SerPop.SerializedPopulation(filename)
+        human = ser_pop.nodes[2].individualHumans[7]
+        human["Properties"] = ["Age_Bin:Age_Bin_Property_From_0_To_20", "Risk:HIGH"]
+        table = ser_pop.to_table(["m_age", "infections", "susceptibility.mod_acquire", "Properties.Risk", "no_such"])
+        self.assertEqual(10000, len(table))
+        self.assertEqual([2500] * 4, list(table.groupby("node").size()))
+        row = table[table.node == 2].iloc[7]
+        self.assertEqual(human.m_age, row["m_age"])
+        self.assertEqual(len(human.infections), row["infections"])
+        self.assertEqual("HIGH", row["Properties.Risk"])
+        self.assertTrue(table["Properties.Risk"].isna().iloc[0])
+        self.assertTrue(table["no_such"].isna().all())
+        return
+
+    def test_read_table(self):
+        filename = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk")
+        expected = SerPop.SerializedPopulation(filename).to_table()
+        for workers in [None, 2]:
+            table = SerPop.read_table(filename, workers=workers)
+            self.assertEqual(list(expected.columns), list(table.columns))
+            self.assertTrue(expected.equals(table))
+        return
+
+    def test_read_table_empty_node(self):
+        filename = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk")
+        expected = SerPop.read_table(filename)
+        dtk = dft.read(filename)
+        node = dtk.nodes[1]
+        count = len(node.individualHumans)
+        node.individualHumans = []
+        dtk.nodes[1] = node
+        handle, output = tempfile.mkstemp()
+        os.close(handle)
+        dft.write(dtk, output)
+        table = SerPop.read_table(output)
+        os.remove(output)
+        self.assertEqual(len(expected) - count, len(table))
+        self.assertEqual(list(expected.dtypes), list(table.dtypes))
+        self.assertTrue(expected[expected.node != 1].reset_index(drop=True).equals(table))
+        return
+
+    def test_set_field(self):
+        filename = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk")
+        ser_pop = SerPop.SerializedPopulation(filename)
+        table = ser_pop.to_table(["m_age", "susceptibility.mod_acquire"])
+        young = table.m_age < 20 * 365
+        changed = ser_pop.set_field("susceptibility.mod_acquire", 0, where=young)
+        self.assertEqual(young.sum(), changed)
+        ser_pop.set_field("Properties.Risk", "LOW", where=young)
+        ser_pop.set_field("m_age", table.m_age + 1)
+        result = ser_pop.to_table(["m_age", "susceptibility.mod_acquire", "Properties.Risk"])
+        self.assertTrue((result.m_age == table.m_age + 1).all())
+        self.assertTrue((result["susceptibility.mod_acquire"][young] == 0).all())
+        self.assertTrue((result["susceptibility.mod_acquire"][~young] == table["susceptibility.mod_acquire"][~young]).all())
+        self.assertTrue((result["Properties.Risk"][young] == "LOW").all())
+        with self.assertRaises(ValueError):
+            ser_pop.set_field("m_age", 0, where=young[:10])
+        with self.assertRaises(ValueError):
+            ser_pop.set_field("m_age", [1, 2, 3], where=young)
+        return
+
+    def test_change_ser_pop_fields(self):
+        filename = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk")
+        handle, output = tempfile.mkstemp()
+        os.close(handle)
+        CensusAndModPop.change_ser_pop_fields(
+            filename, [("susceptibility.mod_acquire", 0, lambda table: table.m_age < 20 * 365)], output)
+        table = SerPop.read_table(output)
+        os.remove(output)
+        young = table.m_age < 20 * 365
+        self.assertTrue(young.any())
+        self.assertTrue((table["susceptibility.mod_acquire"][young] == 0).all())
+        self.assertEqual(4, len(table.node.unique()))
+        return
+
+    @unittest.skipUnless(importlib.util.find_spec("pyarrow"), "pyarrow not installed.")
+    def test_to_parquet(self):
+        ser_pop = SerPop.SerializedPopulation(os.path.join(WORKING_DIRECTORY, "data", "serialization", "version3.dtk"))
+        handle, filename = tempfile.mkstemp()
+        os.close(handle)
+        ser_pop.to_parquet(filename, ["m_age", "m_gender"])
+        import pandas as pd
+        table = pd.read_parquet(filename)
+        os.remove(filename)
+        self.assertEqual(list(ser_pop.to_table(["m_age", "m_gender"]).m_age), list(table.m_age))
+        return
+
+    def test_serial_object_copy(self):
+        dtk = dft.read(os.path.join(WORKING_DIRECTORY, "data", "serialization", "version3.dtk"))
+        human = dtk.nodes[0].individualHumans[0]
+        for duplicate in [copy.deepcopy(human), pickle.loads(pickle.dumps(human))]:
+            self.assertEqual(human, duplicate)
+            duplicate.m_age = 1.5
+            self.assertEqual(1.5, duplicate["m_age"])
+            self.assertEqual(human.susceptibility.age, duplicate.susceptibility.age)
+        self.assertEqual(support.NullPtr(), pickle.loads(pickle.dumps(support.NullPtr())))
+        return
+
+
+class TestKeyPathIndex(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.filename = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk")
+        cls.ser_pop = SerPop.SerializedPopulation(cls.filename)
+        return
+
+    def test_paths(self):
+        index = self.ser_pop.key_paths()
+        self.assertIs(index, self.ser_pop.key_paths())
+        self.assertIn("individualHumans[].susceptibility.age", index)
+        self.assertIn("individualHumans[].suid.id", index)
+        self.assertNotIn("individualHumans.m_age", index)
+        self.assertEqual(index.paths, list(index))
+        self.assertEqual(len(index.paths), len(index))
+        return
+
+    def test_info(self):
+        index = self.ser_pop.key_paths()
+        self.assertEqual(SerPop.KeyPathInfo("individualHumans[].m_gender", ("int",), 400, 2),
+                         index["individualHumans[].m_gender"])
+        self.assertEqual(SerPop.KeyPathInfo("individualHumans", ("list",), 4, None), index["individualHumans"])
+        self.assertEqual(("dict",), index["individualHumans[].susceptibility"].types)
+        self.assertEqual(4, index["externalId"].cardinality)
+        with self.assertRaises(KeyError):
+            index["individualHumans[].no_such_field"]
+        return
+
+    def test_sample(self):
+        full = SerPop.KeyPathIndex(self.ser_pop.nodes, sample=None)
+        self.assertEqual(10000, full["individualHumans[].m_age"].count)
+        small = SerPop.KeyPathIndex(self.ser_pop.nodes, sample=10, max_values=5)
+        self.assertEqual(40, small["individualHumans[].m_age"].count)
+        self.assertEqual(5, small["individualHumans[].m_age"].cardinality)
+        return
+
+    def test_find(self):
+        index = self.ser_pop.key_paths()
+        self.assertEqual(["individualHumans[].m_age", "individualHumans[].susceptibility.age"], index.find("age"))
+        self.assertEqual(index.find("age"), index.find("AGE"))
+        self.assertEqual(["individualHumans[].m_age"], index.find("individualHumans[].m_age"))
+        self.assertIn("individualHumans[].m_gender", index.find("gendr"))
+        self.assertEqual([], index.find("xyzzy"))
+        return
+
+    def test_from_file(self):
+        index = self.ser_pop.key_paths()
+        for workers in [None, 2]:
+            from_file = SerPop.KeyPathIndex.from_file(self.filename, workers=workers)
+            self.assertEqual(index.paths, from_file.paths)
+            self.assertEqual([index[path] for path in index], [from_file[path] for path in from_file])
+        return
+
+    def test_refresh(self):
+        ser_pop = SerPop.SerializedPopulation(self.filename)
+        self.assertNotIn("individualHumans[].new_field", ser_pop.key_paths())
+        ser_pop.nodes[0].individualHumans[0]["new_field"] = 1
+        self.assertNotIn("individualHumans[].new_field", ser_pop.key_paths())
+        self.assertIn("individualHumans[].new_field", ser_pop.key_paths(sample=None, refresh=True))
+        return
+
+class TestCompactObjects(unittest.TestCase):
+
+    filename = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk")
+
+    def test_same_objects_and_json(self):
+        default = dft.read(self.filename)
+        compact = dft.read(self.filename, compact=True)
+        self.assertTrue(compact.compact)
+        node = compact.nodes[0]
+        self.assertIsInstance(node, support.CompactObject)
+        self.assertIsInstance(node.individualHumans[0].susceptibility, support.CompactObject)
+        self.assertEqual(default.nodes[0], node)
+        self.assertEqual(json.dumps(default.nodes[0]), json.dumps(node, default=support.json_default))
+        self.assertEqual(default.simulation, compact.simulation)
+        return
+
+    def test_mapping_and_attributes(self):
+        individual = dft.read(self.filename, compact=True).nodes[0].individualHumans[0]
+        other = dft.read(self.filename, compact=True).nodes[0].individualHumans[1]
+        # noinspection PyProtectedMember
+        self.assertIs(individual._shape, other._shape)
+        self.assertEqual(individual["m_age"], individual.m_age)
+        individual.m_age = 1.5
+        individual.susceptibility["age"] = 1.5
+        individual.new_field = [1, 2]
+        self.assertEqual(1.5, individual["m_age"])
+        self.assertEqual("new_field", list(individual)[-1])
+        del individual["new_field"]
+        self.assertNotIn("new_field", individual)
+        with self.assertRaises(AttributeError):
+            individual.no_such_field
+        with self.assertRaises(KeyError):
+            individual["no_such_field"]
+        self.assertEqual(3, individual.get("no_such_field", 3))
+        self.assertEqual(individual, dict(individual))
+        self.assertEqual(individual, copy.deepcopy(individual))
+        self.assertEqual(individual, pickle.loads(pickle.dumps(individual)))
+        self.assertEqual({"a": 2}, support.CompactObject([("a", 1), ("a", 2)]))
+        return
+
+    def test_shape_registry_is_bounded(self):
+        limit = support.MAX_SHAPES
+        support.MAX_SHAPES = 100
+        try:
+            objects = [support.CompactObject([("key{0}".format(index), index)]) for index in range(250)]
+            self.assertLessEqual(len(support.__shapes__), 100)
+            # Objects created before the registry was cleared keep their keys.
+            for index, item in enumerate(objects):
+                self.assertEqual({"key{0}".format(index): index}, item)
+            item = objects[0]
+            item.added = 1
+            self.assertEqual({"key0": 0, "added": 1}, item)
+        finally:
+            support.MAX_SHAPES = limit
+        return
+
+    def test_write_round_trip(self):
+        source = dft.read(self.filename, compact=True)
+        node = source.nodes[1]
+        node.individualHumans[0].m_age += 1
+        source.nodes[1] = node
+        handle, filename = tempfile.mkstemp()
+        os.close(handle)
+        dft.write(source, filename)
+        expected = dft.read(self.filename)
+        node = expected.nodes[1]
+        node.individualHumans[0].m_age += 1
+        expected.nodes[1] = node
+        dest = dft.read(filename)
+        os.remove(filename)
+        self.assertEqual(list(expected.chunks), list(dest.chunks))
+        return
+
+    def test_workers_and_streaming(self):
+        nodes = dft.read_nodes(dft.read(self.filename, lazy=True, compact=True), workers=2)
+        self.assertIsInstance(nodes[2], support.CompactObject)
+        self.assertEqual(dft.read(self.filename).nodes[2], nodes[2])
+        individuals = dft.read(self.filename, compact=True).iter_individuals(3)
+        self.assertIsInstance(next(individuals), support.CompactObject)
+        return
+
+    def test_serialized_population(self):
+        default = SerPop.SerializedPopulation(self.filename)
+        compact = SerPop.SerializedPopulation(self.filename, compact=True)
+        self.assertTrue(default.to_table().equals(compact.to_table()))
+        self.assertTrue(SerPop.read_table(self.filename, compact=True).equals(default.to_table()))
+        self.assertEqual(10000, compact.set_field("susceptibility.mod_acquire", 0.5))
+        self.assertEqual(0.5, compact.nodes[3].individualHumans[-1].susceptibility.mod_acquire)
+        return
+
+    def test_memory(self):
+        contents = dft.read(self.filename).contents[1]
+        sizes = []
+        for compact in [False, True]:
+            tracemalloc.start()
+            node = dft.__decode__(contents, compact)
+            sizes.append(tracemalloc.get_traced_memory()[0])
+            tracemalloc.stop()
+            del node
+        self.assertLess(sizes[1], 0.75 * sizes[0])
+        return
+
+class TestMergeSplit(unittest.TestCase):
+
+    def setUp(self):
+        self.filename = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk")
+        self.directory = tempfile.mkdtemp()
+        return
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        return
+
+    def test_split_and_merge(self):
+        source = dft.read(self.filename)
+        filenames = dft.split(self.filename, output=os.path.join(self.directory, "node-{0}.dtk"))
+        self.assertEqual([os.path.join(self.directory, "node-{0}.dtk".format(index)) for index in range(4)], filenames)
+        for index, filename in enumerate(filenames):
+            part = dft.read(filename)
+            self.assertEqual(1, len(part.nodes))
+            self.assertEqual(source.chunks[index + 1], part.chunks[1])
+            self.assertEqual(source.simulation, part.simulation)
+            self.assertEqual("IDM", part.author)
+        merged = os.path.join(self.directory, "merged.dtk")
+        self.assertEqual(4, dft.merge(filenames, merged))
+        dest = dft.read(merged)
+        self.assertEqual(4, dest.version)
+        self.assertEqual(list(source.chunks)[1:], list(dest.chunks)[1:])
+        self.assertEqual(source.simulation, dest.simulation)
+        return
+
+    def test_split_groups(self):
+        source = dft.read(self.filename)
+        filenames = dft.split(self.filename, groups=[[3, 0], [1]], output=os.path.join(self.directory, "part{0}.dtk"))
+        first = dft.read(filenames[0])
+        self.assertEqual([source.chunks[4], source.chunks[1]], list(first.chunks)[1:])
+        self.assertEqual(1, len(dft.read(filenames[1]).nodes))
+        return
+
+    def test_merge_suid_generators_and_compression(self):
+        version3 = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version3.dtk")
+        merged = os.path.join(self.directory, "merged.dtk")
+        self.assertEqual(5, dft.merge([(version3, [0]), self.filename], merged, compression=dft.NONE))
+        dest = dft.read(merged)
+        self.assertEqual(3, dest.version)
+        self.assertEqual(dft.NONE, dest.compression)
+        simulation = dft.read(version3).simulation
+        self.assertEqual(simulation.Run_Number, dest.simulation.Run_Number)
+        self.assertEqual(9996, dest.simulation.infectionSuidGenerator.next_suid.id)
+        self.assertEqual(10001, dest.simulation.individualHumanSuidGenerator.next_suid.id)
+        self.assertEqual(dft.read(version3).nodes[0], dest.nodes[0])
+        self.assertEqual(dft.read(self.filename).nodes[3], dest.nodes[4])
+        return
+
+    def test_merge_errors(self):
+        with self.assertRaises(UserWarning):
+            dft.merge([], os.path.join(self.directory, "empty.dtk"))
+        with self.assertRaises(UserWarning):
+            dft.merge([self.filename], self.filename)
+        with self.assertRaises(IndexError):
+            dft.merge([(self.filename, [4])], os.path.join(self.directory, "bad.dtk"))
+        with self.assertRaises(UserWarning):
+            dft.merge([os.path.join(WORKING_DIRECTORY, "data", "serialization", "version2.dtk"), self.filename],
+                      os.path.join(self.directory, "mixed.dtk"))
+        return
+
+class TestChecksums(unittest.TestCase):
+
+    def setUp(self):
+        self.source = os.path.join(WORKING_DIRECTORY, "data", "serialization", "version4.dtk")
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "checksums.dtk")
+        dft.write(dft.read(self.source), self.filename, checksums=True)
+        return
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        return
+
+    def corrupt(self, index):
+        # Flip a byte in the middle of the given chunk.
+        dtk = dft.read(self.filename, lazy=True)
+        position = dtk.chunks.offset(index) + dtk.chunk_sizes[index] // 2
+        with open(self.filename, "r+b") as handle:
+            handle.seek(position)
+            value = handle.read(1)
+            handle.seek(position)
+            handle.write(bytes([value[0] ^ 0xFF]))
+        return
+
+    def test_round_trip(self):
+        source = dft.read(self.source)
+        dest = dft.read(self.filename)
+        self.assertEqual([zlib.crc32(chunk) for chunk in source.chunks], dest.header.chunkchecksums)
+        self.assertEqual(list(source.chunks), list(dest.chunks))
+        self.assertNotIn("chunkchecksums", source.header)
+        # Checksums are kept on rewrite and updated for modified chunks.
+        dest.nodes[2] = dest.nodes[2]
+        dest.nodes[2].individualHumans[0]["m_age"] += 1
+        rewritten = os.path.join(self.directory, "rewritten.dtk")
+        dft.write(dest, rewritten)
+        self.assertEqual([zlib.crc32(chunk) for chunk in dest.chunks], dft.read(rewritten).header.chunkchecksums)
+        dft.write(dft.read(rewritten), rewritten, checksums=False)
+        self.assertNotIn("chunkchecksums", dft.read(rewritten).header)
+        return
+
+    def test_lazy_chunk_checksums(self):
+        dtk = dft.read(self.filename, lazy=True)
+        self.assertEqual(dtk.header.chunkchecksums, dtk.chunk_checksums())
+        dtk.nodes[0] = dtk.nodes[0]
+        self.assertIsNone(dtk.chunks.checksum(1))
+        self.assertEqual(zlib.crc32(dtk.chunks[1]), dtk.chunk_checksums(workers=2)[1])
+        return
+
+    def test_corrupt_chunk(self):
+        self.corrupt(3)
+        with self.assertRaises(UserWarning):
+            dft.read(self.filename)
+        # Lazily read files check each chunk when it is read.
+        for memory_map in [False, True]:
+            dtk = dft.read(self.filename, lazy=True, memory_map=memory_map)
+            self.assertEqual(2500, len(dtk.nodes[0].individualHumans))
+            with self.assertRaises(UserWarning):
+                dtk.nodes[2]
+        # Checking can be disabled to salvage the intact chunks.
+        self.assertEqual(2500, len(dft.read(self.filename, verify=False).nodes[0].individualHumans))
+        return
+
+    def test_verify(self):
+        self.assertEqual([], dft.verify(self.filename))
+        self.assertEqual([], dft.verify(self.source, workers=2))
+        self.corrupt(3)
+        problems = dft.verify(self.filename)
+        self.assertEqual(1, len(problems))
+        self.assertIn("chunk 3", problems[0])
+        truncated = os.path.join(WORKING_DIRECTORY, "data", "serialization", "truncated.dtk")
+        self.assertEqual(1, len(dft.verify(truncated)))
+        with contextlib.redirect_stdout(io.StringIO()):
+            with self.assertRaises(SystemExit):
+                dtkFileUtility.__do_verify__(argparse.Namespace(filename=self.filename, workers=None))
+        return
+
+    def test_writer_checksums(self):
+        source = dft.read(self.source)
+        filename = os.path.join(self.directory, "writer.dtk")
+        with dft.DtkWriter(filename, version=5, compression=dft.LZ4, node_count=1, checksums=True) as writer:
+            for chunk in source.chunks:
+                writer.write_chunk(chunk)
+        dest = dft.read(filename)
+        self.assertEqual([zlib.crc32(chunk) for chunk in source.chunks], dest.header.chunkchecksums)
+        # Merged files keep checksums if the first source has them.
+        merged = os.path.join(self.directory, "merged.dtk")
+        dft.merge([(filename, [3, 1])], merged)
+        self.assertEqual([zlib.crc32(chunk) for chunk in dft.read(merged).chunks],
+                         dft.read(merged).header.chunkchecksums)
+        return
+
+
+def _process_id(filename):
+    return os.getpid()
+
+
+class TestBatch(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = os.path.join(WORKING_DIRECTORY, "data", "serialization")
+        self.files = [os.path.join(self.directory, name + ".dtk") for name in ["version3", "version4", "truncated"]]
+        return
+
+    def test_serial(self):
+        results = list(batch.map(self.files, dft.verify))
+        self.assertEqual(self.files, [item.file for item in results])
+        self.assertEqual([[], []], [item.result for item in results[:2]])
+        self.assertEqual(1, len(results[2].result))
+        self.assertTrue(all(item.error is None and item.seconds >= 0 for item in results))
+        return
+
+    def test_workers(self):
+        missing = os.path.join(self.directory, "no-such-file.dtk")
+        results = {item.file: item for item in batch.map(self.files + [missing], dft.verify, workers=2)}
+        self.assertEqual(set(self.files + [missing]), set(results))
+        self.assertEqual([], results[self.files[1]].result)
+        self.assertIsNone(results[self.files[1]].error)
+        self.assertIsNone(results[missing].result)
+        self.assertIn("FileNotFoundError", results[missing].error)
+        if importlib.util.find_spec("resource"):
+            self.assertGreater(results[self.files[0]].peak_rss, 0)
+        return
+
+    def test_worker_processes_are_replaced(self):
+        files = self.files[:2] * 2
+        results = list(batch.map(files, _process_id, workers=2))
+        self.assertEqual(len(files), len(set(item.result for item in results)))
+        # Before Python 3.11 each group of files runs in a new single process pool.
+        for max_tasks_per_child in [1, 2]:
+            results = list(batch.__map_recycled__(files, _process_id, 2, max_tasks_per_child, {}))
+            self.assertEqual(sorted(files), sorted(item.file for item in results))
+            self.assertEqual(len(files) // max_tasks_per_child, len(set(item.result for item in results)))
+        return
+
+    def test_glob_and_memory_limit(self):
+        pattern = os.path.join(self.directory, "version[34].dtk")
+        results = list(batch.map(pattern, dft.verify, workers=2, max_tasks_per_child=None, memory_limit=2**34))
+        self.assertEqual(sorted(self.files[:2]), sorted(item.file for item in results))
+        self.assertTrue(all(item.result == [] for item in results))
+        return
+
+
 if __name__ == "__main__":
     unittest.main()